@@ -19,6 +19,7 @@ import json
 import logging
 import os
 import re
+import time
 from functools import wraps
 
 import cherrypy
@@ -41,7 +42,7 @@ from girder.utility import setting_utilities
 from girder.utility.model_importer import ModelImporter
 from girder.utility.webroot import Webroot
 
-from . import handlers, rest
+from . import assets, folder_config, handlers, ingest, rest, virtual_folders
 from .constants import PluginSettings
 from .models.aperio import Aperio
 from .models.case import Case
@@ -99,37 +100,74 @@ def patchCookieParsing():
         pass
 
 
+#: When rendered webroot HTML is cached, the built assets are checked for
+#: changes at most this often in seconds.
+WEBROOT_BUILD_CHECK_INTERVAL = 10
+
+# Links to built assets that get a content hash parameter.  The second group
+# is the path relative to the built directory.
+_builtAssetPattern = re.compile(
+    r'(<(?:link rel="(?:icon|stylesheet)" [^>]*href|script src)='
+    r'"[^>?"]*/built/([^>?"]*\.(?:css|png|js)))(")')
+
+# This is incremented whenever cached webroot HTML could be stale
+_webrootGeneration = 0
+
+
+def invalidateWebrootCaches(event=None):
+    """
+    Discard the cached HTML of all webroots.  This is a handler for setting
+    change events, since settings are used in rendering webroots.
+
+    :param event: the event that triggered this or None.
+    """
+    global _webrootGeneration
+
+    _webrootGeneration += 1
+
+
+def _hashAssetUrl(match):
+    """
+    Add the content hash of an asset to a link matched by _builtAssetPattern.
+
+    :param match: the regex match.
+    :returns: the link.
+    """
+    assetHash = assets.getManifest().hash(match.group(2))
+    if not assetHash:
+        return match.group(0)
+    return match.group(1) + '?_=' + assetHash + match.group(3)
+
+
 def betterInvalidateJSandCSSCaches(root):
-    from girder import constants
+    """
+    Add a content hash parameter to each built asset link in a webroot's HTML,
+    and cache the rendered HTML.  The cache is discarded when a setting
+    changes (see invalidateWebrootCaches) or, checked at most every
+    WEBROOT_BUILD_CHECK_INTERVAL seconds, when the built assets change.
 
+    :param root: the webroot to modify.
+    """
     origRenderHTML = root._renderHTML
+    root._htmlCache = None
 
     def _renderHTML(self):
-        topBuiltDir = os.path.join(constants.STATIC_ROOT_DIR, 'built')
-        result = origRenderHTML()
-        lastUpdate = 0
-        for filename in {
-                'girder_lib.min.js', 'girder_app.min.js', 'girder_lib.min.css',
-                'Girder_Favicon.png'}:
-            filepath = os.path.join(topBuiltDir, filename)
-            if os.path.exists(filepath):
-                lastUpdate = max(lastUpdate, os.path.getmtime(filepath))
-        builtDir = os.path.join(constants.STATIC_ROOT_DIR, 'built', 'plugins')
-        for pluginName in self.vars['plugins']:
-            for filepath in [
-                os.path.join(builtDir, pluginName, 'plugin.min.css'),
-                os.path.join(builtDir, pluginName, 'plugin.min.js'),
-            ]:
-                if os.path.exists(filepath):
-                    lastUpdate = max(lastUpdate, os.path.getmtime(filepath))
-        luParam = '?_=%d' % int(lastUpdate * 1000)
-        while True:
-            match = re.search(
-                r'<(link rel="(icon|stylesheet)" [^>]*href="[^>?"]*\.(css|png)|'
-                r'script src="[^>?"]*.js)">', result)
-            if not match:
-                break
-            result = result[:match.span()[1] - 2] + luParam + result[match.span()[1] - 2:]
+        cached = self._htmlCache
+        if cached is not None and cached['generation'] == _webrootGeneration:
+            now = time.time()
+            if now - cached['checked'] < WEBROOT_BUILD_CHECK_INTERVAL:
+                return cached['html']
+            if assets.getManifest().refresh() == cached['assetVersion']:
+                cached['checked'] = now
+                return cached['html']
+        generation = _webrootGeneration
+        result = _builtAssetPattern.sub(_hashAssetUrl, origRenderHTML())
+        self._htmlCache = {
+            'html': result,
+            'generation': generation,
+            'assetVersion': assets.getManifest().version,
+            'checked': time.time(),
+        }
         return result
 
     root._renderHTML = _renderHTML.__get__(root)
@@ -240,6 +278,7 @@ def validateHistomicsUIHelp(doc):
 
 @setting_utilities.validator({
     PluginSettings.HUI_DELETE_ANNOTATIONS_AFTER_INGEST,
+    PluginSettings.HUI_MATERIALIZE_VIRTUAL_FOLDERS,
 })
 def validateBoolean(doc):
     val = doc['value']
@@ -254,9 +293,15 @@ def childItems(self, folder, limit=0, offset=0, sort=None, filters=None,
         return Folder._childItemsBeforeHUI(
             self, folder, limit=limit, offset=offset, sort=sort,
             filters=filters, **kwargs)
-    q = json_util.loads(folder['virtualItemsQuery'])
     if 'virtualItemsSort' in folder and sort is None:
         sort = json.loads(folder['virtualItemsSort'])
+    ordering = None if filters else virtual_folders.virtualFolderOrderings.get(
+        folder, sort or [])
+    if ordering is not None:
+        ids = ordering.ids(offset, limit)
+        items = {item['_id']: item for item in Item().find({'_id': {'$in': ids}}, **kwargs)}
+        return [items[itemId] for itemId in ids if itemId in items]
+    q = virtual_folders.virtualItemsQuery(folder)
     q.update(filters or {})
     return Item().find(q, limit=limit, offset=offset, sort=sort, **kwargs)
 
@@ -424,6 +469,13 @@ class GirderPlugin(plugin.GirderPlugin):
         rest.addEndpoints(info['apiRoot'])
         info['serverRoot'].updateHtmlVars({
             'brandName': Setting().get(SettingKey.BRAND_NAME)})
+        # Support finding adjacent images in name order with range queries
+        Item().ensureIndex(([('folderId', 1), ('name', 1), ('_id', 1)], {}))
+        # Support listing items of many folders in id order and filtering
+        # folders by access in queries
+        Item().ensureIndex(([('folderId', 1), ('_id', 1)], {}))
+        for key in ('access.users.id', 'access.groups.id', 'public'):
+            Folder().ensureIndex(key)
         # Better virtual folder support
         if not getattr(Folder, '_childItemsBeforeHUI', None):
             Folder._childItemsBeforeHUI = Folder.childItems
@@ -434,8 +486,7 @@ class GirderPlugin(plugin.GirderPlugin):
 
         def lookUpToken(token, parentType, parent):
             if parentType == 'folder' and parent.get('isVirtual') and 'virtualItemsQuery' in parent:
-                q = json_util.loads(parent['virtualItemsQuery'])
-                q = {'$and': [q, {'name': token}]}
+                q = {'$and': [virtual_folders.virtualItemsQuery(parent), {'name': token}]}
                 item = Item().findOne(q)
                 if item:
                     return item, 'item'
@@ -449,6 +500,7 @@ class GirderPlugin(plugin.GirderPlugin):
 
         betterInvalidateJSandCSSCaches(girderRoot)
         betterInvalidateJSandCSSCaches(huiRoot)
+        assets.enableStaticAssets(girderRoot.vars['plugins'])
 
         # The interface is always available under hui and also available
         # under the specified path.
@@ -468,9 +520,40 @@ class GirderPlugin(plugin.GirderPlugin):
         # Auto-ingest metadata into parent when a file with an identifier
         # ending in 'ItemMetadata' is uploaded (usually .meta files).
         events.bind('data.process', 'histomicsui.metadata', handlers.process_metadata)
+        # Auto-ingest metadata for many items from a table (CSV, TSV, or
+        # NDJSON) with an identifier ending in 'ItemMetadataTable'.
+        events.bind('data.process', 'histomicsui.metadata_table',
+                    handlers.process_metadata_table)
 
         events.bind('model.job.save', 'histomicsui', _saveJob)
 
+        # Resolved folder config files are cached until a config file or a
+        # folder changes.
+        folder_config.folderConfigCache.clear()
+        for eventName in ('model.item.save.after', 'model.item.remove',
+                          'model.file.save.after', 'model.file.remove'):
+            events.bind(eventName, 'histomicsui.folder_config',
+                        folder_config.folderConfigCache.itemChanged)
+        for eventName in ('model.item.save', 'model.file.save'):
+            events.bind(eventName, 'histomicsui.folder_config',
+                        folder_config.folderConfigCache.itemSaving)
+        for eventName in ('model.folder.save.after', 'model.folder.remove'):
+            events.bind(eventName, 'histomicsui.folder_config',
+                        folder_config.folderConfigCache.clear)
+
+        # Bootstrap ETags change when a folder's items change.
+        for eventName in ('model.item.save.after', 'model.item.remove'):
+            events.bind(eventName, 'histomicsui.bootstrap',
+                        rest.hui_resource.folderItemsChanged)
+
+        # Materialized virtual folder orderings are kept current as items
+        # change.
+        virtual_folders.virtualFolderOrderings.clear()
+        events.bind('model.item.save.after', 'histomicsui.virtual_folders',
+                    virtual_folders.virtualFolderOrderings.itemSaved)
+        events.bind('model.item.remove', 'histomicsui.virtual_folders',
+                    virtual_folders.virtualFolderOrderings.itemRemoved)
+
         handlers.json_nans_as_nulls()
 
         def updateWebroot(event):
@@ -483,6 +566,16 @@ class GirderPlugin(plugin.GirderPlugin):
                 setattr(info['serverRoot'], event.info['value'], huiRoot)
 
         events.bind('model.setting.save.after', 'histomicsui', updateWebroot)
+        events.bind('model.setting.save.after', 'histomicsui.webroot', invalidateWebrootCaches)
+        events.bind('model.setting.remove', 'histomicsui.webroot', invalidateWebrootCaches)
+        # The database may have changed since the plugin was last loaded
+        rest.hui_resource.invalidatePublicSettings()
+        events.bind('model.setting.save.after', 'histomicsui.settings',
+                    rest.hui_resource.invalidatePublicSettings)
+        events.bind('model.setting.remove', 'histomicsui.settings',
+                    rest.hui_resource.invalidatePublicSettings)
 
         restrict_downloads(info)
         cleanupFSAssetstores()
+        # Queued ingest jobs are only kept in memory
+        ingest.recoverIngestJobs()
@@ -0,0 +1,316 @@
+"""
+Content-hashed URLs and precompressed variants of built static assets.
+
+Webroots reference built assets with a ``?_=<hash>`` parameter, where the hash
+is of the asset's contents.  Hashes are kept in a manifest that is saved next
+to the built assets so they are only recomputed when an asset changes.  When a
+request for a static asset carries its current hash, it is served with
+long-lived immutable cache headers.  Large assets get ``.br`` (if the brotli
+module is installed) and ``.gz`` siblings which are served to clients that
+accept those encodings.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import threading
+
+import cherrypy
+from girder import logger
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+HASH_LENGTH = 16
+MANIFEST_NAME = 'histomicsui_asset_manifest.json'
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Built assets that get precompressed siblings
+_compressiblePattern = re.compile(
+    r'^(girder_(lib|app)\.min\.(js|css)|plugins/[^/]+/plugin\.min\.(js|css)|'
+    r'plugins/histomicsui/extra/plotly\.js)$')
+# Encodings in order of preference with the suffix of their sibling files
+_encodings = (('br', '.br'), ('gzip', '.gz'))
+
+
+def assetHash(path):
+    """
+    Compute the content hash used in asset URLs.
+
+    :param path: the path of the file.
+    :returns: a hexadecimal string.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fptr:
+        for chunk in iter(lambda: fptr.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:HASH_LENGTH]
+
+
+class AssetManifest:
+    """
+    A record of the content hashes of built assets.  Entries are keyed by the
+    asset path relative to the built directory and store the file's size and
+    modification time, so a hash is only recomputed when these change.
+    """
+
+    def __init__(self, builtDir=None):
+        """
+        :param builtDir: the directory of built assets.  If None, this is the
+            built directory of girder's static root.
+        """
+        if builtDir is None:
+            from girder import constants
+
+            builtDir = os.path.join(constants.STATIC_ROOT_DIR, 'built')
+        self.builtDir = builtDir
+        self.entries = None
+        #: Incremented whenever the hash of any asset changes.
+        self.version = 0
+        self._lock = threading.RLock()
+
+    def _load(self):
+        self.entries = {}
+        try:
+            with open(os.path.join(self.builtDir, MANIFEST_NAME)) as fptr:
+                entries = json.load(fptr)
+            if isinstance(entries, dict):
+                self.entries = entries
+        except (OSError, ValueError):
+            pass
+
+    def _save(self):
+        path = os.path.join(self.builtDir, MANIFEST_NAME)
+        try:
+            with open(path + '.tmp', 'w') as fptr:
+                json.dump(self.entries, fptr, sort_keys=True, indent=1)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            logger.debug('Could not save the asset manifest to %s', path)
+
+    def _update(self, relpath):
+        """
+        Make sure the manifest entry of an asset is current.
+
+        :param relpath: the path of the asset relative to the built directory.
+        :returns: True if the entry changed.
+        """
+        path = os.path.join(self.builtDir, relpath)
+        entry = self.entries.get(relpath)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            if entry is None:
+                return False
+            del self.entries[relpath]
+            return True
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return False
+        digest = assetHash(path)
+        self.entries[relpath] = {'hash': digest, 'size': stat.st_size, 'mtime': stat.st_mtime}
+        return entry is None or entry['hash'] != digest
+
+    def hash(self, relpath):
+        """
+        Get the content hash of an asset, adding it to the manifest if needed.
+
+        :param relpath: the path of the asset relative to the built directory.
+        :returns: the hash or None if the asset doesn't exist.
+        """
+        if '..' in relpath.split('/'):
+            return None
+        with self._lock:
+            if self.entries is None:
+                self._load()
+            if relpath not in self.entries and self._update(relpath):
+                self.version += 1
+                self._save()
+            entry = self.entries.get(relpath)
+            return entry['hash'] if entry else None
+
+    def current(self, relpath):
+        """
+        Get the content hash of an asset in the manifest without checking the
+        file.
+
+        :param relpath: the path of the asset relative to the built directory.
+        :returns: the hash or None if the asset isn't in the manifest.
+        """
+        with self._lock:
+            if self.entries is None:
+                self._load()
+            entry = self.entries.get(relpath)
+            return entry['hash'] if entry else None
+
+    def refresh(self):
+        """
+        Check every asset in the manifest for changes.
+
+        :returns: the manifest version.
+        """
+        with self._lock:
+            if self.entries is None:
+                self._load()
+            changed = False
+            for relpath in list(self.entries):
+                changed = self._update(relpath) or changed
+            if changed:
+                self.version += 1
+                self._save()
+            return self.version
+
+    def precompress(self):
+        """
+        Write compressed siblings of the compressible assets in the manifest
+        that don't have current ones.  Files are written atomically, so this
+        can run while assets are served.
+
+        :returns: the number of files written.
+        """
+        with self._lock:
+            relpaths = [relpath for relpath in self.entries or {}
+                        if _compressiblePattern.match(relpath)]
+        written = 0
+        for relpath in relpaths:
+            path = os.path.join(self.builtDir, relpath)
+            for encoding, suffix in _encodings:
+                if encoding == 'br' and brotli is None:
+                    continue
+                if _currentSibling(path, suffix):
+                    continue
+                try:
+                    with open(path, 'rb') as fptr:
+                        data = fptr.read()
+                    data = (brotli.compress(data) if encoding == 'br'
+                            else gzip.compress(data, mtime=0))
+                    with open(path + suffix + '.tmp', 'wb') as fptr:
+                        fptr.write(data)
+                    os.replace(path + suffix + '.tmp', path + suffix)
+                    written += 1
+                except OSError:
+                    logger.debug('Could not write %s%s', path, suffix)
+        if written:
+            logger.info('Precompressed %d static asset file(s)', written)
+        return written
+
+
+def _currentSibling(path, suffix):
+    """
+    Check if a compressed sibling of a file exists and is at least as new as
+    the file.
+
+    :param path: the path of the original file.
+    :param suffix: the suffix of the sibling.
+    :returns: True if the sibling is current.
+    """
+    try:
+        return os.path.getmtime(path + suffix) >= os.path.getmtime(path)
+    except OSError:
+        return False
+
+
+_manifest = None
+
+
+def getManifest():
+    """
+    Get the asset manifest for girder's built directory.
+
+    :returns: the AssetManifest.
+    """
+    global _manifest
+
+    if _manifest is None:
+        _manifest = AssetManifest()
+    return _manifest
+
+
+def webrootAssets(plugins):
+    """
+    List the built assets used by webroots and the plotly library.
+
+    :param plugins: a list of the loaded plugins.
+    :returns: a list of paths relative to the built directory.
+    """
+    relpaths = [
+        'girder_lib.min.js', 'girder_app.min.js', 'girder_lib.min.css', 'Girder_Favicon.png',
+        'plugins/histomicsui/favicon.png', 'plugins/histomicsui/extra/plotly.js']
+    for pluginName in plugins:
+        relpaths.append('plugins/%s/plugin.min.css' % pluginName)
+        relpaths.append('plugins/%s/plugin.min.js' % pluginName)
+    return relpaths
+
+
+def _setEncodingHeaders(contentType, encoding):
+    headers = cherrypy.serving.response.headers
+    headers['Content-Type'] = contentType
+    headers['Content-Encoding'] = encoding
+
+
+def serveStaticAsset():
+    """
+    A cherrypy tool for the static file route.  Requests for built assets that
+    carry the asset's current hash get immutable cache headers, and
+    compressible assets are served from a precompressed sibling when the
+    client accepts its encoding.
+    """
+    request = cherrypy.serving.request
+    if (not request.config.get('tools.staticdir.on') or
+            not request.path_info.startswith('/built/')):
+        return
+    relpath = request.path_info[len('/built/'):]
+    manifest = getManifest()
+    currentHash = manifest.current(relpath)
+    if currentHash is None:
+        return
+    headers = cherrypy.serving.response.headers
+    if request.params.get('_') == currentHash:
+        headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    if not _compressiblePattern.match(relpath):
+        return
+    headers['Vary'] = 'Accept-Encoding'
+    accepted = {element.value.lower() for element in request.headers.elements('Accept-Encoding')
+                if element.qvalue > 0}
+    path = os.path.join(manifest.builtDir, relpath)
+    for encoding, suffix in _encodings:
+        if encoding in accepted and _currentSibling(path, suffix):
+            # Let the staticdir tool serve the sibling, since it handles
+            # conditional and range requests; it can't determine the headers
+            # for the original file, so set them before finishing.
+            request.path_info += suffix
+            request.hooks.attach(
+                'before_finalize', _setEncodingHeaders,
+                contentType=mimetypes.guess_type(path)[0], encoding=encoding)
+            return
+
+
+def enableStaticAssets(plugins):
+    """
+    Serve built assets with immutable cache headers and precompressed
+    variants.  The webroot assets are hashed and missing precompressed
+    variants are written in the background.
+
+    :param plugins: a list of the loaded plugins.
+    """
+    if not hasattr(cherrypy.tools, 'histomicsui_assets'):
+        # Run before the staticdir tool so precompressed files can be served
+        cherrypy.tools.histomicsui_assets = cherrypy.Tool(
+            'before_handler', serveStaticAsset, priority=40)
+    cherrypy.config.update({'tools.histomicsui_assets.on': True})
+
+    def prepare():
+        try:
+            manifest = getManifest()
+            manifest.refresh()
+            for relpath in webrootAssets(plugins):
+                manifest.hash(relpath)
+            manifest.precompress()
+        except Exception:
+            logger.exception('Failed to prepare static assets')
+
+    threading.Thread(target=prepare, daemon=True, name='HistomicsUI-assets').start()
@@ -0,0 +1,319 @@
+"""
+Ingest annotations from a compact binary columnar format.
+
+A columnar annotation file is a numpy ``.npz`` archive (as written by
+``numpy.savez`` or ``numpy.savez_compressed``) describing a single annotation.
+It can contain:
+
+- ``name``, ``description``: optional scalar strings for the annotation.
+- ``point_center``: an (N, 2) or (N, 3) array of point element centers.
+- ``polyline_coords``: a (V, 2) or (V, 3) array of the vertices of all
+  polyline elements, one after another.
+- ``polyline_offsets``: a (K + 1,) integer array; polyline k uses vertices
+  ``offsets[k]`` up to ``offsets[k + 1]``.  The first value must be 0 and the
+  last must be V.
+- ``polyline_closed``: an optional (K,) boolean array.  Polylines are closed
+  if this is absent.
+- Per-element property columns for either kind of element, named
+  ``point_<property>`` or ``polyline_<property>``, where property is one of
+  ``label``, ``group``, ``fillColor``, ``lineColor`` (string arrays), or
+  ``lineWidth`` (a numeric array).  Empty strings and NaN widths leave the
+  property unset on that element.
+
+Coordinates are converted to element documents and bounding boxes with
+vectorized numpy operations rather than per-vertex python code.
+"""
+
+import time
+
+import numpy as np
+from girder import logger
+from girder.exceptions import ValidationException
+from girder_large_image_annotation.models.annotation import Annotation
+
+from . import ingest
+from .plugin_config import getPluginConfig
+
+_stringProperties = ('label', 'group', 'fillColor', 'lineColor')
+_numberProperties = ('lineWidth',)
+
+
+def isColumnarFile(fptr):
+    """
+    Check if a file is a zip archive, and therefore might be a columnar
+    annotation file.  The file position is restored.
+
+    :param fptr: a file-like object opened for binary reading.
+    :returns: True if the file starts with a zip signature.
+    """
+    position = fptr.tell()
+    header = fptr.read(4)
+    fptr.seek(position)
+    return header == b'PK\x03\x04'
+
+
+def _coordinates(data, key):
+    """
+    Get an array of coordinates as an (N, 3) float array.
+
+    :param data: the loaded archive.
+    :param key: the name of the array.
+    :returns: a numpy array.
+    """
+    coords = np.asarray(data[key])
+    if (coords.ndim != 2 or coords.shape[1] not in {2, 3} or
+            not np.issubdtype(coords.dtype, np.number)):
+        msg = '%s must be an array of 2 or 3 numeric columns.' % key
+        raise ValidationException(msg)
+    coords = coords.astype(float, copy=False)
+    if not np.isfinite(coords).all():
+        msg = '%s must contain only finite values.' % key
+        raise ValidationException(msg)
+    if coords.shape[1] == 2:
+        coords = np.column_stack((coords, np.zeros(len(coords))))
+    return coords
+
+
+def _offsets(data, vertexCount):
+    """
+    Get and check the polyline offsets array.
+
+    :param data: the loaded archive.
+    :param vertexCount: the number of polyline vertices.
+    :returns: a numpy integer array.
+    """
+    if 'polyline_offsets' not in data:
+        msg = 'polyline_offsets is required with polyline_coords.'
+        raise ValidationException(msg)
+    offsets = np.asarray(data['polyline_offsets'])
+    if offsets.ndim != 1 or len(offsets) < 1 or not np.issubdtype(offsets.dtype, np.integer):
+        msg = 'polyline_offsets must be a one-dimensional integer array.'
+        raise ValidationException(msg)
+    if offsets[0] != 0 or offsets[-1] != vertexCount or (np.diff(offsets) < 2).any():
+        msg = ('polyline_offsets must start at 0, end at the number of vertices, and '
+               'give each polyline at least 2 vertices.')
+        raise ValidationException(msg)
+    return offsets.astype(np.int64, copy=False)
+
+
+def _properties(data, kind, count):
+    """
+    Get and check the per-element property columns for a kind of element.
+
+    :param data: the loaded archive.
+    :param kind: 'point' or 'polyline'.
+    :param count: the number of elements of this kind.
+    :returns: a dictionary of property names to numpy arrays.
+    """
+    columns = {}
+    for prop in _stringProperties + _numberProperties + (
+            ('closed', ) if kind == 'polyline' else ()):
+        key = '%s_%s' % (kind, prop)
+        if key not in data:
+            continue
+        column = np.asarray(data[key])
+        if column.shape != (count, ):
+            msg = '%s must have one value per element.' % key
+            raise ValidationException(msg)
+        if prop in _stringProperties and column.dtype.kind != 'U':
+            msg = '%s must be a string array.' % key
+            raise ValidationException(msg)
+        if prop in _numberProperties:
+            if not np.issubdtype(column.dtype, np.number):
+                msg = '%s must be a numeric array.' % key
+                raise ValidationException(msg)
+            column = column.astype(float, copy=False)
+            if (column[~np.isnan(column)] < 0).any() or np.isinf(column).any():
+                msg = '%s must contain non-negative finite values.' % key
+                raise ValidationException(msg)
+        if prop == 'closed':
+            column = column.astype(bool)
+        columns[prop] = column
+    _validatePropertyValues(columns)
+    return columns
+
+
+def _validatePropertyValues(columns):
+    """
+    Validate each distinct string property value once against the annotation
+    schema rather than validating every element.
+
+    :param columns: a dictionary of property names to numpy arrays.
+    """
+    samples = []
+    for prop in _stringProperties:
+        for value in np.unique(columns.get(prop, [])).tolist():
+            if value:
+                samples.append({'type': 'point', 'center': [0, 0, 0], prop: value})
+    for sample in samples:
+        if 'label' in sample:
+            sample['label'] = {'value': sample['label']}
+    if samples:
+        Annotation().validate({'annotation': {'name': 'validate', 'elements': samples}})
+
+
+def _applyProperties(elements, columns, start, stop):
+    """
+    Add property values to a batch of element dictionaries.
+
+    :param elements: a list of element dictionaries.  Modified.
+    :param columns: a dictionary of property names to numpy arrays.
+    :param start: the index of the first element of the batch.
+    :param stop: the index after the last element of the batch.
+    """
+    for prop, column in columns.items():
+        values = column[start:stop].tolist()
+        if prop == 'closed':
+            for element, value in zip(elements, values):
+                element[prop] = value
+        elif prop in _numberProperties:
+            for element, value in zip(elements, values):
+                if value == value:
+                    element[prop] = value
+        else:
+            for element, value in zip(elements, values):
+                if value:
+                    element[prop] = value if prop != 'label' else {'value': value}
+
+
+def _bboxEntries(elements, low, high, details):
+    """
+    Combine elements with their bounding boxes into element database entries.
+
+    :param elements: a list of element dictionaries.
+    :param low: an (N, 3) array of minimum coordinates.
+    :param high: an (N, 3) array of maximum coordinates.
+    :param details: an (N, ) array of the complexity of each element.
+    :returns: a list of element entries.
+    """
+    size = np.hypot(high[:, 0] - low[:, 0], high[:, 1] - low[:, 1])
+    return [{
+        'bbox': {
+            'lowx': lx, 'lowy': ly, 'lowz': lz, 'highx': hx, 'highy': hy, 'highz': hz,
+            'details': d, 'size': s,
+        },
+        'element': element,
+    } for element, (lx, ly, lz), (hx, hy, hz), d, s in zip(
+        elements, low.tolist(), high.tolist(), details.tolist(), size.tolist())]
+
+
+def _pointEntries(centers, columns, start, stop):
+    """
+    Create element entries for a batch of points.
+
+    :param centers: an (N, 3) array of point centers.
+    :param columns: property columns for points.
+    :param start: the index of the first point of the batch.
+    :param stop: the index after the last point of the batch.
+    :returns: a list of element entries.
+    """
+    batch = centers[start:stop]
+    elements = [{'type': 'point', 'center': center} for center in batch.tolist()]
+    _applyProperties(elements, columns, start, stop)
+    # Points are given a small extent, as large_image does.
+    low = batch - np.array([0.5, 0.5, 0])
+    high = batch + np.array([0.5, 0.5, 0])
+    return _bboxEntries(elements, low, high, np.ones(len(batch), dtype=int))
+
+
+def _polylineEntries(coords, offsets, columns, start, stop):
+    """
+    Create element entries for a batch of polylines.
+
+    :param coords: a (V, 3) array of all polyline vertices.
+    :param offsets: the polyline offsets into the coordinates.
+    :param columns: property columns for polylines.
+    :param start: the index of the first polyline of the batch.
+    :param stop: the index after the last polyline of the batch.
+    :returns: a list of element entries.
+    """
+    vstart, vstop = int(offsets[start]), int(offsets[stop])
+    vertices = coords[vstart:vstop]
+    starts = offsets[start:stop] - vstart
+    points = vertices.tolist()
+    bounds = np.append(starts, vstop - vstart).tolist()
+    elements = [{
+        'type': 'polyline',
+        'points': points[bounds[idx]:bounds[idx + 1]],
+        'closed': True,
+    } for idx in range(stop - start)]
+    _applyProperties(elements, columns, start, stop)
+    low = np.minimum.reduceat(vertices, starts, axis=0)
+    high = np.maximum.reduceat(vertices, starts, axis=0)
+    return _bboxEntries(elements, low, high, np.diff(offsets[start:stop + 1]))
+
+
+def _loadColumnar(fptr):
+    """
+    Load and check the arrays of a columnar annotation file.
+
+    :param fptr: a file-like object opened for binary reading.
+    :returns: the annotation properties and a list of (kind, count, function)
+        tuples, where function takes a start and stop index and returns
+        element entries.
+    """
+    try:
+        data = dict(np.load(fptr, allow_pickle=False))
+    except Exception:
+        msg = 'Could not read columnar annotation file.'
+        raise ValidationException(msg)
+    properties = {}
+    for key in ('name', 'description'):
+        if key in data:
+            if data[key].shape != () or data[key].dtype.kind != 'U':
+                msg = '%s must be a string.' % key
+                raise ValidationException(msg)
+            properties[key] = str(data[key])
+    kinds = []
+    if 'point_center' in data:
+        centers = _coordinates(data, 'point_center')
+        columns = _properties(data, 'point', len(centers))
+        kinds.append(('point', len(centers), lambda start, stop: _pointEntries(
+            centers, columns, start, stop)))
+    if 'polyline_coords' in data:
+        coords = _coordinates(data, 'polyline_coords')
+        offsets = _offsets(data, len(coords))
+        polyColumns = _properties(data, 'polyline', len(offsets) - 1)
+        kinds.append(('polyline', len(offsets) - 1, lambda start, stop: _polylineEntries(
+            coords, offsets, polyColumns, start, stop)))
+    if not kinds:
+        msg = 'A columnar annotation file must contain point_center or polyline_coords.'
+        raise ValidationException(msg)
+    return properties, kinds
+
+
+def ingestColumnarAnnotation(item, user, fptr, batchSize=None, progress=None):
+    """
+    Ingest an annotation from a columnar annotation file.  Everything is
+    checked before anything is stored, then element entries are created and
+    inserted in batches.
+
+    :param item: the item to add the annotation to.
+    :param user: the user creating the annotation.
+    :param fptr: a file-like object opened for binary reading.
+    :param batchSize: the number of elements to store at a time.  If None,
+        this is read from the config file.
+    :param progress: if not None, a function that is called with the number
+        of elements stored and the total number of elements after each batch.
+        If it raises an exception, anything already stored is removed.
+    :returns: the created annotation document without elements.
+    """
+    batchSize = max(1, int(batchSize or getPluginConfig('annotation_batch_size', 10000)))
+    startTime = time.time()
+    properties, kinds = _loadColumnar(fptr)
+    total = sum(count for _, count, _ in kinds)
+    writer = ingest.StreamedAnnotationWriter(item, user, properties)
+    try:
+        for _, count, entries in kinds:
+            for start in range(0, count, batchSize):
+                writer.addEntries(entries(start, min(start + batchSize, count)))
+                if progress:
+                    progress(writer.count, total)
+        annotation = writer.finish(properties)
+    except BaseException:
+        writer.discard()
+        raise
+    ingestTime = time.time() - startTime
+    logger.info('Ingested %d columnar element(s) in %5.3fs (%d elements/s)',
+                total, ingestTime, total / max(ingestTime, 1e-3))
+    return annotation
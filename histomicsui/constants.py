@@ -21,3 +21,4 @@ class PluginSettings:
     HUI_HELP_TEXT = 'histomicsui.help_text'
     HUI_LOGIN_TEXT = 'histomicsui.login_text'
     HUI_LOGIN_SESSION_EXPIRY_MINUTES = 'histomicsui.login_session_expiry_minutes'
+    HUI_MATERIALIZE_VIRTUAL_FOLDERS = 'histomicsui.materialize_virtual_folders'
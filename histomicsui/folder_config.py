@@ -0,0 +1,136 @@
+"""
+Cache resolved folder config files.
+
+Config files such as ``.large_image_config.yaml`` and
+``.histomicsui_config.yaml`` are resolved by walking up a folder's ancestry,
+parsing each config file found, and adjusting the result for the current
+user.  Resolved configs are cached by folder, file name, and the user's access
+context.  Since a config depends on every folder in the ancestry, the whole
+cache is discarded when any config file or folder changes, including when a
+config file is renamed.  Entries also
+expire, so changes made by other server processes are seen eventually.
+"""
+
+import copy
+import threading
+
+import cachetools
+import girder_large_image
+from girder.utility.model_importer import ModelImporter
+
+LARGE_IMAGE_CONFIG_NAME = '.large_image_config.yaml'
+HISTOMICSUI_CONFIG_NAME = '.histomicsui_config.yaml'
+CONFIG_NAMES = (LARGE_IMAGE_CONFIG_NAME, HISTOMICSUI_CONFIG_NAME)
+
+
+def _resolveConfig(folder, name, user):
+    # Newer versions of large_image renamed this function
+    yamlConfigFile = getattr(girder_large_image, 'yamlConfigFile', None)
+    if yamlConfigFile is None:
+        yamlConfigFile = girder_large_image.YAMLConfigFile
+    return yamlConfigFile(folder, name, user)
+
+
+class FolderConfigCache:
+    """
+    A cache of resolved folder config files.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300):
+        """
+        :param maxsize: the maximum number of resolved configs to keep.
+        :param ttl: the number of seconds a resolved config is kept.
+        """
+        self._cache = cachetools.TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._generation = 0
+        #: The number of configs returned from the cache.
+        self.hits = 0
+        #: The number of configs that were resolved.
+        self.misses = 0
+
+    def get(self, folder, name, user):
+        """
+        Get a resolved config file for a folder.
+
+        :param folder: the folder document.
+        :param name: the name of the config file.
+        :param user: the user the config is adjusted for.
+        :returns: the config or None.  This is a copy that can be modified.
+        """
+        key = (
+            folder['_id'], name,
+            user and (user['_id'], bool(user.get('admin')),
+                      tuple(sorted(str(group) for group in user.get('groups', [])))))
+        with self._lock:
+            if key in self._cache:
+                self.hits += 1
+                return copy.deepcopy(self._cache[key])
+            generation = self._generation
+        config = _resolveConfig(folder, name, user)
+        with self._lock:
+            self.misses += 1
+            # Don't cache a config that could have changed while resolving it
+            if generation == self._generation:
+                self._cache[key] = config
+        return copy.deepcopy(config)
+
+    @property
+    def generation(self):
+        """
+        A number that changes whenever the cache is cleared, which is whenever
+        any config file or folder changes in this process.
+        """
+        return self._generation
+
+    def clear(self, event=None):
+        """
+        Discard all cached configs.
+
+        :param event: the event that triggered this or None.
+        """
+        with self._lock:
+            self._cache.clear()
+            self._generation += 1
+
+    def itemChanged(self, event):
+        """
+        Discard all cached configs if a config file's item or file changed.
+        This is a handler for item and file save and remove events.
+
+        :param event: the event.
+        """
+        if event.info.get('name') in CONFIG_NAMES:
+            self.clear()
+
+    def itemSaving(self, event):
+        """
+        Discard all cached configs if an existing item or file that is about
+        to be saved was stored as a config file, since a renamed config file
+        no longer has a config name when it is saved.  This is a handler for
+        item and file save events, before the document is stored.
+
+        :param event: the event.
+        """
+        doc = event.info
+        if '_id' not in doc or doc.get('name') in CONFIG_NAMES or not len(self._cache):
+            return
+        stored = ModelImporter.model(event.name.split('.')[1]).collection.find_one(
+            {'_id': doc['_id']}, {'name': True})
+        if stored and stored.get('name') in CONFIG_NAMES:
+            self.clear()
+
+
+folderConfigCache = FolderConfigCache()
+
+
+def folderConfig(folder, name, user):
+    """
+    Get a resolved config file for a folder, using the cache.
+
+    :param folder: the folder document.
+    :param name: the name of the config file.
+    :param user: the user the config is adjusted for.
+    :returns: the config or None.
+    """
+    return folderConfigCache.get(folder, name, user)
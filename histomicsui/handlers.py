@@ -1,38 +1,47 @@
+import concurrent.futures
 import datetime
 import json
+import logging
 import math
+import threading
 import time
 
-import cachetools
 import cherrypy
 import girder.utility
 import girder_large_image_annotation
 import large_image.config
 import orjson
-from girder import logger
+from bson import ObjectId
+from girder import events, logger
 from girder.constants import AccessType
 from girder.exceptions import RestException
 from girder.models.file import File
 from girder.models.folder import Folder
 from girder.models.item import Item
+from girder.models.notification import Notification
 from girder.models.setting import Setting
-from girder.models.token import Token
 from girder.models.user import User
+from girder_jobs.models.job import Job
 from girder_large_image_annotation.models.annotation import Annotation
+from girder_large_image_annotation.models.annotationelement import Annotationelement
 
+from . import columnar, identifiers, ingest
 from .constants import PluginSettings
+from .models.ingested_annotation_file import IngestedAnnotationFile
+from .plugin_config import getPluginConfig
+from .sessions import sessionExtender
 
-_recentIdentifiers = cachetools.TTLCache(maxsize=100, ttl=86400)
 
-
-def _itemFromEvent(event, identifierEnding, itemAccessLevel=AccessType.READ):  # noqa
+def _referenceFromEvent(event, record=True):
     """
-    If an event has a reference and an associated identifier that ends with a
-    specific string, return the associated item, user, and image file.
+    Parse the reference of a data.process event.  If the reference has an
+    identifier and a uuid, the uploaded file is recorded so that other files
+    in the same batch can refer to it.
 
     :param event: the data.process event.
-    :param identifierEnding: the required end of the identifier.
-    :returns: a dictionary with item, user, and file if there was a match.
+    :param record: if False, don't record the identifier.
+    :returns: the reference dictionary and its identifier.  The identifier is
+        None if there is no usable reference.
     """
     info = event.info
     identifier = None
@@ -45,41 +54,151 @@ def _itemFromEvent(event, identifierEnding, itemAccessLevel=AccessType.READ):  #
                 identifier = reference['identifier']
         except (ValueError, TypeError):
             logger.debug('Failed to parse data.process reference: %r', reference)
-    if identifier and 'uuid' in reference:
-        if reference['uuid'] not in _recentIdentifiers:
-            _recentIdentifiers[reference['uuid']] = {}
-        _recentIdentifiers[reference['uuid']][identifier] = info
-        reprocessFunc = _recentIdentifiers[reference['uuid']].pop('_reprocess', None)
-        if reprocessFunc:
-            reprocessFunc()
+    if record and identifier and 'uuid' in reference:
+        fileInfo = info.get('file') or {}
+        for pending in identifiers.getIdentifierRegistry().record(
+                reference['uuid'], identifier,
+                {'file': {'_id': fileInfo.get('_id'), 'itemId': fileInfo.get('itemId')}}):
+            _reprocessIngest(pending)
+    return reference, identifier
+
+
+class EventModelCache:
+    """
+    Cache the item, file, folder, and user documents loaded while handling a
+    single event so that each is only fetched from the database once.
+    Access is still checked on each load, using cached parent documents.
+    """
+
+    # The totals across all events, which are changed from request and ingest
+    # threads
+    hits = 0
+    misses = 0
+    _countLock = threading.Lock()
+
+    def __init__(self):
+        self._docs = {}
+
+    def load(self, model, id, user=None, level=None):
+        """
+        Load a document, checking access if a level is specified.
+
+        :param model: one of the Item, File, Folder, or User model classes.
+        :param id: the id of the document.
+        :param user: the user to check access for.
+        :param level: the access level required or None to not check access.
+        :returns: the document or None if it doesn't exist.
+        """
+        key = (model.__name__, str(id))
+        hit = key in self._docs
+        if not hit:
+            self._docs[key] = model().load(id, force=True)
+        with EventModelCache._countLock:
+            if hit:
+                EventModelCache.hits += 1
+            else:
+                EventModelCache.misses += 1
+        doc = self._docs[key]
+        if doc is not None and level is not None:
+            self._requireAccess(model, doc, user, level)
+        return doc
+
+    def _requireAccess(self, model, doc, user, level):
+        # Items and files don't have their own access lists; their access
+        # comes from the folder containing them.
+        if model is File and doc.get('itemId'):
+            self.load(Item, doc['itemId'], user, level)
+        elif model is Item:
+            self.load(Folder, doc['folderId'], user, level)
+        else:
+            model().requireAccess(doc, user, level)
+
+    @classmethod
+    def counts(cls):
+        """
+        Report how effective the cache has been.
+
+        :returns: a dictionary with the total number of hits and misses.
+        """
+        with cls._countLock:
+            return {'hits': cls.hits, 'misses': cls.misses}
+
+
+_eventModelCaches = threading.local()
+
+
+def _eventModelCache(event):
+    """
+    Get the document cache for an event.  Handlers for the same event share a
+    cache; since events are handled one at a time on a thread, only the cache
+    for the latest event is kept.
+
+    :param event: the event being handled.
+    :returns: an EventModelCache.
+    """
+    if getattr(_eventModelCaches, 'info', None) is not event.info:
+        _eventModelCaches.info = event.info
+        _eventModelCaches.cache = EventModelCache()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Event model cache totals: %r', EventModelCache.counts())
+    return _eventModelCaches.cache
+
+
+def _itemFromEvent(event, identifierEnding, itemAccessLevel=AccessType.READ):  # noqa
+    """
+    If an event has a reference and an associated identifier that ends with a
+    specific string, return the associated item, user, and image file.
+
+    :param event: the data.process event.
+    :param identifierEnding: the required end of the identifier.
+    :returns: a dictionary with item, user, and file if there was a match.
+    """
+    reference, identifier = _referenceFromEvent(event)
     if identifier is not None and identifier.endswith(identifierEnding):
         if 'itemId' not in reference and 'fileId' not in reference:
             logger.error('Reference does not contain at least one of itemId or fileId.')
             return
+        cache = _eventModelCache(event)
         userId = reference.get('userId')
         if not userId:
             if 'itemId' in reference:
-                item = Item().load(reference['itemId'], force=True)
+                item = cache.load(Item, reference['itemId'])
             else:
-                file = File().load(reference['fileId'], force=True)
-                item = Item().load(file['itemId'], force=True)
+                file = cache.load(File, reference['fileId'])
+                item = cache.load(Item, file['itemId'])
             if 'folderId' not in item:
                 logger.error('Reference does not contain userId.')
                 return
-            folder = Folder().load(item['folderId'], force=True)
+            folder = cache.load(Folder, item['folderId'])
             userId = folder['creatorId']
-        user = User().load(userId, force=True)
+        user = cache.load(User, userId)
         imageId = reference.get('fileId')
         if not imageId:
-            item = Item().load(reference['itemId'], force=True)
+            item = cache.load(Item, reference['itemId'])
             if 'largeImage' in item and 'fileId' in item['largeImage']:
                 imageId = item['largeImage']['fileId']
-        image = File().load(imageId, level=AccessType.READ, user=user)
-        item = Item().load(image['itemId'], level=itemAccessLevel, user=user)
+        image = cache.load(File, imageId, user=user, level=AccessType.READ)
+        item = cache.load(Item, image['itemId'], user=user, level=itemAccessLevel)
         return {'item': item, 'user': user, 'file': image, 'uuid': reference.get('uuid')}
 
 
-def resolveAnnotationGirderIds(event, results, data, possibleGirderIds):
+def _promoteImageItem(itemId):
+    """
+    Ask if an item can be a large image, in case it is a small image.
+
+    :param itemId: the id of the item.
+    """
+    from girder_large_image.models.image_item import ImageItem
+
+    try:
+        item = ImageItem().load(itemId, force=True)
+        ImageItem().createImageItem(
+            item, list(ImageItem().childFiles(item=item, limit=1))[0], createJob=False)
+    except Exception:
+        pass
+
+
+def resolveAnnotationGirderIds(event, results, data, possibleGirderIds, reprocess=None):
     """
     If an annotation has references to girderIds, resolve them to actual ids.
 
@@ -88,64 +207,168 @@ def resolveAnnotationGirderIds(event, results, data, possibleGirderIds):
     :param data: annotation data.
     :param possibleGirderIds: a list of annotation elements with girderIds
         needing resolution.
+    :param reprocess: a request to ingest the annotation again once all
+        referenced files are available.  This is usually the keyword arguments
+        of the ingest job.  If None, ingest can't be deferred.
     :returns: True if all ids were processed.
     """
-    # Exclude actual girderIds from resolution
-    girderIds = []
-    for element in possibleGirderIds:
-        # This will throw an exception if the girderId isn't well-formed as an
-        # actual id.
+    # Exclude actual girderIds from resolution.  The distinct candidates are
+    # checked with a single query.
+    candidates = {element['girderId'] for element in possibleGirderIds}
+    objectIds = {}
+    for girderId in candidates:
         try:
-            if Item().load(element['girderId'], level=AccessType.READ, force=True) is None:
-                girderIds.append(element)
+            objectIds[ObjectId(girderId)] = girderId
         except Exception:
-            girderIds.append(element)
-    if not len(girderIds):
+            pass
+    existing = {objectIds[doc['_id']] for doc in Item().collection.find(
+        {'_id': {'$in': list(objectIds)}}, {'_id': True})} if objectIds else set()
+    unresolved = candidates - existing
+    if not len(unresolved):
+        return True
+    uuid = results.get('uuid')
+    registry = identifiers.getIdentifierRegistry()
+    idRecord = registry.lookup(uuid, unresolved) if uuid is not None else None
+    if idRecord is not None and len(idRecord) < len(unresolved):
+        if reprocess is None:
+            logger.warning('Cannot defer resolving girderId references')
+            return False
+        if registry.defer(uuid, unresolved, reprocess):
+            return False
+        idRecord = registry.lookup(uuid, unresolved)
+    if not idRecord:
+        msg = 'Could not resolve girderId references in annotation file'
+        raise Exception(msg)
+    resolved = {
+        girderId: str(idRecord[girderId]['file']['itemId']) for girderId in unresolved}
+    for element in possibleGirderIds:
+        element['girderId'] = resolved.get(element['girderId'], element['girderId'])
+    # Currently, all girderIds inside annotations are expected to be large
+    # images.  In this case, load them and ask if they can be so, in case they
+    # are small images
+    itemIds = set(resolved.values())
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(len(itemIds), large_image.config.cpu_count())) as pool:
+        list(pool.map(_promoteImageItem, itemIds))
+    return True
+
+
+def _streamAnnotationMinSize():
+    """
+    Get the minimum size of annotation file that is ingested incrementally.
+
+    :returns: a size in bytes or None if files are never streamed.
+    """
+    minSize = getPluginConfig('annotation_stream_min_size', 16 * 1024 ** 2)
+    return None if minSize is False else int(minSize)
+
+
+def _maxAnnotationFileLength():
+    """
+    Get the maximum size of annotation file that will be ingested.  For
+    compressed files, this applies to the decompressed size.
+
+    :returns: a size in bytes.
+    """
+    return int(large_image.config.getConfig('max_annotation_input_file_length', 1024 ** 3))
+
+
+def _isCompressedFile(file):
+    """
+    Check if a file is gzip or zstd compressed.
+
+    :param file: a Girder file document.
+    :returns: True if the file is compressed.
+    """
+    with File().open(file) as fptr:
+        return ingest.fileCompression(fptr) is not None
+
+
+def _streamAnnotationFile(results, file, reprocess, progress):
+    """
+    Ingest an annotation file incrementally if it is large enough and contains
+    large_image annotations rather than GeoJSON.  Since the decompressed size
+    of compressed files isn't known in advance, they are always streamed if
+    streaming is enabled.
+
+    :param results: the results from _itemFromEvent.
+    :param file: the annotation file.
+    :param reprocess: a request to ingest the file again once referenced
+        files are available.
+    :param progress: a function to report progress or None.
+    :returns: None if the file was not streamed, False if ingest was deferred
+        until more files have been uploaded, or a list of the created
+        annotations if it was ingested.
+    """
+    minSize = _streamAnnotationMinSize()
+    if minSize is None or (file['size'] < minSize and not _isCompressedFile(file)):
+        return None
+
+    def prepareElements(elements):
+        if 'uuid' in results:
+            girderIds = [element for element in elements if 'girderId' in element]
+            if len(girderIds):
+                return resolveAnnotationGirderIds(
+                    None, results, None, girderIds, reprocess=reprocess)
         return True
-    idRecord = _recentIdentifiers.get(results.get('uuid'))
-    if idRecord and not all(element['girderId'] in idRecord for element in girderIds):
-        idRecord['_reprocess'] = lambda: process_annotations(event)
-        return False
-    for element in girderIds:
-        element['girderId'] = str(idRecord[element['girderId']]['file']['itemId'])
-        # Currently, all girderIds inside annotations are expected to be
-        # large images.  In this case, load them and ask if they can be so,
-        # in case they are small images
-        from girder_large_image.models.image_item import ImageItem
 
+    try:
+        with ingest.openAnnotationFile(file, _maxAnnotationFileLength()) as fptr:
+            annotations = ingest.ingestAnnotationStream(
+                results['item'], results['user'], fptr, prepareElements=prepareElements,
+                size=file['size'], progress=progress)
+    except ingest.NotAnnotationStream:
+        return None
+    except ingest.IngestCanceled:
+        raise
+    except Exception:
+        logger.error('Could not create annotation objects from streamed data')
+        raise
+    return annotations if annotations is not None else False
+
+
+def _ingestColumnarFile(results, file, progress):
+    """
+    Ingest an annotation file if it is in the binary columnar format.
+
+    :param results: the results from _itemFromEvent.
+    :param file: the annotation file.
+    :param progress: a function to report progress or None.
+    :returns: None if it is not a columnar file or a list of the created
+        annotations.
+    """
+    with File().open(file) as fptr:
+        if not columnar.isColumnarFile(fptr):
+            return None
         try:
-            item = ImageItem().load(element['girderId'], force=True)
-            ImageItem().createImageItem(
-                item, list(ImageItem().childFiles(item=item, limit=1))[0], createJob=False)
+            annotation = columnar.ingestColumnarAnnotation(
+                results['item'], results['user'], fptr, progress=progress)
+        except ingest.IngestCanceled:
+            raise
         except Exception:
-            pass
-    return True
+            logger.error('Could not create annotation object from columnar data')
+            raise
+    return [annotation]
 
 
-def process_annotations(event):  # noqa
-    """Add annotations to an image on a ``data.process`` event"""
-    results = _itemFromEvent(event, 'AnnotationFile')
-    if not results:
-        return
+def _ingestAnnotationJSON(results, file, reprocess, progress):  # noqa
+    """
+    Read an annotation file into memory and add its annotations to an image.
+
+    :param results: the results from _itemFromEvent.
+    :param file: the annotation file.
+    :param reprocess: a request to ingest the file again once referenced
+        files are available.
+    :param progress: a function to report progress or None.
+    :returns: False if ingest was deferred until more files have been
+        uploaded, or a list of the created annotations.
+    """
     item = results['item']
     user = results['user']
-
-    file = File().load(
-        event.info.get('file', {}).get('_id'),
-        level=AccessType.READ, user=user,
-    )
     startTime = time.time()
-
-    if not file:
-        logger.error('Could not load models from the database')
-        return
     try:
-        if file['size'] > int(large_image.config.getConfig(
-                'max_annotation_input_file_length', 1024 ** 3)):
-            msg = 'File is larger than will be read into memory.'
-            raise Exception(msg)
         data = []
-        with File().open(file) as fptr:
+        with ingest.openAnnotationFile(file, _maxAnnotationFileLength()) as fptr:
             while True:
                 chunk = fptr.read(1024 ** 2)
                 if not len(chunk):
@@ -160,30 +383,284 @@ def process_annotations(event):  # noqa
 
     if not isinstance(data, list) or (
             hasattr(girder_large_image_annotation.utils, 'isGeoJSON') and
-            girder_large_image_annotation.utilsisGeoJSON(data)):
+            girder_large_image_annotation.utils.isGeoJSON(data)):
         data = [data]
-    # Check some of the early elements to see if there are any girderIds
-    # that need resolution.
+    # Check if there are any girderIds that need resolution.
     if 'uuid' in results:
         girderIds = [
             element for annotation in data
-            for element in annotation.get('elements', [])[:100]
+            for element in annotation.get('elements', [])
             if 'girderId' in element]
         if len(girderIds):
-            if not resolveAnnotationGirderIds(event, results, data, girderIds):
-                return
-    for annotation in data:
+            if not resolveAnnotationGirderIds(
+                    None, results, data, girderIds, reprocess=reprocess):
+                return False
+    ingestTime = time.time()
+    elementCount = sum(len(annotation.get('elements') or []) for annotation in data)
+    created = []
+    if len(data) > 1 and not any(
+            girder_large_image_annotation.utils.isGeoJSON(annotation)
+            for annotation in data):
         try:
-            Annotation().createAnnotation(item, user, annotation)
+            created = ingest.bulkCreateAnnotations(item, user, data, progress=progress)
+        except ingest.IngestCanceled:
+            raise
         except Exception:
-            logger.error('Could not create annotation object from data')
+            logger.error('Could not create annotation objects from data')
             raise
+    else:
+        stored = 0
+        for annotation in data:
+            try:
+                count = len(annotation.get('elements') or [])
+                created.append(Annotation().createAnnotation(item, user, annotation))
+            except Exception:
+                logger.error('Could not create annotation object from data')
+                raise
+            stored += count
+            if progress:
+                progress(stored, elementCount)
+    ingestTime = time.time() - ingestTime
+    logger.info('Ingested %d element(s) in %d annotation(s) in %5.3fs (%d elements/s)',
+                elementCount, len(data), ingestTime, elementCount / max(ingestTime, 1e-3))
+    return created
+
+
+def _previousAnnotationFile(item, digest):
+    """
+    Find the record of an identical annotation file that was previously
+    ingested for an item and whose annotations still exist.
+
+    :param item: the item the annotations are for.
+    :param digest: the content hash of the annotation file.
+    :returns: the IngestedAnnotationFile record or None.
+    """
+    for record in IngestedAnnotationFile().find({'itemId': item['_id'], 'hash': digest}):
+        ids = record.get('annotationIds') or []
+        if ids and Annotation().collection.count_documents(
+                {'_id': {'$in': ids}, '_active': {'$ne': False}}) == len(ids):
+            return record
+    return None
+
+
+def _replaceAnnotations(previousIds, created):
+    """
+    Move the content of newly created annotations into the annotations from
+    an identical earlier file, so that the earlier annotations keep their ids
+    and references to them still work.  The new elements are reassigned to
+    the earlier annotations, the earlier elements are removed (or kept as
+    history if annotation history is enabled), and the new annotation
+    documents are deleted.
+
+    :param previousIds: the ids of the earlier annotations, in order.
+    :param created: the newly created annotations, in the same order.
+    :returns: the updated earlier annotation documents, without elements.
+    """
+    previous = {doc['_id']: doc for doc in Annotation().collection.find(
+        {'_id': {'$in': previousIds}})}
+    if len(created) != len(previousIds) or len(previous) != len(previousIds):
+        # The files are identical, so this only happens if annotations were
+        # changed since; replace them as a whole instead.
+        for annotation in previous.values():
+            Annotation().remove(annotation)
+        return created
+    now = datetime.datetime.now(datetime.timezone.utc)
+    replaced = []
+    for oldId, new in zip(previousIds, created):
+        old = previous[oldId]
+        new = Annotation().collection.find_one({'_id': new['_id']})
+        if Annotation()._historyEnabled:
+            history = dict(old, _annotationId=old['_id'], _active=False)
+            history.pop('_id')
+            Annotation().collection.insert_one(history)
+        Annotationelement().collection.update_many(
+            {'annotationId': new['_id']}, {'$set': {'annotationId': oldId}})
+        update = {key: new[key] for key in (
+            'annotation', '_version', '_elementCount', '_detailsCount') if key in new}
+        update.update({'updated': now, 'updatedId': new['creatorId']})
+        Annotation().collection.update_one({'_id': oldId}, {'$set': update})
+        if not Annotation()._historyEnabled:
+            Annotationelement().removeOldElements(
+                {'_id': oldId, '_version': new['_version']}, old.get('_version'))
+        Annotation().collection.delete_one({'_id': new['_id']})
+        old.update(update)
+        replaced.append(old)
+        Notification().createNotification(
+            type='large_image_annotation.update',
+            data={'_id': oldId, 'itemId': old['itemId']},
+            user=User().load(old['creatorId'], force=True),
+            expires=now + datetime.timedelta(seconds=1))
+    return replaced
+
+
+def _recordAnnotationFile(item, file, digest, created, previous):
+    """
+    Record the annotations created from an annotation file, replacing those
+    from an identical earlier file in place.
+
+    :param item: the item the annotations are for.
+    :param file: the annotation file.
+    :param digest: the content hash of the file or None if it is not tracked.
+    :param created: a list of the created annotations.
+    :param previous: the record of an identical earlier file or None.
+    """
+    if previous is not None:
+        created = _replaceAnnotations(previous['annotationIds'], created)
+        IngestedAnnotationFile().remove(previous)
+    if digest is not None:
+        IngestedAnnotationFile().save({
+            'itemId': item['_id'],
+            'hash': digest,
+            'fileId': file['_id'],
+            'annotationIds': [annotation['_id'] for annotation in created],
+            'created': datetime.datetime.now(datetime.timezone.utc),
+        })
+
+
+def ingest_annotation_file(results, file, reprocess=None, progress=None):
+    """
+    Add annotations from a file to an image.  If an identical file was
+    already ingested for the same image and its annotations still exist, the
+    file is skipped, or, if the annotation_duplicates config value is
+    "replace", the earlier annotations are replaced in place.
+
+    :param results: the results from _itemFromEvent.
+    :param file: the annotation file.
+    :param reprocess: a request to ingest the file again once referenced
+        files are available.  See resolveAnnotationGirderIds.
+    :param progress: if not None, a function that is called with the number
+        of elements stored and the expected number of elements.
+    """
+    item = results['item']
+    if file['size'] > _maxAnnotationFileLength():
+        logger.error('Could not parse annotation file')
+        msg = 'File is larger than will be read into memory.'
+        raise Exception(msg)
+    duplicates = getPluginConfig('annotation_duplicates', 'skip')
+    digest = previous = None
+    if duplicates in {'skip', 'replace'}:
+        digest = ingest.fileHash(file)
+        previous = _previousAnnotationFile(item, digest)
+    if previous is not None and duplicates == 'skip':
+        logger.info('Skipping annotation file %s; it was already ingested for item %s',
+                    file['name'], item['_id'])
+    else:
+        created = _ingestColumnarFile(results, file, progress)
+        if created is None:
+            created = _streamAnnotationFile(results, file, reprocess, progress)
+        if created is None:
+            created = _ingestAnnotationJSON(results, file, reprocess, progress)
+        if created is False:
+            return
+        _recordAnnotationFile(item, file, digest, created, previous)
     if Setting().get(PluginSettings.HUI_DELETE_ANNOTATIONS_AFTER_INGEST):
         item = Item().load(file['itemId'], force=True)
         if item and len(list(Item().childFiles(item, limit=2))) == 1:
             Item().remove(item)
 
 
+def _scheduleIngest(kind, results, file):
+    """
+    Queue a job to ingest an uploaded file.
+
+    :param kind: one of 'annotations', 'metadata', or 'metadata_table'.
+    :param results: the results from _itemFromEvent.  For metadata tables,
+        this also contains the folder that the table refers to.
+    :param file: the uploaded file.
+    :returns: the job document.
+    """
+    charge = file['size']
+    minSize = _streamAnnotationMinSize()
+    if kind == 'annotations' and minSize is not None and (
+            file['size'] >= minSize or _isCompressedFile(file)):
+        charge = minSize
+    kwargs = {
+        'kind': kind,
+        'fileId': str(file['_id']),
+        'itemId': str(results['item']['_id']),
+        'userId': str(results['user']['_id']),
+        'uuid': results.get('uuid'),
+    }
+    if 'folder' in results:
+        kwargs['folderId'] = str(results['folder']['_id'])
+    return ingest.scheduleIngestJob(
+        title='Ingest %s from %s' % (kind.replace('_', ' '), file['name']),
+        user=results['user'],
+        kwargs=kwargs,
+        charge=charge,
+        module='histomicsui.handlers',
+        function='ingest_job',
+    )
+
+
+def _reprocessIngest(pending):
+    """
+    Act on a pending reprocess request from the identifier registry.
+
+    :param pending: either the keyword arguments of an ingest job or a
+        function to call.
+    """
+    if callable(pending):
+        pending()
+        return
+    user = User().load(pending['userId'], force=True)
+    item = Item().load(pending['itemId'], force=True)
+    file = File().load(pending['fileId'], force=True)
+    if not user or not item or not file:
+        logger.warning('Could not reprocess %s; models no longer exist', pending['kind'])
+        return
+    results = {'item': item, 'user': user, 'uuid': pending.get('uuid')}
+    if pending.get('folderId'):
+        results['folder'] = Folder().load(pending['folderId'], force=True)
+    _scheduleIngest(pending['kind'], results, file)
+
+
+def ingest_job(job):
+    """
+    Run an ingest job created by _scheduleIngest.
+
+    :param job: the job document.
+    """
+    kwargs = job['kwargs']
+    user = User().load(kwargs['userId'], force=True)
+    item = Item().load(kwargs['itemId'], force=True)
+    file = File().load(kwargs['fileId'], force=True)
+    if not user or not item or not file:
+        msg = 'Could not load models from the database'
+        raise Exception(msg)
+    results = {'item': item, 'user': user, 'uuid': kwargs.get('uuid')}
+    if kwargs['kind'] == 'metadata':
+        ingest_metadata_file(results, file)
+        return
+    if kwargs['kind'] == 'metadata_table':
+        folder = Folder().load(kwargs['folderId'], force=True)
+        if not folder:
+            msg = 'Could not load models from the database'
+            raise Exception(msg)
+        results['folder'] = folder
+        ingest_metadata_table(
+            results, file, job=job, progress=ingest.jobProgress(job, unit='items'))
+        return
+    ingest_annotation_file(
+        results, file,
+        reprocess=dict(kwargs),
+        progress=ingest.jobProgress(job))
+
+
+def process_annotations(event):
+    """Add annotations to an image on a ``data.process`` event"""
+    results = _itemFromEvent(event, 'AnnotationFile')
+    if not results:
+        return
+    file = _eventModelCache(event).load(
+        File, event.info.get('file', {}).get('_id'),
+        user=results['user'], level=AccessType.READ)
+    if not file:
+        logger.error('Could not load models from the database')
+        return
+    _scheduleIngest('annotations', results, file)
+
+
 def quarantine_item(item, user, makePlaceholder=True):
     """
     Quarantine an item, marking which user did it.  Note that this raises
@@ -263,56 +740,172 @@ def restore_quarantine_item(item, user):
     return item
 
 
+def ingest_metadata_file(results, file):
+    """
+    Add metadata from a file to an item.
+
+    :param results: the results from _itemFromEvent.
+    :param file: the metadata file.
+    """
+    try:
+        with File().open(file) as fptr:
+            data = orjson.loads(fptr.read())
+    except Exception:
+        logger.error('Could not parse metadata file')
+        raise
+
+    item = results['item']
+    Item().setMetadata(item, data, allowNull=False)
+
+
 def process_metadata(event):
     """Add metadata to an item on a ``data.process`` event"""
     results = _itemFromEvent(event, 'ItemMetadata', AccessType.WRITE)
     if not results:
         return
-    file = File().load(
-        event.info.get('file', {}).get('_id'),
-        level=AccessType.READ, user=results['user'],
-    )
+    file = _eventModelCache(event).load(
+        File, event.info.get('file', {}).get('_id'),
+        user=results['user'], level=AccessType.READ)
 
     if not file:
         logger.error('Could not load models from the database')
         return
+    _scheduleIngest('metadata', results, file)
+
+
+def ingest_metadata_table(results, file, job=None, progress=None):
+    """
+    Add metadata from a table to the items it refers to.
+
+    :param results: a dictionary with the user doing the ingest and the
+        folder that relative paths and names in the table refer to.
+    :param file: the table file.
+    :param job: if not None, a job to log unmatched rows to.
+    :param progress: if not None, a function that is called with the number
+        of items updated and the number of items to update.
+    :returns: a tuple of the number of items updated and a list of keys of
+        rows that did not match an item or descriptions of invalid rows.
+    """
+    startTime = time.time()
     try:
-        data = orjson.loads(File().open(file).read().decode())
+        with File().open(file) as fptr:
+            rows = list(ingest.iterMetadataTable(fptr, file['name']))
     except Exception:
-        logger.error('Could not parse metadata file')
+        logger.error('Could not parse metadata table')
         raise
-
-    item = results['item']
-    Item().setMetadata(item, data, allowNull=False)
+    updated, unmatched = ingest.bulkSetMetadata(
+        results['folder'], results['user'], rows, progress=progress)
+    logger.info('Set metadata on %d item(s) from %d row(s) in %5.3fs',
+                updated, len(rows), time.time() - startTime)
+    if unmatched:
+        logger.warning('%d row(s) of %s did not match an item or were invalid',
+                       len(unmatched), file['name'])
+        if job is not None:
+            Job().updateJob(job, log='%d row(s) did not match an item or were invalid:\n%s\n' % (
+                len(unmatched), '\n'.join(unmatched)))
+    return updated, unmatched
+
+
+def process_metadata_table(event):
+    """
+    Add metadata to many items from a table on a ``data.process`` event.  The
+    reference identifier must end with ``ItemMetadataTable``.  Table rows
+    refer to items relative to the folder given by the reference's
+    ``folderId`` or, if that is not specified, the folder containing the
+    uploaded table.
+    """
+    reference, identifier = _referenceFromEvent(event, record=False)
+    if identifier is None or not identifier.endswith('ItemMetadataTable'):
+        return
+    cache = _eventModelCache(event)
+    file = cache.load(File, event.info.get('file', {}).get('_id'))
+    item = cache.load(Item, file['itemId']) if file else None
+    folder = None
+    if item:
+        folder = cache.load(Folder, reference.get('folderId') or item['folderId'])
+    if not folder:
+        logger.error('Could not load models from the database')
+        return
+    userId = reference.get('userId') or (
+        (event.info.get('currentUser') or {}).get('_id') or folder['creatorId'])
+    user = cache.load(User, userId)
+    if not user or not Folder().hasAccess(folder, user, AccessType.READ):
+        logger.error('Could not load models from the database')
+        return
+    _scheduleIngest('metadata_table', {
+        'item': item, 'user': user, 'folder': folder, 'uuid': reference.get('uuid')}, file)
 
 
 def nan2None(obj):
     """
-    Convert NaN and +/-Infitity to None.
+    Convert NaN and +/-Infitity to None.  Containers are only copied if they
+    contain a value that is converted, so this is inexpensive when there is
+    nothing to convert.
     """
     if isinstance(obj, dict):
-        return {k: nan2None(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [nan2None(v) for v in obj]
-    elif isinstance(obj, float) and (
-            math.isnan(obj) or obj == float('inf') or obj == -float('inf')):
-        print('Nan')
+        result = None
+        for k, v in obj.items():
+            value = nan2None(v)
+            if value is not v:
+                if result is None:
+                    result = dict(obj)
+                result[k] = value
+        return obj if result is None else result
+    elif isinstance(obj, (list, tuple)):
+        result = None
+        for idx, v in enumerate(obj):
+            value = nan2None(v)
+            if value is not v:
+                if result is None:
+                    result = list(obj)
+                result[idx] = value
+        return obj if result is None else result
+    elif isinstance(obj, float) and not math.isfinite(obj):
         return None
     return obj
 
 
+def orjsonEncode(encoder, obj):
+    """
+    Encode an object with orjson, honoring the sort_keys option of a
+    json.JSONEncoder.  NaN and +/-Infinity are encoded as null, and values
+    orjson can't serialize natively, including datetimes, are passed to the
+    encoder's default method.
+
+    :param encoder: a json.JSONEncoder instance.
+    :param obj: the object to encode.
+    :returns: a JSON string.
+    :raises orjson.JSONEncodeError: if orjson can't encode the object.
+    """
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+    if encoder.sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    return orjson.dumps(obj, default=encoder.default, option=option).decode()
+
+
 def json_nans_as_nulls():
     """
-    Convert NaN and +/-Infinity to nulls so that they will serialize
+    Encode REST responses with orjson, which converts NaN and +/-Infinity to
+    nulls so that they will serialize.  The standard library encoder is only
+    used for indented output and for values orjson can't encode, such as
+    integers larger than 64 bits.
     """
 
     def encode(self, obj, *args, **kwargs):
-        obj = nan2None(obj)
-        return json.JSONEncoder.encode(self, obj, *args, **kwargs)
+        if not self.indent:
+            try:
+                return orjsonEncode(self, obj)
+            except orjson.JSONEncodeError:
+                pass
+        return ''.join(json.JSONEncoder.iterencode(self, nan2None(obj), _one_shot=True))
 
     def iterencode(self, obj, *args, **kwargs):
-        obj = nan2None(obj)
-        return json.JSONEncoder.iterencode(self, obj, *args, **kwargs)
+        if not self.indent:
+            try:
+                return iter((orjsonEncode(self, obj), ))
+            except orjson.JSONEncodeError:
+                pass
+        return json.JSONEncoder.iterencode(self, nan2None(obj), *args, **kwargs)
 
     girder.utility.JsonEncoder.encode = encode
     girder.utility.JsonEncoder.iterencode = iterencode
@@ -321,7 +914,10 @@ def json_nans_as_nulls():
 def shortLoginSessions():
     import girder.api.rest
 
-    _recentTokens = {}
+    sessionExtender.settingChanged()
+    for eventName in ('model.setting.save.after', 'model.setting.remove'):
+        events.bind(eventName, 'histomicsui.sessions', sessionExtender.settingChanged)
+    cherrypy.engine.subscribe('stop', sessionExtender.flush)
 
     origGetCurrentUser = girder.api.rest.getCurrentUser
 
@@ -336,19 +932,10 @@ def shortLoginSessions():
         if user:
             token = girder.api.rest.getCurrentToken()
         if user and token:
-            if token['_id'] not in _recentTokens or time.time() - _recentTokens[token['_id']] > 60:
-                if Setting().get(PluginSettings.HUI_LOGIN_SESSION_EXPIRY_MINUTES):
-                    days = float(Setting().get(
-                        PluginSettings.HUI_LOGIN_SESSION_EXPIRY_MINUTES)) / 24 / 60
-                    token['expires'] = datetime.datetime.utcnow() + datetime.timedelta(
-                        days=float(days))
-                    token = Token().save(token)
-                    logger.debug(
-                        'Extend user login duration '
-                        f'(user {user["_id"]}, token {token["_id"][:16]}...)')
-            if len(_recentTokens) > 100:
-                _recentTokens.clear()
-            _recentTokens[token['_id']] = time.time()
+            if sessionExtender.extend(token):
+                logger.debug(
+                    'Extend user login duration '
+                    f'(user {user["_id"]}, token {token["_id"][:16]}...)')
         return result
 
     girder.api.rest.getCurrentUser = getCurrentUser
@@ -356,8 +943,8 @@ def shortLoginSessions():
     origResourceSendAuthTokenCookie = girder.api.rest.Resource.sendAuthTokenCookie
 
     def sendAuthTokenCookie(self, user=None, scope=None, token=None, days=None):
-        if days is None and Setting().get(PluginSettings.HUI_LOGIN_SESSION_EXPIRY_MINUTES):
-            days = float(Setting().get(PluginSettings.HUI_LOGIN_SESSION_EXPIRY_MINUTES)) / 24 / 60
+        if days is None:
+            days = sessionExtender.expiryDays()
         return origResourceSendAuthTokenCookie(self, user, scope, token, days)
 
     girder.api.rest.Resource.sendAuthTokenCookie = origResourceSendAuthTokenCookie
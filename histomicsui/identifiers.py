@@ -0,0 +1,188 @@
+"""
+Registries of identifiers of recently processed uploads.
+
+When a set of files is uploaded with a shared batch uuid in their references
+(for instance, an annotation file and the images that it refers to), each file
+is recorded here under its identifier.  Annotation ingest uses this to resolve
+references to other files in the batch, and, if some of them haven't been
+processed yet, defers itself until they have.
+"""
+
+import datetime
+import threading
+
+import cachetools
+from girder import logger
+
+from .models.upload_identifier import IDENTIFIER_LIFETIME, UploadIdentifier
+from .plugin_config import getPluginConfig
+
+
+class MemoryIdentifierRegistry:
+    """
+    Keep identifiers in the memory of the current process.  This only works
+    if all of the files in a batch are processed by the same process.
+    """
+
+    def __init__(self, maxsize=10000, ttl=IDENTIFIER_LIFETIME):
+        """
+        :param maxsize: the maximum number of batch uuids to track.
+        :param ttl: how long to track a batch uuid, in seconds.
+        """
+        self._records = cachetools.TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def record(self, uuid, identifier, info):
+        """
+        Record an identifier for a batch.
+
+        :param uuid: the batch uuid.
+        :param identifier: the identifier of the processed file.
+        :param info: a dictionary with information about the file.  This
+            must contain a `file` dictionary with `_id` and `itemId`.
+        :returns: a list of pending reprocess requests for this batch.  The
+            caller is responsible for acting on these.
+        """
+        with self._lock:
+            record = self._remember(uuid, identifier, info)
+            pending, record['pending'] = record['pending'], []
+        return pending
+
+    def _remember(self, uuid, identifier, info):
+        """
+        Store an identifier in memory.  The lock must be held.
+
+        :returns: the in-memory record for the batch.
+        """
+        if uuid not in self._records:
+            self._records[uuid] = {'identifiers': {}, 'pending': []}
+        record = self._records[uuid]
+        record['identifiers'][identifier] = info
+        return record
+
+    def lookup(self, uuid, identifiers):
+        """
+        Get information about identifiers in a batch.
+
+        :param uuid: the batch uuid.
+        :param identifiers: an iterable of identifiers to look up.
+        :returns: None if nothing is known about the batch, otherwise a
+            dictionary of the identifiers that are known with their info.
+        """
+        with self._lock:
+            record = self._records.get(uuid)
+            if record is None:
+                return None
+            return {identifier: record['identifiers'][identifier]
+                    for identifier in identifiers if identifier in record['identifiers']}
+
+    def defer(self, uuid, identifiers, pending):
+        """
+        Request that something be reprocessed once the next identifier for a
+        batch is recorded.
+
+        :param uuid: the batch uuid.
+        :param identifiers: the identifiers that are needed.
+        :param pending: the reprocess request.
+        :returns: True if deferred, False if all of the identifiers are now
+            known and the request was not stored.
+        """
+        with self._lock:
+            record = self._records.setdefault(uuid, {'identifiers': {}, 'pending': []})
+            if all(identifier in record['identifiers'] for identifier in identifiers):
+                return False
+            record['pending'].append(pending)
+        return True
+
+
+class MongoIdentifierRegistry(MemoryIdentifierRegistry):
+    """
+    Keep identifiers in the database so that they are shared by all Girder
+    processes, using the memory of the current process as a fast path.
+    Pending reprocess requests are claimed atomically, so each is returned by
+    exactly one call to record.  Reprocess requests must be serializable.
+    """
+
+    def record(self, uuid, identifier, info):
+        super().record(uuid, identifier, info)
+        model = UploadIdentifier()
+        model.collection.update_one(
+            {'uuid': uuid, 'identifier': identifier},
+            {'$set': {'info': info, 'created': datetime.datetime.now(datetime.timezone.utc)}},
+            upsert=True)
+        pending = []
+        while True:
+            doc = model.collection.find_one_and_delete(
+                {'uuid': uuid, 'pending': {'$exists': True}})
+            if doc is None:
+                break
+            pending.append(doc['pending'])
+        return pending
+
+    def lookup(self, uuid, identifiers):
+        identifiers = set(identifiers)
+        found = super().lookup(uuid, identifiers)
+        if found is not None and len(found) == len(identifiers):
+            return found
+        found = found or {}
+        collection = UploadIdentifier().collection
+        for doc in collection.find({
+                'uuid': uuid, 'identifier': {'$in': list(identifiers - set(found))}}):
+            found[doc['identifier']] = doc['info']
+            with self._lock:
+                self._remember(uuid, doc['identifier'], doc['info'])
+        if not found and collection.find_one({'uuid': uuid}, {'_id': True}) is None:
+            return None
+        return found
+
+    def defer(self, uuid, identifiers, pending):
+        model = UploadIdentifier()
+        pendingId = model.collection.insert_one({
+            'uuid': uuid,
+            'pending': pending,
+            'created': datetime.datetime.now(datetime.timezone.utc),
+        }).inserted_id
+        # An identifier may have been recorded by another process between the
+        # caller's lookup and storing the request.  If everything is now
+        # known and the request hasn't been claimed, withdraw it.
+        if len(self.lookup(uuid, identifiers) or {}) == len(set(identifiers)):
+            if model.collection.delete_one({'_id': pendingId}).deleted_count:
+                return False
+        return True
+
+
+_registry = None
+
+
+def getIdentifierRegistry():
+    """
+    Get the identifier registry.  Unless one has been set, this is chosen by
+    the identifier_registry value in the histomicsui section of the Girder
+    config file, which can be "mongo" (the default) or "memory".
+
+    :returns: the identifier registry.
+    """
+    global _registry
+
+    if _registry is None:
+        kind = getPluginConfig('identifier_registry', 'mongo')
+        if kind == 'memory':
+            _registry = MemoryIdentifierRegistry()
+        else:
+            if kind != 'mongo':
+                logger.warning('Unknown identifier registry %r; using mongo', kind)
+            _registry = MongoIdentifierRegistry()
+    return _registry
+
+
+def setIdentifierRegistry(registry):
+    """
+    Use a specific identifier registry.  This must have the same methods as
+    MemoryIdentifierRegistry.
+
+    :param registry: the registry to use or None to use the configured
+        default.
+    """
+    global _registry
+
+    _registry = registry
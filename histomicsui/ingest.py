@@ -0,0 +1,1101 @@
+"""
+Helpers for ingesting large or numerous annotations and metadata efficiently.
+"""
+
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import csv
+import datetime
+import gzip
+import hashlib
+import itertools
+import math
+import os
+import socket
+import threading
+import time
+import uuid
+
+import ijson.common
+import orjson
+import pymongo
+from bson import ObjectId
+from girder import auditLogger, events, logger
+from girder.constants import AccessType
+from girder.exceptions import ValidationException
+from girder.models.file import File
+from girder.models.folder import Folder
+from girder.models.item import Item
+from girder.models.notification import Notification
+from girder_jobs.constants import JobStatus
+from girder_jobs.models.job import Job
+from girder_large_image_annotation.models.annotation import Annotation
+from girder_large_image_annotation.models.annotationelement import Annotationelement
+
+from .plugin_config import getPluginConfig
+
+# Keys that indicate that a top-level object is GeoJSON rather than a
+# large_image annotation.
+_geoJSONKeys = {'type', 'features', 'geometry'}
+
+
+class NotAnnotationStream(Exception):
+    """
+    Raised when a file can't be ingested as a stream of large_image
+    annotations (for instance, if it is GeoJSON).
+    """
+
+
+class IngestCanceled(Exception):
+    """Raised when the job performing an ingest has been canceled."""
+
+
+def fileCompression(fptr):
+    """
+    Determine if a file is compressed from its first bytes.  The file position
+    is restored.
+
+    :param fptr: a file-like object opened for binary reading.
+    :returns: 'gzip', 'zstd', or None if the file is not compressed.
+    """
+    position = fptr.tell()
+    header = fptr.read(4)
+    fptr.seek(position)
+    if header[:2] == b'\x1f\x8b':
+        return 'gzip'
+    if header == b'\x28\xb5\x2f\xfd':
+        return 'zstd'
+    return None
+
+
+def fileHash(file):
+    """
+    Compute the sha256 hash of the contents of a Girder file without reading
+    it all into memory.
+
+    :param file: the Girder file document.
+    :returns: the hex digest.
+    """
+    digest = hashlib.sha256()
+    with File().open(file) as fptr:
+        while True:
+            chunk = fptr.read(1024 ** 2)
+            if not len(chunk):
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DecompressingReader:
+    """
+    A read-only file-like object that decompresses gzip or zstd data from
+    another file-like object as it is read.  The decompressed size is
+    checked on every read, so data that expands beyond the limit is rejected
+    without decompressing all of it.
+    """
+
+    def __init__(self, fptr, compression, limit=None):
+        """
+        :param fptr: a file-like object with compressed data.
+        :param compression: 'gzip' or 'zstd'.
+        :param limit: the maximum decompressed size in bytes or None for no
+            limit.
+        """
+        self._source = fptr
+        self._limit = limit
+        self.decompressed = 0
+        if compression == 'gzip':
+            self._reader = gzip.GzipFile(fileobj=fptr, mode='rb')
+        else:
+            try:
+                import zstandard
+            except ImportError:
+                msg = 'The zstandard package is required to read zstd compressed files.'
+                raise ValidationException(msg)
+            self._reader = zstandard.ZstdDecompressor().stream_reader(
+                fptr, read_across_frames=True)
+
+    def read(self, size=-1):
+        """
+        Read decompressed data.
+
+        :param size: the maximum number of bytes to read.  If negative or
+            None, read to the end of the data.
+        :returns: decompressed bytes.
+        """
+        if size is None or size < 0:
+            chunks = []
+            while True:
+                chunk = self.read(1024 ** 2)
+                if not len(chunk):
+                    return b''.join(chunks)
+                chunks.append(chunk)
+        data = self._reader.read(size)
+        self.decompressed += len(data)
+        if self._limit is not None and self.decompressed > self._limit:
+            msg = 'Decompressed file is larger than %d bytes.' % self._limit
+            raise ValidationException(msg)
+        return data
+
+    def tell(self):
+        """
+        Report the position in the compressed data.  This can be compared to
+        the size of the compressed file to estimate progress.
+
+        :returns: the position in the source file.
+        """
+        return self._source.tell()
+
+
+@contextlib.contextmanager
+def openAnnotationFile(file, limit=None):
+    """
+    Open a Girder file for reading, transparently decompressing it if it is
+    gzip or zstd compressed.
+
+    :param file: the Girder file document.
+    :param limit: if the file is compressed, the maximum decompressed size in
+        bytes.
+    :yields: a file-like object opened for binary reading.
+    """
+    with File().open(file) as fptr:
+        compression = fileCompression(fptr)
+        if compression is None:
+            yield fptr
+        else:
+            yield DecompressingReader(fptr, compression, limit)
+
+
+def _buildValue(parser, event, value):
+    """
+    Consume the parser events for a single JSON value.
+
+    :param parser: an iterator of ijson (prefix, event, value) tuples.
+    :param event: the first event of the value.
+    :param value: the first value of the value.
+    :returns: the python object represented by the events.
+    """
+    if event not in {'start_map', 'start_array'}:
+        return value
+    builder = ijson.common.ObjectBuilder()
+    builder.event(event, value)
+    depth = 1
+    for _prefix, event, value in parser:
+        builder.event(event, value)
+        if event in {'start_map', 'start_array'}:
+            depth += 1
+        elif event in {'end_map', 'end_array'}:
+            depth -= 1
+            if not depth:
+                break
+    return builder.value
+
+
+def _iterAnnotationMap(parser):
+    """
+    Yield the parts of an annotation object whose start_map event has just
+    been consumed.  See iterAnnotationStream.
+    """
+    yield 'start', None
+    for _prefix, event, value in parser:
+        if event == 'end_map':
+            break
+        # event must be map_key
+        key = value
+        if key in _geoJSONKeys:
+            raise NotAnnotationStream
+        _prefix, event, value = next(parser)
+        if key == 'elements' and event == 'start_array':
+            for _prefix, event, value in parser:
+                if event == 'end_array':
+                    break
+                yield 'element', _buildValue(parser, event, value)
+        else:
+            yield 'property', (key, _buildValue(parser, event, value))
+    yield 'end', None
+
+
+def iterAnnotationStream(fptr):
+    """
+    Incrementally parse a file containing either a single annotation or a
+    list of annotations.  Only a single element is held in memory at a time.
+
+    :param fptr: a file-like object opened for binary reading.
+    :yields: a sequence of (kind, value) tuples.  For each annotation this is
+        ('start', None), then some number of ('property', (key, value)) and
+        ('element', element) tuples in the order they occur in the file, and
+        finally ('end', None).
+    """
+    parser = iter(ijson.parse(fptr, use_float=True))
+    _prefix, event, _value = next(parser)
+    if event == 'start_map':
+        yield from _iterAnnotationMap(parser)
+        return
+    if event != 'start_array':
+        raise NotAnnotationStream
+    for _prefix, event, _value in parser:
+        if event == 'end_array':
+            break
+        if event != 'start_map':
+            raise NotAnnotationStream
+        yield from _iterAnnotationMap(parser)
+
+
+class StreamedAnnotationWriter:
+    """
+    Create a single annotation and add its elements in batches.  The
+    annotation document is created without elements; each batch of elements is
+    validated and inserted as it is added.  Element ids are only checked for
+    uniqueness within a batch.
+    """
+
+    def __init__(self, item, user, properties):
+        """
+        :param item: the item the annotation is attached to.
+        :param user: the user creating the annotation.
+        :param properties: a dictionary of annotation properties other than
+            elements.
+        """
+        self.annotation = Annotation().createAnnotation(
+            item, user, dict(properties, elements=[]))
+        self.annotation['annotation'].pop('elements', None)
+        self.count = 0
+        self.details = 0
+        self._now = datetime.datetime.now(datetime.timezone.utc)
+        self._insertLock = threading.Lock()
+
+    def addElements(self, elements):
+        """
+        Validate and store a batch of elements.
+
+        :param elements: a list of annotation elements.  Modified.
+        """
+        if not len(elements):
+            return
+        Annotation().validate({'annotation': {'elements': elements}})
+        count, details = Annotationelement().updateElementChunk(
+            elements, 0, len(elements), self.annotation, self._now, self._insertLock)
+        self.count += count
+        self.details += details
+
+    def addEntries(self, entries):
+        """
+        Store a batch of element database entries whose elements have already
+        been validated and whose bounding boxes have been computed.
+
+        :param entries: a list of element entries with bbox and element
+            values.  Modified.
+        """
+        if not len(entries):
+            return
+        for entry in entries:
+            entry['annotationId'] = self.annotation['_id']
+            entry['_version'] = self.annotation['_version']
+            entry['created'] = self._now
+        if any(Annotationelement()._entryIsLarge(entry) for entry in entries):
+            Annotationelement().saveElementAsFile(self.annotation, entries)
+        with self._insertLock:
+            Annotationelement().collection.insert_many(entries, ordered=False)
+        self.count += len(entries)
+        self.details += sum(entry['bbox']['details'] for entry in entries)
+
+    def finish(self, properties):
+        """
+        Record the element counts and any annotation properties that were
+        encountered after the annotation was created.
+
+        :param properties: the complete dictionary of annotation properties
+            other than elements.
+        :returns: the annotation document without elements.
+        """
+        # The annotation was saved without elements, so its group set must be
+        # computed from the stored elements.
+        update = {
+            '_elementCount': self.count,
+            '_detailsCount': self.details,
+            'groups': Annotationelement().getElementGroupSet(self.annotation),
+        }
+        late = {k: v for k, v in properties.items()
+                if self.annotation['annotation'].get(k) != v}
+        if late:
+            Annotation().validate({'annotation': dict(late, elements=[])})
+            for key, value in late.items():
+                update['annotation.' + key] = value
+                self.annotation['annotation'][key] = value
+        Annotation().collection.update_one(
+            {'_id': self.annotation['_id']}, {'$set': update})
+        self.annotation.update({k: v for k, v in update.items() if '.' not in k})
+        return self.annotation
+
+    def discard(self):
+        """Remove the annotation and any elements that have been stored."""
+        Annotation().remove(self.annotation)
+
+
+def ingestAnnotationStream(item, user, fptr, batchSize=None, prepareElements=None,
+                           size=None, progress=None):
+    """
+    Ingest annotations from a file without reading it into memory.  Elements
+    are parsed incrementally and stored in batches, so peak memory depends on
+    the batch size rather than the file size.
+
+    :param item: the item to add annotations to.
+    :param user: the user creating the annotations.
+    :param fptr: a file-like object opened for binary reading.
+    :param batchSize: the number of elements to store at a time.  If None,
+        this is read from the config file.
+    :param prepareElements: if not None, a function that is called with each
+        batch of elements before it is stored.  It may modify the elements.
+        If it returns False, ingest stops, anything already stored is removed,
+        and None is returned.
+    :param size: the size of the file in bytes, used to estimate the total
+        number of elements for progress reporting.
+    :param progress: if not None, a function that is called with the number
+        of elements stored and the estimated total number of elements after
+        each batch.  If it raises an exception, anything already stored is
+        removed.
+    :returns: a list of created annotation documents without elements, or
+        None if ingest was stopped.
+    """
+    batchSize = max(1, int(batchSize or getPluginConfig('annotation_batch_size', 10000)))
+    startTime = lastTime = time.time()
+    created = []
+    writer = None
+    total = 0
+    try:
+        for kind, value in iterAnnotationStream(fptr):
+            if kind == 'start':
+                properties, batch, writer = {}, [], None
+            elif kind == 'property':
+                properties[value[0]] = value[1]
+            elif kind == 'element':
+                batch.append(value)
+                if len(batch) >= batchSize:
+                    if prepareElements and prepareElements(batch) is False:
+                        return None
+                    if writer is None:
+                        writer = StreamedAnnotationWriter(item, user, properties)
+                        created.append(writer)
+                    writer.addElements(batch)
+                    total += len(batch)
+                    batch = []
+                    if progress:
+                        position = fptr.tell() if size else 0
+                        progress(total, max(total, int(total * size / position))
+                                 if position else total)
+                    if time.time() - lastTime > 10:
+                        logger.info('Ingested %d elements in %5.3fs',
+                                    total, time.time() - startTime)
+                        lastTime = time.time()
+            elif kind == 'end':
+                if batch and prepareElements and prepareElements(batch) is False:
+                    return None
+                if writer is None:
+                    writer = StreamedAnnotationWriter(item, user, properties)
+                    created.append(writer)
+                writer.addElements(batch)
+                total += len(batch)
+                writer.finish(properties)
+        ingestTime = time.time() - startTime
+        logger.info('Ingested %d element(s) in %d annotation(s) in %5.3fs (%d elements/s)',
+                    total, len(created), ingestTime, total / max(ingestTime, 1e-3))
+        result = [entry.annotation for entry in created]
+        created = []
+        return result
+    finally:
+        for entry in created:
+            entry.discard()
+
+
+def _annotationTemplate(item, user, now):
+    """
+    Create the common parts of new annotation documents for an item, including
+    the access control copied from the item's folder, as createAnnotation
+    does.
+
+    :param item: the item the annotations are attached to.
+    :param user: the user creating the annotations.
+    :param now: the creation time.
+    :returns: a partial annotation document.
+    """
+    template = {
+        'itemId': item['_id'],
+        'creatorId': user['_id'],
+        'created': now,
+        'updatedId': user['_id'],
+        'updated': now,
+    }
+    folder = Folder().load(item['folderId'], force=True)
+    Annotation().copyAccessPolicies(src=folder, dest=template, save=False)
+    Annotation().setPublic(template, folder.get('public', False), save=False)
+    Annotation().setUserAccess(template, user=user, level=AccessType.ADMIN, save=False)
+    return template
+
+
+def _elementEntries(doc, now):
+    """
+    Remove the elements from an annotation document and return the element
+    database entries for them.  Elements with large arrays are stored as
+    files.
+
+    :param doc: an annotation document with an _id and _version.  Modified.
+    :param now: the creation time for the entries.
+    :returns: a list of element entries.
+    """
+    elements = doc['annotation'].pop('elements', None) or []
+    entries = [{
+        'annotationId': doc['_id'],
+        '_version': doc['_version'],
+        'created': now,
+        'bbox': Annotationelement()._boundingBox(element),
+        'element': element,
+    } for element in elements]
+    if any(Annotationelement()._entryIsLarge(entry) for entry in entries):
+        Annotationelement().saveElementAsFile(doc, entries)
+    doc['_elementCount'] = len(entries)
+    doc['_detailsCount'] = sum(entry.get('bbox', {}).get('details') or 1 for entry in entries)
+    return entries
+
+
+def _iterEntryBatches(docs, version, now, batchSize):
+    """
+    Assign ids and a version to annotation documents and yield batches of
+    element entries across all of them.
+
+    :param docs: a list of annotation documents.  Modified.
+    :param version: the annotation version.
+    :param now: the creation time for the entries.
+    :param batchSize: the maximum number of entries in a batch.
+    :yields: lists of element entries.
+    """
+    entries = []
+    for doc in docs:
+        doc['_id'] = ObjectId()
+        doc['_version'] = version
+        for entry in _elementEntries(doc, now):
+            entries.append(entry)
+            if len(entries) >= batchSize:
+                yield entries
+                entries = []
+    if entries:
+        yield entries
+
+
+def _prepareAnnotation(template, annotation, now):
+    """
+    Create and validate an annotation document, triggering the events that
+    saving it would trigger beforehand.
+
+    :param template: the common parts of the annotation document.
+    :param annotation: the annotation dictionary.  Modified.
+    :param now: the creation time.
+    :returns: the annotation document or None if a handler of the
+        ``model.annotation.save`` event prevented saving it.
+    """
+    if not annotation.get('name'):
+        annotation['name'] = now.strftime('Annotation %Y-%m-%d %H:%M')
+    doc = copy.deepcopy(template)
+    doc['annotation'] = annotation
+    if not events.trigger('model.annotation.validate', doc).defaultPrevented:
+        doc = Annotation().validate(doc)
+    if events.trigger('model.annotation.save', doc).defaultPrevented:
+        return None
+    return doc
+
+
+def bulkCreateAnnotations(item, user, annotations, batchSize=None, progress=None):
+    """
+    Create many annotations on an item at once.  All annotations are
+    validated before anything is stored, then elements and annotation
+    documents are written with batched inserts rather than one save per
+    annotation.  This is much faster than calling createAnnotation repeatedly
+    when there are many small annotations.
+
+    The ``model.annotation.validate``, ``model.annotation.save``,
+    ``model.annotation.save.created``, and ``model.annotation.save.after``
+    events are triggered and a notification is sent for each annotation, as
+    createAnnotation does.  Annotations whose save event is prevented are not
+    created.  The asynchronous ``large_image.annotations.save_history`` event
+    is not triggered.
+
+    :param item: the item to add annotations to.
+    :param user: the user creating the annotations.
+    :param annotations: a list of annotation dictionaries, each of which may
+        contain elements.  These are modified.
+    :param batchSize: the number of element or annotation documents to insert
+        at a time.  If None, this is read from the config file.
+    :param progress: if not None, a function that is called with the number
+        of elements stored and the total number of elements after each batch.
+        If it raises an exception, anything already stored is removed.
+    :returns: a list of created annotation documents.
+    """
+    batchSize = max(1, int(batchSize or getPluginConfig('annotation_batch_size', 10000)))
+    now = datetime.datetime.now(datetime.timezone.utc)
+    template = _annotationTemplate(item, user, now)
+    docs = [_prepareAnnotation(template, annotation, now) for annotation in annotations]
+    docs = [doc for doc in docs if doc is not None]
+
+    version = Annotationelement().getNextVersionValue()
+    elementCollection = Annotationelement().collection
+    elementTotal = sum(len(doc['annotation'].get('elements') or []) for doc in docs)
+    stored = 0
+    try:
+        for entries in _iterEntryBatches(docs, version, now, batchSize):
+            res = elementCollection.insert_many(entries, ordered=False)
+            for pos, entry in enumerate(entries):
+                if 'id' not in entry['element']:
+                    entry['element']['id'] = str(res.inserted_ids[pos])
+            stored += len(entries)
+            if progress:
+                progress(stored, elementTotal)
+        for start in range(0, len(docs), batchSize):
+            Annotation().collection.insert_many(docs[start:start + batchSize], ordered=False)
+    except BaseException:
+        ids = [doc['_id'] for doc in docs if '_id' in doc]
+        if ids:
+            # This also removes the files of large elements
+            Annotationelement().removeWithQuery({'annotationId': {'$in': ids}})
+            Annotation().collection.delete_many({'_id': {'$in': ids}})
+        raise
+    expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=1)
+    for doc in docs:
+        auditLogger.info('document.create', extra={
+            'details': {'collection': 'annotation', 'id': doc['_id']}})
+        events.trigger('model.annotation.save.created', doc)
+        events.trigger('model.annotation.save.after', doc)
+        Notification().createNotification(
+            type='large_image_annotation.create',
+            data={'_id': doc['_id'], 'itemId': item['_id']},
+            user=user, expires=expires)
+    return docs
+
+
+# Columns that identify the target item of a row in a metadata table, in
+# order of preference.
+_tableKeyColumns = ('_id', 'itemId', 'path', 'name')
+
+
+def _iterTextLines(fptr, chunkSize=1024 ** 2):
+    """
+    Iterate through the lines of a utf-8 file without reading it all at once.
+
+    :param fptr: a file-like object opened in binary mode.
+    :param chunkSize: the number of bytes to read at a time.
+    :yields: lines of text including their line endings.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    remainder = ''
+    while True:
+        chunk = fptr.read(chunkSize)
+        text = remainder + decoder.decode(chunk, final=not len(chunk))
+        lines = text.split('\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line + '\n'
+        if not len(chunk):
+            break
+    if remainder:
+        yield remainder
+
+
+def _tableFormat(lines, name):
+    """
+    Determine the format of a metadata table from its file name, or, if that
+    is inconclusive, from its first non-blank line.
+
+    :param lines: a list of the first lines of the table.
+    :param name: the name of the file.
+    :returns: one of 'csv', 'tsv', or 'ndjson'.
+    """
+    ext = name.lower().rsplit('.', 1)[-1] if '.' in name else ''
+    if ext in {'ndjson', 'jsonl'}:
+        return 'ndjson'
+    if ext in {'tsv', 'tab'}:
+        return 'tsv'
+    if ext == 'csv':
+        return 'csv'
+    first = next((line for line in lines if line.strip()), '').lstrip()
+    if first.startswith('{'):
+        return 'ndjson'
+    return 'tsv' if '\t' in first else 'csv'
+
+
+def _tableValue(value):
+    """
+    Convert a value from a delimited table to a number if it looks like one.
+
+    :param value: a string.
+    :returns: an int, float, or the original string.
+    """
+    for cls in (int, float):
+        try:
+            number = cls(value)
+        except ValueError:
+            continue
+        if math.isfinite(number):
+            return number
+    return value
+
+
+def _tableRowKey(row, keyColumn, rowNum):
+    """
+    Split a row of a metadata table into the key of its target item and the
+    metadata to set.
+
+    :param row: a dictionary of the row's values.
+    :param keyColumn: the column containing the key.
+    :param rowNum: the row number, used to describe invalid rows.
+    :returns: a tuple of (keyType, key, metadata), where keyType is one of
+        'id', 'path', 'name', or 'invalid'.
+    """
+    key = row.pop(keyColumn, None)
+    if isinstance(key, (int, float)) and not isinstance(key, bool):
+        key = str(key)
+    if not isinstance(key, str) or not key.strip():
+        return _invalidTableRow(rowNum, 'no %s value' % keyColumn)
+    key = key.strip()
+    if keyColumn in {'_id', 'itemId'}:
+        return 'id', key, row
+    key = key.strip('/')
+    if '/' in key:
+        return 'path', key, row
+    return 'name', key, row
+
+
+def _invalidTableRow(rowNum, reason):
+    return 'invalid', 'row %d (%s)' % (rowNum, reason), {}
+
+
+def _ndjsonTableRow(line, rowNum):
+    """
+    Parse a row of an NDJSON metadata table.
+
+    :param line: the line of text.
+    :param rowNum: the row number, used to describe invalid rows.
+    :returns: a tuple of (keyType, key, metadata) as from _tableRowKey.
+    """
+    try:
+        row = orjson.loads(line)
+    except orjson.JSONDecodeError:
+        return _invalidTableRow(rowNum, 'not valid JSON')
+    if not isinstance(row, dict):
+        return _invalidTableRow(rowNum, 'not an object')
+    keyColumn = next((key for key in _tableKeyColumns if key in row), None)
+    if keyColumn is None:
+        return _invalidTableRow(rowNum, 'does not specify an item')
+    keyType, key, meta = _tableRowKey(row, keyColumn, rowNum)
+    try:
+        Item().validateKeys(meta)
+    except ValidationException as exc:
+        return _invalidTableRow(rowNum, exc.args[0] if exc.args else 'invalid key')
+    return keyType, key, meta
+
+
+def iterMetadataTable(fptr, name):
+    """
+    Parse a table of metadata where each row applies to one item.  The table
+    can be a CSV or TSV file with a header row or an NDJSON file with one
+    object per line.  The target of each row is given by an ``_id`` or
+    ``itemId`` column with an item id, a ``path`` column with a path relative
+    to the folder the table is associated with, or a ``name`` column with the
+    name of an item in that folder.  For delimited files, if none of these
+    columns are present, the first column is treated as an item name.  Values
+    other than keys that look like numbers are converted to numbers and empty
+    values are ignored.  In NDJSON files, numeric keys are used as strings
+    and null values remove the metadata key.  Rows that can't be applied,
+    such as ones without a key, are yielded with an 'invalid' key type and a
+    key that describes the row, so they are reported as unmatched.
+
+    :param fptr: a file-like object opened in binary mode.
+    :param name: the name of the file, used to determine its format.
+    :yields: tuples of (keyType, key, metadata), where keyType is one of
+        'id', 'path', 'name', or 'invalid'.
+    """
+    lines = _iterTextLines(fptr)
+    head = []
+    for line in lines:
+        head.append(line)
+        if line.strip():
+            break
+    fmt = _tableFormat(head, name)
+    lines = itertools.chain(head, lines)
+    if fmt == 'ndjson':
+        for rowNum, line in enumerate(lines, 1):
+            if line.strip():
+                yield _ndjsonTableRow(line, rowNum)
+        return
+    reader = csv.reader(lines, delimiter='\t' if fmt == 'tsv' else ',')
+    header = next(reader, None)
+    if not header:
+        return
+    header = [column.strip() for column in header]
+    keyColumn = next((key for key in _tableKeyColumns if key in header), header[0])
+    Item().validateKeys(column for column in header if column != keyColumn)
+    for rowNum, values in enumerate(reader, 2):
+        if not any(value.strip() for value in values):
+            continue
+        # Keys are names or ids, so they are never converted to numbers
+        row = {column: value if column == keyColumn else _tableValue(value)
+               for column, value in zip(header, values)
+               if value.strip() or column == keyColumn}
+        yield _tableRowKey(row, keyColumn, rowNum)
+
+
+def _resolveTablePaths(folder, paths):
+    """
+    Find the folders referenced by the directory portion of relative paths.
+    Each distinct directory is looked up once.
+
+    :param folder: the folder the paths are relative to.
+    :param paths: an iterable of relative item paths.
+    :returns: a dictionary of directory paths to folder ids for the
+        directories that exist.
+    """
+    folders = {'': folder['_id']}
+    for path in sorted({path.rsplit('/', 1)[0] for path in paths}):
+        parentPath = ''
+        for part in path.split('/'):
+            subPath = parentPath + '/' + part if parentPath else part
+            if subPath not in folders and folders.get(parentPath) is not None:
+                child = Folder().findOne({
+                    'parentId': folders[parentPath], 'parentCollection': 'folder',
+                    'name': part}, fields=['_id'])
+                folders[subPath] = child['_id'] if child else None
+            parentPath = subPath
+    return {path: folderId for path, folderId in folders.items() if folderId is not None}
+
+
+def _resolveTableTargets(folder, user, rows):
+    """
+    Find the items that rows of a metadata table refer to with a single query.
+    Only items the user can write to are matched.
+
+    :param folder: the folder that paths and names are relative to.
+    :param user: the user setting the metadata.
+    :param rows: a list of (keyType, key, metadata) tuples.
+    :returns: a dictionary of (keyType, key) to item ids.
+    """
+    ids = {}
+    names = {}
+    for keyType, key, _ in rows:
+        if keyType == 'id':
+            try:
+                ids[ObjectId(key)] = key
+            except Exception:
+                pass
+    folderIds = _resolveTablePaths(folder, [key for keyType, key, _ in rows if keyType == 'path'])
+    for keyType, key, _ in rows:
+        if keyType == 'name':
+            names[(folder['_id'], key)] = ('name', key)
+        elif keyType == 'path' and key.rsplit('/', 1)[0] in folderIds:
+            names[(folderIds[key.rsplit('/', 1)[0]], key.rsplit('/', 1)[1])] = ('path', key)
+    clauses = []
+    if ids:
+        clauses.append({'_id': {'$in': list(ids)}})
+    if names:
+        clauses.append({
+            'folderId': {'$in': list({folderId for folderId, _ in names})},
+            'name': {'$in': list({name for _, name in names})}})
+    if not clauses:
+        return {}
+    cursor = Item().find({'$or': clauses}, fields=['_id', 'folderId', 'name'])
+    targets = {}
+    for item in Item().filterResultsByPermission(cursor, user, AccessType.WRITE):
+        if item['_id'] in ids:
+            targets[('id', ids[item['_id']])] = item['_id']
+        if (item['folderId'], item['name']) in names:
+            targets[names[(item['folderId'], item['name'])]] = item['_id']
+    return targets
+
+
+def bulkSetMetadata(folder, user, rows, batchSize=None, progress=None):
+    """
+    Set metadata on many items at once.  The target items are resolved with
+    a single query and the metadata is applied with batched bulk writes.
+    Unlike Item().setMetadata, this does not trigger model save events.
+
+    :param folder: the folder that relative paths and names refer to.
+    :param user: the user setting the metadata.  Only items this user can
+        write to are modified.
+    :param rows: a list of (keyType, key, metadata) tuples as produced by
+        iterMetadataTable.
+    :param batchSize: the number of items to update in one bulk write.  If
+        None, this is read from the config file.
+    :param progress: if not None, a function that is called with the number
+        of items updated and the total number of items after each batch.
+    :returns: a tuple of the number of items updated and a list of keys of
+        rows that did not match an item or descriptions of invalid rows.
+    """
+    batchSize = max(1, int(batchSize or getPluginConfig('metadata_batch_size', 1000)))
+    targets = _resolveTableTargets(folder, user, rows)
+    unmatched = []
+    # Rows that refer to the same item are merged so that the unordered bulk
+    # writes don't race each other.
+    updates = {}
+    for keyType, key, meta in rows:
+        itemId = targets.get((keyType, key))
+        if itemId is None:
+            unmatched.append(key)
+        else:
+            updates.setdefault(itemId, {}).update(meta)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    operations = []
+    for itemId, meta in updates.items():
+        update = {'$set': {'updated': now}}
+        for metaKey, value in meta.items():
+            if value is None:
+                update.setdefault('$unset', {})['meta.' + metaKey] = ''
+            else:
+                update['$set']['meta.' + metaKey] = value
+        operations.append(pymongo.UpdateOne({'_id': itemId}, update))
+    for start in range(0, len(operations), batchSize):
+        Item().collection.bulk_write(operations[start:start + batchSize], ordered=False)
+        if progress:
+            progress(min(start + batchSize, len(operations)), len(operations))
+    return len(operations), unmatched
+
+
+def jobProgress(job, interval=1, unit='elements'):
+    """
+    Create a progress function that records ingest progress on a job.  The
+    job is updated at most once per interval, and the function raises
+    IngestCanceled if the job has been canceled.
+
+    :param job: the job to update.
+    :param interval: the minimum time in seconds between job updates.
+    :param unit: the name of what is being counted in progress messages.
+    :returns: a function taking the number of elements stored and the
+        expected number of elements.
+    """
+    lastTime = 0
+
+    def progress(current, total):
+        nonlocal job, lastTime
+
+        if time.time() - lastTime < interval and current < total:
+            return
+        lastTime = time.time()
+        job = Job().load(job['_id'], force=True, includeLog=False)
+        if not job or job['status'] == JobStatus.CANCELED:
+            raise IngestCanceled
+        job = Job().updateJob(
+            job, progressCurrent=current, progressTotal=total,
+            progressMessage='Ingested %d of %d %s' % (current, total, unit))
+
+    return progress
+
+
+class IngestPool:
+    """
+    Run ingest jobs on a bounded pool of threads.  In addition to limiting the
+    number of concurrent jobs, the total memory charge of running jobs is
+    limited.  Jobs wait in order in a queue until a thread is free and their
+    charge fits within the budget, though a job is always started if nothing
+    else is running.  Waiting jobs don't hold a thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = collections.deque()
+        self._inFlight = 0
+        self._running = 0
+        self._executor = None
+        self._heartbeat = None
+
+    def submit(self, job, charge, func):
+        """
+        Queue a job.
+
+        :param job: the job document.
+        :param charge: the approximate memory in bytes the job needs.
+        :param func: a function that is called with the job document to do
+            the work.
+        """
+        job = Job().updateJob(
+            job, status=JobStatus.QUEUED if job['status'] != JobStatus.QUEUED else None,
+            notify=False, otherFields=_ownerFields())
+        with self._lock:
+            self._pending.append((job, charge, func))
+            self._dispatch()
+
+    def _dispatch(self):
+        """
+        Start queued jobs that fit within the limits.  The lock must be held.
+        """
+        workers = max(1, int(getPluginConfig('ingest_workers', 2)))
+        budget = int(getPluginConfig('ingest_memory_budget', 4 * 1024 ** 3))
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='HistomicsUI-ingest')
+        if self._heartbeat is None:
+            self._heartbeat = threading.Thread(
+                target=self._beat, name='HistomicsUI-ingest-heartbeat', daemon=True)
+            self._heartbeat.start()
+        while self._pending and self._running < workers:
+            job, charge, func = self._pending[0]
+            if self._running and self._inFlight + charge > budget:
+                break
+            self._pending.popleft()
+            self._running += 1
+            self._inFlight += charge
+            self._executor.submit(self._run, job, charge, func)
+
+    def _run(self, job, charge, func):
+        try:
+            job = Job().load(job['_id'], force=True, includeLog=False)
+            if not job or job['status'] != JobStatus.QUEUED:
+                return
+            try:
+                job = Job().updateJob(
+                    job, status=JobStatus.RUNNING, log='Started ingest\n',
+                    otherFields=_ownerFields())
+            except ValidationException:
+                # Another server process started or canceled the job
+                return
+            func(job)
+            job = Job().load(job['_id'], force=True, includeLog=False)
+            if job and job['status'] == JobStatus.RUNNING:
+                Job().updateJob(job, status=JobStatus.SUCCESS, log='Finished ingest\n')
+        except IngestCanceled:
+            logger.info('Ingest job %s was canceled', job['_id'])
+        except Exception as exc:
+            logger.exception('Ingest job %s failed', job['_id'])
+            job = Job().load(job['_id'], force=True, includeLog=False)
+            if job and job['status'] != JobStatus.CANCELED:
+                Job().updateJob(
+                    job, status=JobStatus.ERROR, log='Ingest failed with %s\n' % exc)
+        finally:
+            with self._lock:
+                self._inFlight -= charge
+                self._running -= 1
+                self._dispatch()
+
+    def _beat(self):
+        """
+        Periodically refresh the heartbeat of the jobs this process holds so
+        that other processes don't recover them.
+        """
+        while True:
+            time.sleep(float(getPluginConfig('ingest_heartbeat_interval', 30)))
+            try:
+                Job().collection.update_many({
+                    'type': 'histomicsui_ingest',
+                    'ingestOwner.boot': _ingestOwner['boot'],
+                    'status': {'$in': [JobStatus.QUEUED, JobStatus.RUNNING]},
+                }, {'$set': {'ingestHeartbeat': datetime.datetime.now(datetime.timezone.utc)}})
+            except Exception:
+                logger.exception('Could not update the ingest job heartbeat')
+
+
+_ingestPool = IngestPool()
+
+# Identifies the ingest pool of this server process on the jobs it holds.  The
+# boot id distinguishes a restarted process that reuses a pid.
+_ingestOwner = {
+    'host': socket.gethostname(),
+    'pid': os.getpid(),
+    'boot': uuid.uuid4().hex,
+}
+
+
+def _ownerFields():
+    """
+    Get the job fields that record that this process holds a job.
+
+    :returns: a dictionary of fields to set on the job.
+    """
+    return {
+        'ingestOwner': _ingestOwner,
+        'ingestHeartbeat': datetime.datetime.now(datetime.timezone.utc),
+    }
+
+
+def _ownerIsLive(job):
+    """
+    Check if the server process that holds an ingest job is still running.  A
+    process on this host is checked directly; otherwise, the process is live
+    if it has updated the job's heartbeat recently.
+
+    :param job: the job document.
+    :returns: True if the job is held by a live process other than this one.
+    """
+    owner = job.get('ingestOwner')
+    heartbeat = job.get('ingestHeartbeat')
+    if not owner or not heartbeat or owner.get('boot') == _ingestOwner['boot']:
+        return False
+    if owner.get('host') == _ingestOwner['host']:
+        if owner.get('pid') == _ingestOwner['pid']:
+            return False
+        try:
+            os.kill(owner['pid'], 0)
+        except ProcessLookupError:
+            return False
+        except Exception:
+            pass
+    if heartbeat.tzinfo is None:
+        heartbeat = heartbeat.replace(tzinfo=datetime.timezone.utc)
+    age = (datetime.datetime.now(datetime.timezone.utc) - heartbeat).total_seconds()
+    return age < float(getPluginConfig('ingest_heartbeat_timeout', 120))
+
+
+def _jobFunction(job):
+    import importlib
+
+    return getattr(importlib.import_module(job['module']), job['function'])
+
+
+def scheduleIngestJob(title, user, kwargs, charge, module, function):
+    """
+    Create a local job and queue it on the ingest pool.  The job is run by
+    calling the specified function with the job document.
+
+    :param title: the job title.
+    :param user: the user that owns the job.
+    :param kwargs: the job's keyword arguments.
+    :param charge: the approximate memory in bytes the job needs.
+    :param module: the python module containing the job function.
+    :param function: the name of the job function.
+    :returns: the job document.
+    """
+    job = Job().createLocalJob(
+        module=module,
+        function=function,
+        kwargs=kwargs,
+        title=title,
+        user=user,
+        type='histomicsui_ingest',
+        public=False,
+        asynchronous=True,
+        otherFields={'ingestCharge': charge},
+    )
+    _ingestPool.submit(job, charge, _jobFunction(job))
+    return job
+
+
+def recoverIngestJobs():
+    """
+    Handle ingest jobs left by server processes that have stopped, since
+    queued jobs are only kept in memory.  Jobs that hadn't started are queued
+    again.  Jobs that were running may have been partly done, so they are
+    marked as failed.  Jobs held by other server processes that are still
+    running are left alone.
+    """
+    for job in Job().find({
+            'type': 'histomicsui_ingest',
+            'status': {'$in': [JobStatus.INACTIVE, JobStatus.QUEUED, JobStatus.RUNNING]},
+    }, sort=[('created', 1)], includeLog=False):
+        if _ownerIsLive(job):
+            continue
+        try:
+            if job['status'] == JobStatus.RUNNING:
+                Job().updateJob(
+                    job, status=JobStatus.ERROR,
+                    log='Ingest was interrupted by a server restart\n')
+            else:
+                _ingestPool.submit(job, job.get('ingestCharge', 0), _jobFunction(job))
+                logger.info('Requeued ingest job %s', job['_id'])
+        except Exception:
+            logger.exception('Could not recover ingest job %s', job['_id'])
@@ -0,0 +1,22 @@
+from girder.constants import SortDir
+from girder.models.model_base import Model
+
+
+class IngestedAnnotationFile(Model):
+    """
+    A record of the content hash of each annotation file ingested for an item
+    and the annotations it produced.  This is used to detect when an
+    identical file is uploaded for the same item again.
+    """
+
+    def initialize(self):
+        self.name = 'histomicsui_ingested_annotation_file'
+        self.ensureIndices([
+            ([
+                ('itemId', SortDir.ASCENDING),
+                ('hash', SortDir.ASCENDING),
+            ], {}),
+        ])
+
+    def validate(self, doc):
+        return doc
@@ -0,0 +1,29 @@
+from girder.constants import SortDir
+from girder.models.model_base import Model
+
+#: How long identifier records are kept, in seconds.
+IDENTIFIER_LIFETIME = 86400
+
+
+class UploadIdentifier(Model):
+    """
+    Identifiers of recently processed uploads that share a batch uuid.  This
+    lets files in the same batch be associated even when they are processed by
+    different Girder processes.  Each document either records an identifier
+    (with `uuid`, `identifier`, and `info` fields) or is a pending reprocess
+    request (with `uuid` and `pending` fields).  Documents expire after
+    IDENTIFIER_LIFETIME seconds.
+    """
+
+    def initialize(self):
+        self.name = 'histomicsui_upload_identifier'
+        self.ensureIndices([
+            ([
+                ('uuid', SortDir.ASCENDING),
+                ('identifier', SortDir.ASCENDING),
+            ], {}),
+            ('created', {'expireAfterSeconds': IDENTIFIER_LIFETIME}),
+        ])
+
+    def validate(self, doc):
+        return doc
@@ -0,0 +1,17 @@
+"""
+Access to the histomicsui section of the Girder config file.
+"""
+
+from girder.utility import config
+
+
+def getPluginConfig(key, default=None):
+    """
+    Get a value from the histomicsui section of the Girder config file.
+
+    :param key: the key within the histomicsui section.
+    :param default: the value to return if the key is not set.
+    :returns: the configured value.
+    """
+    value = config.getConfig().get('histomicsui', {}).get(key)
+    return default if value is None else value
@@ -14,6 +14,6 @@ def addEndpoints(apiRoot):
     aperio.addItemEndpoints(apiRoot.item)
     aperio.addTcgaEndpoints(apiRoot.tcga)
 
-    ImageBrowseResource(apiRoot)
+    imageBrowse = ImageBrowseResource(apiRoot)
 
-    apiRoot.histomicsui = HistomicsUIResource()
+    apiRoot.histomicsui = HistomicsUIResource(imageBrowse)
@@ -1,24 +1,277 @@
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import threading
+import time
+
+import cachetools
+import cherrypy
+import girder.utility
+from bson import ObjectId
+from bson.errors import InvalidId
 from girder import logger
 from girder.api import access
 from girder.api.describe import Description, autoDescribeRoute, describeRoute
-from girder.api.rest import Resource, filtermodel
+from girder.api.rest import Resource, filtermodel, setResponseHeader
 from girder.constants import AccessType, TokenScope
 from girder.exceptions import RestException
+from girder.models.file import File
+from girder.models.folder import Folder
+from girder.models.group import Group
 from girder.models.item import Item
 from girder.models.setting import Setting
 from girder.utility.model_importer import ModelImporter
+from girder_large_image_annotation.models.annotation import Annotation
 
 from .. import handlers
 from ..constants import PluginSettings
-from .system import allChildFolders, allChildItems
+from ..folder_config import (CONFIG_NAMES, HISTOMICSUI_CONFIG_NAME, folderConfig,
+                             folderConfigCache)
+from .image_browse_resource import tileMetadata
+from .system import childItemsQuery, readableChildFolders
+
+#: The most folders whose config files can be fetched in one request.
+MAX_CONFIG_FOLDERS = 100
+# The approximate size in bytes of each chunk of a streamed response
+STREAM_CHUNK_SIZE = 65536
+# The number of seconds a bootstrap ETag is valid.  Changes made by other
+# server processes that don't change the folder are seen after this long.
+BOOTSTRAP_ETAG_TTL = 300
+
+PUBLIC_SETTINGS = (
+    PluginSettings.HUI_BRAND_NAME,
+    PluginSettings.HUI_DEFAULT_DRAW_STYLES,
+    PluginSettings.HUI_LOGIN_TEXT,
+    PluginSettings.HUI_PANEL_LAYOUT,
+    PluginSettings.HUI_QUARANTINE_FOLDER,
+    PluginSettings.HUI_WEBROOT_PATH,
+)
+
+# A tuple of the public settings and their ETag, or None if they need to be
+# reloaded.
+_publicSettingsCache = None
+
+
+def _cachedPublicSettings():
+    """
+    Get the public settings and an ETag for them, loading them if they aren't
+    cached.
+
+    :returns: a dictionary of settings and a hexadecimal ETag.
+    """
+    global _publicSettingsCache
+
+    cached = _publicSettingsCache
+    if cached is None:
+        result = {k: Setting().get(k) for k in PUBLIC_SETTINGS}
+        result[PluginSettings.HUI_QUARANTINE_FOLDER] = bool(
+            result[PluginSettings.HUI_QUARANTINE_FOLDER])
+        etag = hashlib.sha256(json.dumps(
+            result, sort_keys=True, default=str).encode()).hexdigest()
+        cached = _publicSettingsCache = (result, etag)
+    return cached
+
+
+def publicSettings():
+    """
+    Get the HistomicsUI settings that are available to all users.  These are
+    cached until one of them is changed.
+
+    :returns: a dictionary of settings.
+    """
+    return dict(_cachedPublicSettings()[0])
+
+
+def invalidatePublicSettings(event=None):
+    """
+    Discard the cached public settings if one of them changed.  This is a
+    handler for the ``model.setting.save.after`` and ``model.setting.remove``
+    events.
+
+    :param event: the event.  If None, the cache is always discarded.
+    """
+    global _publicSettingsCache
+
+    if event is None or event.info.get('key') in PUBLIC_SETTINGS:
+        _publicSettingsCache = None
+
+
+# For folders whose items have changed in this process, a number that changes
+# with each change.
+_folderItemGenerations = cachetools.LRUCache(maxsize=100000)
+_folderItemGenerationLock = threading.Lock()
+_folderItemCounter = itertools.count(1)
+
+
+def folderItemsChanged(event):
+    """
+    Note that an item in a folder changed.  This is a handler for the
+    ``model.item.save.after`` and ``model.item.remove`` events.
+
+    :param event: the event.
+    """
+    folderId = event.info.get('folderId')
+    if folderId is not None:
+        with _folderItemGenerationLock:
+            _folderItemGenerations[folderId] = next(_folderItemCounter)
+
+
+def checkETag(etag):
+    """
+    Add a strong ETag to the response and compare it to the request's
+    If-None-Match header.  If they match, the response status is set to 304.
+
+    :param etag: the entity tag without quotes.
+    :returns: True if the client already has the current response.
+    """
+    etag = '"%s"' % etag
+    setResponseHeader('ETag', etag)
+    match = cherrypy.request.headers.get('If-None-Match')
+    if match and (match.strip() == '*' or etag in {
+            value.strip().removeprefix('W/') for value in match.split(',')}):
+        cherrypy.response.status = 304
+        return True
+    return False
+
+
+def _bootstrapFile(item, user):
+    """
+    Get the file that the image viewer uses as analysis input: the large image
+    file if there is one, otherwise the item's first file.
+    """
+    largeImage = item.get('largeImage') or {}
+    fileId = largeImage.get('fileId') or largeImage.get('originalId')
+    if fileId:
+        file = File().load(fileId, user=user, level=AccessType.READ)
+    else:
+        file = next(iter(Item().childFiles(item, limit=1)), None)
+    return File().filter(file, user) if file else None
+
+
+def _bootstrapUserFolders(user):
+    """
+    Get the user's private folder and groups.
+    """
+    if not user:
+        return None, []
+    folder = Folder().findOne({
+        'parentId': user['_id'], 'parentCollection': 'user', 'name': 'Private'})
+    groups = Group().find({'_id': {'$in': user.get('groups', [])}}, sort=[('lowerName', 1)])
+    return (Folder().filter(folder, user) if folder else None,
+            [Group().filter(group, user) for group in groups])
+
+
+def _bootstrapAnnotations(item, user):
+    """
+    List the annotations of an item as the annotation endpoint does.
+    """
+    fields = list((
+        'annotation.name', 'annotation.description', 'annotation.attributes',
+        'annotation.display', 'access', 'groups', '_version', '_elementCount',
+        '_detailsCount',
+    ) + Annotation().baseFields)
+    annotations = Annotation().findWithPermissions(
+        {'itemId': item['_id'], '_active': {'$ne': False}}, sort=[('lowerName', 1)],
+        fields=fields, user=user, level=AccessType.READ)
+    return [Annotation().filter(annotation, user) for annotation in annotations]
+
+
+def _bootstrapFingerprint(item, folder, user):
+    """
+    Compute a hash of everything a bootstrap response depends on from values
+    that are already loaded or cached, so that an unchanged response needn't
+    be assembled.  Only the item's annotations are queried.
+
+    :param item: the item document.
+    :param folder: the folder whose images are adjacent to the item.
+    :param user: the current user.
+    :returns: a hexadecimal hash or None if the response can't be
+        fingerprinted, as with virtual folders.
+    """
+    if folder.get('isVirtual'):
+        return None
+    with _folderItemGenerationLock:
+        folderItems = _folderItemGenerations.get(folder['_id'], 0)
+    parts = [
+        item,
+        user and [user['_id'], sorted(user.get('groups', []))],
+        _cachedPublicSettings()[1],
+        # Adding, removing, or moving an image changes the folder's size.
+        # Other changes to its items, such as renames that change the order of
+        # adjacent images, are tracked in this process.
+        {key: folder.get(key) for key in ('_id', 'updated', 'size', 'access', 'public')},
+        folderItems,
+        # This covers both the HistomicsUI config and the large_image config,
+        # which determines the order of adjacent images.
+        folderConfigCache.generation,
+        int(time.time() // BOOTSTRAP_ETAG_TTL),
+        list(Annotation().collection.find(
+            {'itemId': item['_id'], '_active': {'$ne': False}},
+            {'updated': True, '_version': True, 'access': True, 'public': True},
+        ).sort('_id', 1)),
+    ]
+    return hashlib.sha256(json.dumps(
+        parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _childMetadata(doc, modelType, folders):
+    """
+    Yield the metadata of a resource and of its child folders and items.
+
+    :param doc: the resource document.
+    :param modelType: the type of the resource.
+    :param folders: the readable child folders of the resource, as from
+        readableChildFolders.
+    :yields: (model type, id, parent id, metadata) tuples for the documents
+        that have metadata.
+    """
+    if doc.get('meta'):
+        yield modelType, doc['_id'], doc.get('parentId'), doc['meta']
+    hasMeta = {'meta': {'$nin': [None, {}]}}
+    for folder in Folder().find(
+            {'$and': [{'_id': {'$in': [folder['_id'] for folder in folders]}}, hasMeta]},
+            fields=['meta', 'parentId']):
+        yield 'folder', folder['_id'], folder['parentId'], folder['meta']
+    for item in Item().find(
+            {'$and': [childItemsQuery(doc, modelType, folders), hasMeta]},
+            fields=['meta', 'folderId']):
+        yield 'item', item['_id'], item['folderId'], item['meta']
+
+
+def _streamChunks(parts):
+    """
+    Join strings into chunks of encoded bytes for a streamed response.
+
+    :param parts: an iterable of strings.
+    :yields: bytes.
+    """
+    chunk = []
+    size = 0
+    for part in parts:
+        chunk.append(part)
+        size += len(part)
+        if size >= STREAM_CHUNK_SIZE:
+            yield ''.join(chunk).encode('utf8')
+            chunk = []
+            size = 0
+    if chunk:
+        yield ''.join(chunk).encode('utf8')
 
 
 class HistomicsUIResource(Resource):
-    def __init__(self):
+    def __init__(self, imageBrowse=None):
+        """
+        :param imageBrowse: the ImageBrowseResource used to find adjacent
+            images.
+        """
         super().__init__()
         self.resourceName = 'histomicsui'
+        self.imageBrowse = imageBrowse
 
         self.route('GET', ('settings',), self.getPublicSettings)
+        self.route('GET', ('bootstrap', ':id'), self.getBootstrap)
+        self.route('GET', ('folder_config',), self.getFolderConfigs)
         self.route('PUT', ('quarantine', ':id'), self.putQuarantine)
         self.route('PUT', ('quarantine', ':id', 'restore'), self.restoreQuarantine)
         # The route function tells girder to route calls to the endpoint to
@@ -40,22 +293,96 @@ class HistomicsUIResource(Resource):
         self.route('GET', ('query_metadata',), self.findItemsByMetadata)
 
     @describeRoute(
-        Description('Get public settings for HistomicsUI.'),
+        Description('Get public settings for HistomicsUI.')
+        .notes('The response has an ETag; if it matches If-None-Match, '
+               'nothing is returned.'),
     )
     @access.public(scope=TokenScope.DATA_READ)
     def getPublicSettings(self, params):
-        keys = [
-            PluginSettings.HUI_BRAND_NAME,
-            PluginSettings.HUI_DEFAULT_DRAW_STYLES,
-            PluginSettings.HUI_LOGIN_TEXT,
-            PluginSettings.HUI_PANEL_LAYOUT,
-            PluginSettings.HUI_QUARANTINE_FOLDER,
-            PluginSettings.HUI_WEBROOT_PATH,
-        ]
-        result = {k: Setting().get(k) for k in keys}
-        result[PluginSettings.HUI_QUARANTINE_FOLDER] = bool(
-            result[PluginSettings.HUI_QUARANTINE_FOLDER])
-        return result
+        settings, etag = _cachedPublicSettings()
+        if checkETag(etag):
+            return None
+        return dict(settings)
+
+    @autoDescribeRoute(
+        Description('Get everything the image viewer needs to open an image.')
+        .notes('This combines the item, its tile metadata, the file used as '
+               "analysis input, the folder's HistomicsUI config, the public "
+               "settings, the user's private folder and groups, the item's "
+               'annotations, and the adjacent images.  The response has an '
+               'ETag; if it matches If-None-Match, nothing is returned.')
+        .modelParam('id', model=Item, level=AccessType.READ)
+        .modelParam('folderId', 'The (virtual) folder ID the image is located in',
+                    model=Folder, destName='folder', paramType='query',
+                    level=AccessType.READ, required=False)
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for the item.', 403),
+    )
+    @access.public(scope=TokenScope.DATA_READ)
+    def getBootstrap(self, item, folder):
+        user = self.getCurrentUser()
+        if not folder:
+            folder = Folder().load(item['folderId'], user=user, level=AccessType.READ)
+        fingerprint = _bootstrapFingerprint(item, folder, user)
+        if fingerprint and checkETag(fingerprint):
+            return None
+        # The independent lookups are run concurrently.  Finding adjacent
+        # images uses the current request, so it is run in this thread.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=6) as pool:
+            futures = {
+                'tiles': pool.submit(tileMetadata, item),
+                'file': pool.submit(_bootstrapFile, item, user),
+                'config': pool.submit(folderConfig, folder, HISTOMICSUI_CONFIG_NAME, user),
+                'settings': pool.submit(publicSettings),
+                'userFolders': pool.submit(_bootstrapUserFolders, user),
+                'annotations': pool.submit(_bootstrapAnnotations, item, user),
+            }
+            adjacent = None
+            if self.imageBrowse is not None:
+                try:
+                    adjacent = self.imageBrowse.getAdjacentImages(item, folder)
+                except RestException:
+                    pass
+            results = {key: future.result() for key, future in futures.items()}
+        if adjacent:
+            for key in ('previous', 'next'):
+                adjacent[key] = Item().filter(adjacent[key], user)
+        privateFolder, groups = results.pop('userFolders')
+        return dict(
+            results, item=Item().filter(item, user), privateFolder=privateFolder,
+            groups=groups, adjacentImages=adjacent)
+
+    @autoDescribeRoute(
+        Description('Get resolved config files for several folders.')
+        .notes('The result maps each folder ID to an object of config file '
+               "names and their resolved contents.  Folders that don't exist "
+               "or can't be read are omitted.")
+        .jsonParam('folderIds', 'A JSON list of folder IDs.', requireArray=True)
+        .jsonParam('names', 'A JSON list of config file names.  By default, '
+                   'both the large_image and HistomicsUI config files are '
+                   'returned.', requireArray=True, required=False)
+        .errorResponse('Invalid folder ID or config file name.'),
+    )
+    @access.public(scope=TokenScope.DATA_READ)
+    def getFolderConfigs(self, folderIds, names):
+        if len(folderIds) > MAX_CONFIG_FOLDERS:
+            msg = 'At most %d folders can be requested.' % MAX_CONFIG_FOLDERS
+            raise RestException(msg)
+        names = names or list(CONFIG_NAMES)
+        if any(name not in CONFIG_NAMES for name in names):
+            msg = 'Config file names must be one of %s.' % ', '.join(CONFIG_NAMES)
+            raise RestException(msg)
+        try:
+            folderIds = [ObjectId(folderId) for folderId in folderIds]
+        except (InvalidId, TypeError):
+            msg = 'Invalid folder ID.'
+            raise RestException(msg)
+        user = self.getCurrentUser()
+        folders = Folder().findWithPermissions(
+            {'_id': {'$in': folderIds}}, user=user, level=AccessType.READ)
+        return {
+            str(folder['_id']): {name: folderConfig(folder, name, user) for name in names}
+            for folder in folders}
 
     @autoDescribeRoute(
         Description('Move an item to the quarantine folder.')
@@ -96,6 +423,11 @@ class HistomicsUIResource(Resource):
         # Add a required "query" parameter... e.g. `?type=collection`.
         .param('type', 'The type of the resource',
                enum=['folder', 'collection', 'user'])
+        # Add an optional "query" parameter with a default value.
+        .param('format', 'The output format.  json is an object of ids and '
+               'metadata.  ndjson is one object per line with id, type, '
+               'parentId, and meta.', required=False,
+               enum=['json', 'ndjson'], default='json')
         # The following to lines document common rest errors that can occur
         # when calling this endpoint.  This is for documentation only.
         .errorResponse('ID was invalid.')
@@ -115,22 +447,31 @@ class HistomicsUIResource(Resource):
         if not doc:
             msg = 'Resource not found.'
             raise RestException(msg)
-        results = {}
-        if doc.get('meta'):
-            results[str(doc['_id'])] = doc['meta']
         logger.info('Getting child metadata')
-        for folder in allChildFolders(parentType=modelType, parent=doc,
-                                      user=user, limit=0, offset=0):
-            if folder.get('meta'):
-                results[str(folder['_id'])] = folder['meta']
-        for item in allChildItems(parentType=modelType, parent=doc,
-                                  user=user, limit=0, offset=0):
-            if item.get('meta'):
-                results[str(item['_id'])] = item['meta']
-        # By default, responses to girder endpoints are json encoded when
-        # returned to the client.  In this case, it is a dictionary mapping
-        # `id` -> `metadata`.
-        return results
+        # The folder hierarchy is resolved before the response starts, so
+        # errors are still reported normally.
+        folders = readableChildFolders(doc, modelType, user)
+        encode = girder.utility.JsonEncoder().encode
+        ndjson = params.get('format') == 'ndjson'
+        setResponseHeader(
+            'Content-Type', 'application/x-ndjson' if ndjson else 'application/json')
+
+        def lines():
+            for kind, docId, parentId, meta in _childMetadata(doc, modelType, folders):
+                yield encode({
+                    'id': docId, 'type': kind, 'parentId': parentId, 'meta': meta}) + '\n'
+
+        def mapping():
+            yield '{'
+            separator = ''
+            for _, docId, _, meta in _childMetadata(doc, modelType, folders):
+                yield '%s"%s": %s' % (separator, docId, encode(meta))
+                separator = ', '
+            yield '}'
+
+        # Returning a generator function streams the response.  By default,
+        # it is an object mapping `id` -> `metadata`.
+        return lambda: _streamChunks(lines() if ndjson else mapping())
 
     # This endpoint returns a paginated list of all items with a given
     # (key, value) pair in their metadata.  This endpoint can be called as
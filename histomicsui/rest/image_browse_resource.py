@@ -1,16 +1,69 @@
-import girder_large_image
+import concurrent.futures
+
 from girder.api import access
 from girder.api.describe import Description, autoDescribeRoute
 from girder.api.v1.item import Item as ItemResource
 from girder.constants import AccessType, TokenScope
 from girder.exceptions import RestException
 from girder.models.folder import Folder
+from girder.models.item import Item
+
+from ..folder_config import LARGE_IMAGE_CONFIG_NAME, folderConfig
+from ..virtual_folders import SORTABLE_KEYS, virtualFolderOrderings, virtualItemsQuery
+
+# The maximum number of images prefetched in each direction
+MAX_PREFETCH = 10
 
 
 def _isLargeImageItem(item):
     return item.get('largeImage', {}).get('fileId') is not None
 
 
+def _imagesQuery(folder):
+    """
+    Get a query for the large image items in a folder or virtual folder.
+
+    :param folder: the folder document.
+    :returns: a query.
+    """
+    if folder.get('isVirtual') and 'virtualItemsQuery' in folder:
+        query = virtualItemsQuery(folder)
+    else:
+        query = {'folderId': folder['_id']}
+    return {'$and': [query, {'largeImage.fileId': {'$ne': None}}]}
+
+
+def tileMetadata(item):
+    """
+    Get the tile metadata of an item, or None if it isn't a large image.
+    """
+    from girder_large_image.models.image_item import ImageItem
+
+    if not item.get('largeImage'):
+        return None
+    try:
+        return ImageItem().getMetadata(item)
+    except Exception:
+        return None
+
+
+def keysetFilter(sort, item, after):
+    """
+    Get a query for the items before or after an item in a sort order.
+
+    :param sort: a list of (key, direction) tuples that ends with a unique key.
+    :param item: the item document.
+    :param after: True for items after the item, False for items before it.
+    :returns: a query.
+    """
+    clauses = []
+    for idx, (key, direction) in enumerate(sort):
+        clause = {priorKey: item[priorKey] for priorKey, _ in sort[:idx]}
+        clause[key] = {'$gt' if (direction == 1) == after else '$lt': item[key]}
+        clauses.append(clause)
+    return {'$or': clauses}
+
+
 class ImageBrowseResource(ItemResource):
     """Extends the "item" resource to iterate through images im a folder."""
 
@@ -24,18 +77,17 @@ class ImageBrowseResource(ItemResource):
         apiRoot.item.route('GET', (':id', 'previous_image'), self.getPreviousImage)
         apiRoot.item.route('GET', (':id', 'adjacent_images'), self.getPreviousAndNextImages)
 
-    def getAdjacentImages(self, currentImage, currentFolder=None):
-        folderModel = Folder()
-        if currentFolder:
-            folder = currentFolder
-        else:
-            folder = folderModel.load(
-                currentImage['folderId'], user=self.getCurrentUser(), level=AccessType.READ)
+    def _folderSort(self, folder):
+        """
+        Get the sort order of the images in a folder from the large_image
+        config file.
 
+        :param folder: the folder document.
+        :returns: a list of (key, direction) tuples.
+        """
         sort = [('name', 1)]
         try:
-            conf = girder_large_image.YAMLConfigFile(
-                folder, '.large_image_config.yaml', self.getCurrentUser())
+            conf = folderConfig(folder, LARGE_IMAGE_CONFIG_NAME, self.getCurrentUser())
             if conf['itemList']['defaultSort']:
                 sort = [(
                     ('meta.' if entry['type'] == 'metadata' else '') + entry['value'],
@@ -43,25 +95,173 @@ class ImageBrowseResource(ItemResource):
                     for entry in conf['itemList']['defaultSort']]
         except Exception:
             pass
+        return sort
+
+    def getAdjacentImages(self, currentImage, currentFolder=None, includeIndex=True,
+                          prefetch=0):
+        """
+        Get the images before and after an image in a folder, wrapping around
+        at the ends.
 
-        if folder.get('isVirtual'):
-            children = folderModel.childItems(folder, sort=sort, includeVirtual=True)
+        :param currentImage: the image item.
+        :param currentFolder: the (virtual) folder containing the image.  If
+            None, this is the item's folder.
+        :param includeIndex: if True, also get the position of the image in
+            the folder and the number of images in the folder.  Counting can
+            take longer than finding the adjacent images.
+        :param prefetch: the number of images before and after the image to
+            return with their tile metadata.
+        :returns: a dictionary with previous, next, and, optionally, index,
+            count, previousImages, and nextImages.  previousImages and
+            nextImages are lists of objects with item and tiles, nearest first.
+        """
+        folderModel = Folder()
+        if currentFolder:
+            folder = currentFolder
         else:
-            children = folderModel.childItems(folder, sort=sort)
+            folder = folderModel.load(
+                currentImage['folderId'], user=self.getCurrentUser(), level=AccessType.READ)
 
-        allImages = [item for item in children if _isLargeImageItem(item)]
-        try:
-            index = allImages.index(currentImage)
-        except ValueError:
+        sort = self._folderSort(folder)
+        if not any(key == '_id' for key, _ in sort):
+            # Break ties so that every image has one position
+            sort.append(('_id', 1))
+        ordering = virtualFolderOrderings.get(folder, sort, imagesOnly=True)
+        neighbors = (ordering.neighbors(currentImage['_id'], max(1, prefetch))
+                     if ordering is not None else None)
+        if neighbors is not None:
+            return self._orderedAdjacentImages(
+                currentImage, ordering, neighbors, includeIndex, prefetch)
+        query = _imagesQuery(folder)
+        if not _isLargeImageItem(currentImage) or not Item().findOne(
+                {'$and': [query, {'_id': currentImage['_id']}]}, fields=['_id']):
             msg = 'Id is not an image'
             raise RestException(msg, 404)
+        if not all(key in SORTABLE_KEYS and currentImage.get(key) is not None
+                   for key, _ in sort):
+            return self._scanAdjacentImages(currentImage, query, sort, prefetch)
+
+        reverse = [(key, -direction) for key, direction in sort]
+        before = {'$and': [query, keysetFilter(sort, currentImage, False)]}
+        count = max(1, prefetch)
+        previousImages = self._keysetNeighbors(
+            currentImage, before, query, reverse, count)
+        nextImages = self._keysetNeighbors(
+            currentImage, {'$and': [query, keysetFilter(sort, currentImage, True)]},
+            query, sort, count)
+        result = self._adjacentResult(currentImage, previousImages, nextImages, prefetch)
+        if includeIndex:
+            result['index'] = Item().collection.count_documents(before)
+            result['count'] = Item().collection.count_documents(query)
+        return result
+
+    def _orderedAdjacentImages(self, currentImage, ordering, neighbors, includeIndex,
+                               prefetch):
+        """
+        Get the images before and after an image from the materialized
+        ordering of a virtual folder.
+
+        :param currentImage: the image item.
+        :param ordering: the VirtualFolderOrdering of the folder's images.
+        :param neighbors: the position of the image and the ids of the images
+            before and after it as returned by the ordering.
+        :param includeIndex: if True, also include the index and count.
+        :param prefetch: the number of images to include with their tile
+            metadata in each direction.
+        :returns: a dictionary as returned by getAdjacentImages.
+        """
+        index, previousIds, nextIds = neighbors
+        items = {item['_id']: item for item in Item().find(
+            {'_id': {'$in': previousIds + nextIds}})}
+        result = self._adjacentResult(
+            currentImage,
+            [items[itemId] for itemId in previousIds if itemId in items],
+            [items[itemId] for itemId in nextIds if itemId in items], prefetch)
+        if includeIndex:
+            result['index'] = index
+            result['count'] = len(ordering)
+        return result
 
-        return {
-            'previous': allImages[index - 1],
-            'next': allImages[(index + 1) % len(allImages)],
-            'index': index,
-            'count': len(allImages),
+    def _keysetNeighbors(self, currentImage, adjacentQuery, query, sort, count):
+        """
+        Get the images following an image in one direction, wrapping around
+        at the end.
+
+        :param currentImage: the image item.
+        :param adjacentQuery: the query for the images following the image.
+        :param query: the query for all of the images in the folder.
+        :param sort: the sort order of the direction.
+        :param count: the maximum number of images to get.
+        :returns: a list of item documents, not including the current image.
+        """
+        images = list(Item().find(adjacentQuery, sort=sort, limit=count))
+        if len(images) < count:
+            seen = {currentImage['_id']} | {image['_id'] for image in images}
+            images.extend(
+                image for image in Item().find(query, sort=sort, limit=count - len(images))
+                if image['_id'] not in seen)
+        return images
+
+    def _adjacentResult(self, currentImage, previousImages, nextImages, prefetch):
+        """
+        Assemble the adjacent images response.
+
+        :param currentImage: the image item.
+        :param previousImages: a list of the preceding images, nearest first.
+        :param nextImages: a list of the following images, nearest first.
+        :param prefetch: the number of images to include with their tile
+            metadata in each direction.
+        :returns: a dictionary with previous, next, and, if prefetch is
+            positive, previousImages and nextImages.
+        """
+        result = {
+            'previous': previousImages[0] if previousImages else currentImage,
+            'next': nextImages[0] if nextImages else currentImage,
         }
+        if prefetch > 0:
+            user = self.getCurrentUser()
+            previousImages = previousImages[:prefetch]
+            images = previousImages + nextImages[:prefetch]
+            # Getting tile metadata may need to open each image's file
+            with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+                tiles = list(pool.map(tileMetadata, images))
+            entries = [{'item': Item().filter(image, user), 'tiles': imageTiles}
+                       for image, imageTiles in zip(images, tiles)]
+            result['previousImages'] = entries[:len(previousImages)]
+            result['nextImages'] = entries[len(previousImages):]
+        return result
+
+    def _scanAdjacentImages(self, currentImage, query, sort, prefetch=0):
+        """
+        Get the images before and after an image by listing the ids of all of
+        the images in a folder.  This is used for sort orders where values can
+        be missing or of different types, such as metadata, since range
+        queries only compare values of the same type.
+
+        :param currentImage: the image item.
+        :param query: the query for the images in the folder.
+        :param sort: the sort order.
+        :param prefetch: the number of images to include with their tile
+            metadata in each direction.
+        :returns: a dictionary with previous, next, index, count, and, if
+            prefetch is positive, previousImages and nextImages.
+        """
+        ids = [entry['_id'] for entry in Item().find(query, sort=sort, fields={'_id': True})]
+        try:
+            index = ids.index(currentImage['_id'])
+        except ValueError:
+            msg = 'Id is not an image'
+            raise RestException(msg, 404)
+        count = min(max(1, prefetch), len(ids) - 1)
+        previousIds = [ids[(index - offset) % len(ids)] for offset in range(1, count + 1)]
+        nextIds = [ids[(index + offset) % len(ids)] for offset in range(1, count + 1)]
+        result = self._adjacentResult(
+            currentImage,
+            [Item().load(itemId, force=True) for itemId in previousIds],
+            [Item().load(itemId, force=True) for itemId in nextIds], prefetch)
+        result['index'] = index
+        result['count'] = len(ids)
+        return result
 
     @access.public(scope=TokenScope.DATA_READ)
     @autoDescribeRoute(
@@ -75,7 +275,7 @@ class ImageBrowseResource(ItemResource):
         .errorResponse('Image not found', code=404),
     )
     def getNextImage(self, image, folder):
-        return self.getAdjacentImages(image, folder)['next']
+        return self.getAdjacentImages(image, folder, includeIndex=False)['next']
 
     @access.public(scope=TokenScope.DATA_READ)
     @autoDescribeRoute(
@@ -89,7 +289,7 @@ class ImageBrowseResource(ItemResource):
         .errorResponse('Image not found', code=404),
     )
     def getPreviousImage(self, image, folder):
-        return self.getAdjacentImages(image, folder)['previous']
+        return self.getAdjacentImages(image, folder, includeIndex=False)['previous']
 
     @access.public(scope=TokenScope.DATA_READ)
     @autoDescribeRoute(
@@ -99,8 +299,16 @@ class ImageBrowseResource(ItemResource):
         .modelParam('folderId', 'The (virtual) folder ID the image is located in',
                     model='folder', destName='folder', paramType='query', level=AccessType.READ,
                     required=False)
+        .param('includeIndex', 'Whether to include the index of the image and the '
+               'number of images in the folder.', dataType='boolean',
+               required=False, default=True)
+        .param('prefetch', 'The number of images before and after the image to '
+               'also return with their tile metadata in previousImages and '
+               'nextImages.  This is at most %d.' % MAX_PREFETCH, dataType='integer',
+               required=False, default=0)
         .errorResponse()
         .errorResponse('Image not found', code=404),
     )
-    def getPreviousAndNextImages(self, image, folder):
-        return self.getAdjacentImages(image, folder)
+    def getPreviousAndNextImages(self, image, folder, includeIndex, prefetch):
+        prefetch = max(0, min(prefetch, MAX_PREFETCH))
+        return self.getAdjacentImages(image, folder, includeIndex, prefetch)
@@ -0,0 +1,182 @@
+"""
+Guardrails for the endpoints that run Mongo queries sent by clients.
+
+Queries are limited in how long they may run and how many results they may
+return.  Optionally, queries from non-admin users on large collections are
+explained before they are run and rejected if they would scan the whole
+collection.  Slow queries are logged with their shape, plan, and duration.
+These are configured in the histomicsui section of the Girder config file.
+"""
+
+import json
+import time
+
+import cherrypy
+import pymongo.errors
+from girder import logger
+from girder.api.rest import RestException
+
+from ..plugin_config import getPluginConfig
+
+
+def cappedLimit(limit):
+    """
+    Apply the maximum result limit.
+
+    :param limit: the requested limit; 0 for no limit.
+    :returns: the limit to use.
+    """
+    maxLimit = int(getPluginConfig('query_max_limit', 10000) or 0)
+    if maxLimit and (not limit or limit > maxLimit):
+        return maxLimit
+    return limit
+
+
+def queryShape(query):
+    """
+    Get the shape of a query: its keys and operators with the values
+    replaced, so similar queries can be grouped.
+
+    :param query: a Mongo query or part of one.
+    :returns: the shape.
+    """
+    if isinstance(query, dict):
+        return {key: queryShape(value) for key, value in query.items()}
+    if isinstance(query, (list, tuple)):
+        shapes = []
+        for value in query:
+            shape = queryShape(value)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return '?'
+
+
+def _planStages(plan):
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage'] + ('(%s)' % plan['indexName'] if 'indexName' in plan else '')
+        for key in ('queryPlan', 'inputStage', 'inputStages'):
+            children = plan.get(key)
+            for child in children if isinstance(children, list) else [children]:
+                yield from _planStages(child)
+
+
+def explainPlan(collection, query, sort=None, limit=0):
+    """
+    Get the stages of the plan the database would use for a query without
+    running it.
+
+    :param collection: the pymongo collection.
+    :param query: the query.
+    :param sort: a list of (key, direction) tuples or None.
+    :param limit: the result limit.
+    :returns: a list of stage names, outermost first.  Index scans include
+        the name of the index.
+    """
+    find = {'find': collection.name, 'filter': query}
+    if sort:
+        find['sort'] = dict(sort)
+    if limit:
+        find['limit'] = limit
+    explain = collection.database.command({'explain': find, 'verbosity': 'queryPlanner'})
+    return list(_planStages(explain.get('queryPlanner', {}).get('winningPlan')))
+
+
+def _checkPlan(model, query, sort, limit):
+    """
+    Reject a query that would scan a whole large collection.
+
+    :param model: the model being queried.
+    :param query: the query as it is sent to the database.
+    :param sort: the sort order.
+    :param limit: the result limit.
+    """
+    minDocuments = getPluginConfig('query_explain_min_documents', False)
+    if minDocuments is False or model.collection.estimated_document_count() < int(minDocuments):
+        return
+    if any(stage.startswith('COLLSCAN') for stage in explainPlan(
+            model.collection, query, sort, limit)):
+        msg = ('This query would scan every %s.  Use a query that can use an '
+               'index.' % model.name)
+        raise RestException(msg)
+
+
+def _logSlowQuery(model, query, sort, limit, duration, count, user):
+    try:
+        plan = explainPlan(model.collection, query, sort, limit)
+    except Exception:
+        plan = None
+    logger.warning('Slow query: %s', json.dumps({
+        'collection': model.name,
+        'shape': queryShape(query),
+        'sort': sort,
+        'limit': limit,
+        'plan': plan,
+        'durationMs': int(duration * 1000),
+        'results': count,
+        'userId': str(user['_id']) if user else None,
+    }, sort_keys=True))
+
+
+def _totalCount(model, countQuery, maxTimeMS):
+    """
+    Count the documents that match a query within the time limit.
+
+    :param model: the model being queried.
+    :param countQuery: the query to count.
+    :param maxTimeMS: the time limit in milliseconds or None for no limit.
+    :returns: the count or None if it took too long.
+    """
+    kwargs = {'maxTimeMS': maxTimeMS} if maxTimeMS else {}
+    try:
+        return model.collection.count_documents(countQuery, **kwargs)
+    except pymongo.errors.ExecutionTimeout:
+        logger.info('Counting %s query results took too long', model.name)
+        return None
+
+
+def guardedQuery(model, find, query, sort, limit, user, countQuery=None):
+    """
+    Run a query with the configured guardrails.
+
+    :param model: the model being queried.
+    :param find: a function that takes limit and timeout keyword arguments
+        and returns a cursor or other iterable of documents.
+    :param query: the query as it is sent to the database, used to explain
+        and log the query.
+    :param sort: the sort order.
+    :param limit: the requested result limit.
+    :param user: the user running the query.
+    :param countQuery: a query that matches all of the documents the find
+        could return, or None if the documents can't be counted with a
+        query.
+    :returns: a list of documents.  If the requested limit was capped, the
+        Girder-Limit-Capped response header is set to the limit used.  If the
+        documents could be counted within the time limit, the
+        Girder-Total-Count response header is set.
+    """
+    requestedLimit = limit
+    limit = cappedLimit(limit)
+    if limit != requestedLimit:
+        cherrypy.response.headers['Girder-Limit-Capped'] = limit
+    maxTimeMS = int(getPluginConfig('query_max_time_ms', 30000) or 0) or None
+    start = time.time()
+    try:
+        if not user or not user['admin']:
+            _checkPlan(model, query, sort, limit)
+        cursor = find(limit=limit, timeout=maxTimeMS)
+        results = list(cursor)
+    except pymongo.errors.ExecutionTimeout:
+        _logSlowQuery(model, query, sort, limit, time.time() - start, None, user)
+        msg = 'The query took too long.  Use a more selective query.'
+        raise RestException(msg)
+    # Report the total count as Girder does for cursors, but without letting
+    # the count run longer than the query could.
+    count = _totalCount(model, countQuery, maxTimeMS) if countQuery is not None else None
+    if count is not None:
+        cherrypy.response.headers['Girder-Total-Count'] = count
+    duration = time.time() - start
+    if duration * 1000 >= float(getPluginConfig('slow_query_ms', 1000)):
+        _logSlowQuery(model, query, sort, limit, duration, len(results), user)
+    return results
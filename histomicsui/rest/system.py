@@ -14,24 +14,44 @@
 #  limitations under the License.
 #############################################################################
 
+import base64
 import datetime
+import functools
 import os
 
+import pymongo
+from bson import ObjectId, json_util
 from girder import logger
 from girder.api import access
 from girder.api.describe import Description, autoDescribeRoute, describeRoute
-from girder.api.rest import RestException, boundHandler, filtermodel
+from girder.api.rest import RestException, boundHandler, filtermodel, setResponseHeader
 from girder.api.v1.resource import Resource as ResourceResource
 from girder.constants import AccessType, AssetstoreType, TokenScope
+from girder.exceptions import AccessException
 from girder.models.assetstore import Assetstore
 from girder.models.file import File
 from girder.models.folder import Folder
 from girder.models.item import Item
+from girder.models.model_base import AccessControlledModel
 from girder.models.setting import Setting
 from girder.utility import path as path_util
 from girder.utility.model_importer import ModelImporter
+from girder_jobs.constants import JobStatus
 from girder_jobs.models.job import Job
 
+from ..virtual_folders import SORTABLE_KEYS, virtualItemsQuery
+from . import query_guard
+from .image_browse_resource import keysetFilter
+
+# The maximum number of folders a user can read for item queries to be
+# restricted to those folders in the query itself.
+MAX_PUSHDOWN_FOLDERS = 10000
+
+# The number of resources changed by each update when setting metadata on
+# multiple resources, and the number of updates sent at once by a metadata job.
+METADATA_CHUNK_SIZE = 1000
+METADATA_JOB_BATCH_SIZE = 10
+
 
 def addSystemEndpoints(apiRoot):
     """
@@ -182,10 +202,172 @@ def allChildItems(parent, parentType, user, limit=0, offset=0,
             yield item
 
 
+def readableChildFolders(parent, parentType, user):
+    """
+    Get all of the folders that are children of the resource or recursively
+    children of child folders of the resource that a user can read, with a
+    single query.  As when walking the hierarchy, the descendants of a folder
+    the user can't read are not included.
+
+    :param parent: The parent object.
+    :param parentType: The parent type.
+    :type parentType: 'user', 'folder', or 'collection'
+    :param user: The user running the query.
+    :returns: a list of folder documents with only the _id, isVirtual, and
+        virtualItemsQuery fields.
+    """
+    graphLookup = {
+        'from': Folder().name,
+        'startWith': '$_id',
+        'connectFromField': '_id',
+        'connectToField': 'parentId',
+        'as': 'folders',
+    }
+    if not user or not user['admin']:
+        graphLookup['restrictSearchWithMatch'] = Folder().permissionClauses(
+            user, AccessType.READ)
+    # Unwinding the lookup lets the database return the folders as separate
+    # documents rather than one array, which could exceed the document size
+    # limit for large trees.
+    return list(ModelImporter.model(parentType).collection.aggregate([
+        {'$match': {'_id': parent['_id']}},
+        {'$graphLookup': graphLookup},
+        {'$unwind': '$folders'},
+        {'$replaceRoot': {'newRoot': '$folders'}},
+        {'$project': {'_id': True, 'isVirtual': True, 'virtualItemsQuery': True}},
+    ], allowDiskUse=True))
+
+
+def childItemsQuery(parent, parentType, folders):
+    """
+    Get a query for the items in a resource and a list of folders.  The items
+    of virtual folders are those matching their queries.
+
+    :param parent: The parent object.
+    :param parentType: The parent type.
+    :type parentType: 'user', 'folder', or 'collection'
+    :param folders: a list of folder documents with at least the _id,
+        isVirtual, and virtualItemsQuery fields, as from readableChildFolders.
+    :returns: a query.
+    """
+    if parentType == 'folder':
+        folders = [parent] + folders
+    clauses = [{'folderId': {'$in': [
+        folder['_id'] for folder in folders
+        if not folder.get('isVirtual') or 'virtualItemsQuery' not in folder]}}]
+    clauses.extend(
+        virtualItemsQuery(folder) for folder in folders
+        if folder.get('isVirtual') and 'virtualItemsQuery' in folder)
+    return clauses[0] if len(clauses) == 1 else {'$or': clauses}
+
+
+# The type of the value of each sortable key in a cursor
+_cursorValueTypes = {
+    '_id': ObjectId,
+    'name': str,
+    'lowerName': str,
+    'created': datetime.datetime,
+    'updated': datetime.datetime,
+    'size': (int, float),
+}
+
+
+def _encodeCursor(sort, item):
+    """
+    Make an opaque cursor that resumes a listing after an item.
+
+    :param sort: the sort order, ending with a unique key.
+    :param item: the last item of a page.
+    :returns: the cursor or None if the item can't be resumed from.
+    """
+    if not all(key in SORTABLE_KEYS and item.get(key) is not None for key, _ in sort):
+        return None
+    return base64.urlsafe_b64encode(json_util.dumps(
+        [[key, direction, item[key]] for key, direction in sort]).encode()).decode()
+
+
+def _decodeCursor(cursor, sort):
+    """
+    Get the sort values of the item a cursor resumes after.  Since cursors
+    come from clients, each value must have the type of its sort key so that
+    it can't add query operators.
+
+    :param cursor: a cursor from _encodeCursor.
+    :param sort: the sort order, which must match the cursor's.
+    :returns: a dictionary of sort values.
+    """
+    try:
+        entries = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if [(key, direction) for key, direction, _ in entries] == sort and all(
+                isinstance(value, _cursorValueTypes[key]) and not isinstance(value, bool)
+                for key, _, value in entries):
+            return {key: value for key, _, value in entries}
+    except Exception:
+        pass
+    msg = 'Invalid cursor.'
+    raise RestException(msg)
+
+
+def flatChildItems(parent, parentType, user, limit=0, offset=0, sort=None, cursor=None):
+    """
+    List all items that are children of the resource or recursively children
+    of child folders of the resource in a single sort order with one query.
+    Unlike allChildItems, items from different folders are interleaved by the
+    sort.
+
+    :param parent: The parent object.
+    :param parentType: The parent type.
+    :type parentType: 'user', 'folder', or 'collection'
+    :param user: The user running the query.  Only returns items that this
+                 user can see.
+    :param limit: Result limit.
+    :param offset: Result offset.
+    :param sort: The sort structure to pass to pymongo.  Items are also
+        sorted by id.
+    :param cursor: a cursor from a previous call to resume after, or None.
+    :returns: a list of items and a cursor for the next page.  The cursor is
+        None if there are no more items or the sort can't be resumed from.
+    """
+    sort = [(key, direction) for key, direction in (sort or [])]
+    if not any(key == '_id' for key, _ in sort):
+        sort.append(('_id', 1))
+    query = childItemsQuery(parent, parentType, readableChildFolders(parent, parentType, user))
+    if cursor:
+        query = {'$and': [query, keysetFilter(sort, _decodeCursor(cursor, sort), True)]}
+    items = list(Item().find(query, offset=offset, limit=limit, sort=sort))
+    nextCursor = None
+    if limit and len(items) == limit:
+        nextCursor = _encodeCursor(sort, items[-1])
+    return items, nextCursor
+
+
+def readableFolderIds(user, maxCount=None):
+    """
+    List the ids of all of the folders that a user can read.
+
+    :param user: the user or None for anonymous access.
+    :param maxCount: the maximum number of folder ids to list.  None to use
+        MAX_PUSHDOWN_FOLDERS.
+    :returns: a list of folder ids, or None if the user is an admin or can
+        read more than maxCount folders.
+    """
+    if user and user['admin']:
+        return None
+    maxCount = MAX_PUSHDOWN_FOLDERS if maxCount is None else maxCount
+    folderIds = [folder['_id'] for folder in Folder().find(
+        Folder().permissionClauses(user, AccessType.READ), fields=['_id'],
+        limit=maxCount + 1)]
+    return folderIds if len(folderIds) <= maxCount else None
+
+
 @access.public(scope=TokenScope.DATA_READ)
 @filtermodel(model=Item)
 @autoDescribeRoute(
     Description('List items that match a query.')
+    .notes('Queries are limited in run time and number of results, as set in '
+           'the histomicsui section of the Girder config file.  If the limit '
+           'is 0 or more than the maximum, the maximum is used and the '
+           'Girder-Limit-Capped header is set to it.')
     .responseClass('Item', array=True)
     .jsonParam('query', 'Find items that match this Mongo query.',
                required=True, requireObject=True)
@@ -195,13 +377,31 @@ def allChildItems(parent, parentType, user, limit=0, offset=0,
 @boundHandler()
 def getItemsByQuery(self, query, limit, offset, sort):
     user = self.getCurrentUser()
-    return Item().findWithPermissions(query, offset=offset, limit=limit, sort=sort, user=user)
+    folderIds = readableFolderIds(user)
+    if folderIds is not None:
+        # Items are readable if their folder is, so the database can filter,
+        # sort, and limit readable items without joining each item to its
+        # folder.
+        query = {'$and': [query, {'folderId': {'$in': folderIds}}]}
+        find = functools.partial(Item().find, query, offset=offset, sort=sort)
+    else:
+        find = functools.partial(
+            Item().findWithPermissions, query, offset=offset, sort=sort, user=user)
+    # Without the pushdown, the items a non-admin can read can't be counted
+    # by a query.
+    countQuery = query if folderIds is not None or (user and user['admin']) else None
+    return query_guard.guardedQuery(
+        Item(), find, query, sort, limit, user, countQuery=countQuery)
 
 
 @access.admin(scope=TokenScope.DATA_READ)
 @filtermodel(model=File)
 @autoDescribeRoute(
     Description('List files that match a query.')
+    .notes('Queries are limited in run time and number of results, as set in '
+           'the histomicsui section of the Girder config file.  If the limit '
+           'is 0 or more than the maximum, the maximum is used and the '
+           'Girder-Limit-Capped header is set to it.')
     .responseClass('File', array=True)
     .jsonParam('query', 'Find files that match this Mongo query.',
                required=True, requireObject=True)
@@ -211,13 +411,19 @@ def getItemsByQuery(self, query, limit, offset, sort):
 @boundHandler()
 def getFilesByQuery(self, query, limit, offset, sort):
     user = self.getCurrentUser()
-    return File().findWithPermissions(query, offset=offset, limit=limit, sort=sort, user=user)
+    find = functools.partial(
+        File().findWithPermissions, query, offset=offset, sort=sort, user=user)
+    return query_guard.guardedQuery(File(), find, query, sort, limit, user, countQuery=query)
 
 
 @access.public(scope=TokenScope.DATA_READ)
 @filtermodel(model=Folder)
 @autoDescribeRoute(
     Description('List folders that match a query.')
+    .notes('Queries are limited in run time and number of results, as set in '
+           'the histomicsui section of the Girder config file.  If the limit '
+           'is 0 or more than the maximum, the maximum is used and the '
+           'Girder-Limit-Capped header is set to it.')
     .responseClass('Folder', array=True)
     .jsonParam('query', 'Find folders that match this Mongo query.',
                required=True, requireObject=True)
@@ -227,7 +433,11 @@ def getFilesByQuery(self, query, limit, offset, sort):
 @boundHandler()
 def getFoldersByQuery(self, query, limit, offset, sort):
     user = self.getCurrentUser()
-    return Folder().findWithPermissions(query, offset=offset, limit=limit, sort=sort, user=user)
+    find = functools.partial(
+        Folder().findWithPermissions, query, offset=offset, sort=sort, user=user)
+    if not user or not user['admin']:
+        query = {'$and': [query, Folder().permissionClauses(user, AccessType.READ)]}
+    return query_guard.guardedQuery(Folder(), find, query, sort, limit, user, countQuery=query)
 
 
 @access.admin
@@ -306,6 +516,154 @@ def deleteOldJobs(self, age, status):
     return count
 
 
+def _resourceObjectIds(ids):
+    try:
+        return [ObjectId(id) for id in ids]
+    except Exception:
+        msg = 'Invalid resources format.'
+        raise RestException(msg)
+
+
+def requireWriteAccess(model, kind, ids, user):
+    """
+    Check that a user can write to a set of resources of one kind, querying
+    all of them at once where the model allows it.
+
+    :param model: the model of the resources.
+    :param kind: the resource kind, used in error messages.
+    :param ids: a list of resource ids.
+    :param user: the user or None for anonymous access.
+    :returns: a list of the resource ids as ObjectIds.
+    """
+    ids = _resourceObjectIds(ids)
+    if getattr(model, 'resourceColl', None) and getattr(model, 'resourceParent', None):
+        # Access to these resources, such as items, comes from their parents
+        found = {doc['_id']: doc.get(model.resourceParent) for doc in model.collection.find(
+            {'_id': {'$in': ids}}, {model.resourceParent: True})}
+        resourceColl = model.resourceColl
+        accessModel = (ModelImporter.model(*resourceColl) if isinstance(resourceColl, tuple)
+                       else ModelImporter.model(resourceColl))
+        accessIds = set(found.values())
+    elif isinstance(model, AccessControlledModel):
+        found = {doc['_id']: doc['_id'] for doc in model.collection.find(
+            {'_id': {'$in': ids}}, {'_id': True})}
+        accessModel = model
+        accessIds = set(found.values())
+    else:
+        for id in ids:
+            if not model.load(id=id, user=user, level=AccessType.WRITE):
+                msg = 'Resource not found.'
+                raise RestException(msg)
+        return ids
+    if any(id not in found for id in ids):
+        msg = 'Resource not found.'
+        raise RestException(msg)
+    if user and user['admin']:
+        return ids
+    allowed = set() if not user else {doc['_id'] for doc in accessModel.collection.find(
+        {'$and': [{'_id': {'$in': list(accessIds)}},
+                  accessModel.permissionClauses(user, AccessType.WRITE)]},
+        {'_id': True})}
+    for id in ids:
+        if found[id] not in allowed:
+            msg = 'Write access denied for %s %s.' % (kind, id)
+            raise AccessException(msg)
+    return ids
+
+
+def metadataUpdate(metadata, allowNull=False):
+    """
+    Get the update that sets metadata on a resource.
+
+    :param metadata: a dictionary of metadata keys and values.  Keys may be
+        dotted to set nested values.
+    :param allowNull: if False, keys with None values are removed.
+    :returns: a Mongo update.
+    """
+    metaUpdate = {}
+    for key, value in metadata.items():
+        if value is None and not allowNull:
+            metaUpdate.setdefault('$unset', {})['meta.' + key] = ''
+        else:
+            metaUpdate.setdefault('$set', {})['meta.' + key] = value
+    return metaUpdate
+
+
+def bulkUpdate(model, ids, update, batchSize=None):
+    """
+    Apply the same update to many resources with unordered bulk writes.
+
+    :param model: the model of the resources.
+    :param ids: a list of resource ids.
+    :param update: the Mongo update.
+    :param batchSize: the maximum number of updates of METADATA_CHUNK_SIZE
+        resources in each bulk write.  None to send them all at once.
+    :yields: the number of resources processed and the number modified after
+        each bulk write.
+    """
+    requests = [
+        pymongo.UpdateMany({'_id': {'$in': ids[start:start + METADATA_CHUNK_SIZE]}}, update)
+        for start in range(0, len(ids), METADATA_CHUNK_SIZE)]
+    batchSize = batchSize or len(requests) or 1
+    for start in range(0, len(requests), batchSize):
+        result = model.collection.bulk_write(
+            requests[start:start + batchSize], ordered=False)
+        yield (min(len(ids), (start + batchSize) * METADATA_CHUNK_SIZE),
+               result.modified_count)
+
+
+def _kindModel(kind):
+    if '.' in kind:
+        return ModelImporter.model(kind.split('.', 1)[-1], plugin=kind.split('.', 1)[0])
+    return ModelImporter.model(kind)
+
+
+def setResourceMetadataJob(job):
+    """
+    Set metadata on multiple resources as a local job.  Access must have been
+    checked before the job was scheduled.
+
+    :param job: the job.  Its kwargs have resources, metadata, and allowNull.
+    """
+    try:
+        resources = {kind: _resourceObjectIds(ids)
+                     for kind, ids in job['kwargs']['resources'].items()}
+        metaUpdate = metadataUpdate(job['kwargs']['metadata'], job['kwargs']['allowNull'])
+        total = sum(len(ids) for ids in resources.values())
+        job = Job().updateJob(
+            job, log='Started setting metadata\n',
+            status=JobStatus.RUNNING,
+            progressCurrent=0,
+            progressTotal=total,
+            progressMessage='Setting metadata',
+        )
+        done = modified = 0
+        for kind, ids in resources.items():
+            model = _kindModel(kind)
+            for processed, batchModified in bulkUpdate(
+                    model, ids, metaUpdate, METADATA_JOB_BATCH_SIZE):
+                modified += batchModified
+                job = Job().updateJob(job, progressCurrent=done + processed)
+                # handle any request to stop execution
+                job = Job().load(id=job['_id'], force=True)
+                if not job or job['status'] in (JobStatus.CANCELED, JobStatus.ERROR):
+                    logger.info('Set metadata job halted')
+                    return
+            done += len(ids)
+        job = Job().updateJob(
+            job, log='Modified %d resources\n' % modified,
+            status=JobStatus.SUCCESS,
+            progressCurrent=total,
+            progressMessage='Finished setting metadata',
+        )
+    except Exception as e:
+        logger.exception('Setting metadata failed with %s' % str(e))
+        job = Job().updateJob(
+            job, log='Setting metadata failed with %s\n' % str(e),
+            status=JobStatus.ERROR,
+        )
+
+
 class HUIResourceResource(ResourceResource):
     def __init__(self, apiRoot):
         super(ResourceResource, self).__init__()
@@ -319,7 +677,15 @@ class HUIResourceResource(ResourceResource):
         .param('type', 'The type of the resource (folder, collection, or '
                'user).')
         .pagingParams(defaultSort='_id')
+        .param('flat', 'If true, list the items of all folders in a single '
+               'sort order rather than folder by folder.  A cursor to resume '
+               'from is returned in the Girder-Next-Cursor header when '
+               'there may be more items.', required=False,
+               dataType='boolean', default=False)
+        .param('cursor', 'The cursor from a previous flat listing to resume '
+               'after.  This implies a flat listing.', required=False)
         .errorResponse('ID was invalid.')
+        .errorResponse('Invalid cursor.')
         .errorResponse('Access was denied for the resource.', 403),
     )
     @access.public(scope=TokenScope.DATA_READ)
@@ -332,6 +698,13 @@ class HUIResourceResource(ResourceResource):
             msg = 'Resource not found.'
             raise RestException(msg)
         limit, offset, sort = self.getPagingParameters(params, '_id')
+        if self.boolParam('flat', params, False) or params.get('cursor'):
+            items, nextCursor = flatChildItems(
+                parentType=modelType, parent=doc, user=user,
+                limit=limit, offset=offset, sort=sort, cursor=params.get('cursor'))
+            if nextCursor:
+                setResponseHeader('Girder-Next-Cursor', nextCursor)
+            return items
         return list(allChildItems(
             parentType=modelType, parent=doc, user=user,
             limit=limit, offset=offset, sort=sort))
@@ -346,6 +719,13 @@ class HUIResourceResource(ResourceResource):
                    'add', paramType='body', requireObject=True)
         .param('allowNull', 'Whether "null" is allowed as a metadata value.',
                required=False, dataType='boolean', default=False)
+        .param('asynchronous', 'If true, check access and then set the '
+               'metadata in a local job, which is returned.  Use this for '
+               'very large sets of resources.', required=False,
+               dataType='boolean', default=False)
+        .notes('Access to all resources is checked before any are changed.  '
+               'Otherwise, this returns the number of resources that were '
+               'modified.')
         .errorResponse('Unsupported or unknown resource type.')
         .errorResponse('Invalid resources format.')
         .errorResponse('No resources specified.')
@@ -353,30 +733,39 @@ class HUIResourceResource(ResourceResource):
         .errorResponse('Write access was denied for a resource.', 403),
     )
     @access.public(scope=TokenScope.DATA_WRITE)
-    def putResourceMetadata(self, resources, metadata, allowNull):
+    def putResourceMetadata(self, resources, metadata, allowNull, asynchronous):
         user = self.getCurrentUser()
         self._validateResourceSet(resources)
         # Validate that we have write permission for all resources; if any
         # fail, no item will be changed.
+        models = {}
         for kind in resources:
             model = self._getResourceModel(kind, 'setMetadata')
-            for id in resources[kind]:
-                model.load(id=id, user=user, level=AccessType.WRITE)
-        metaUpdate = {}
-        for key, value in metadata.items():
-            if value is None and not allowNull:
-                metaUpdate.setdefault('$unset', {})['meta.' + key] = ''
-            else:
-                metaUpdate.setdefault('$set', {})['meta.' + key] = value
-        modified = 0
-        for kind in resources:
-            model = self._getResourceModel(kind, 'setMetadata')
-            for id in resources[kind]:
-                resource = model.load(id=id, user=user, level=AccessType.WRITE)
-                # We aren't using model.setMetadata, since it is more
-                # restrictive than we want.
-                modified += model.update({'_id': resource['_id']}, metaUpdate).modified_count
-        return modified
+            resources[kind] = requireWriteAccess(model, kind, resources[kind], user)
+            models[kind] = model
+        if asynchronous:
+            job = Job().createLocalJob(
+                module='histomicsui.rest.system',
+                function='setResourceMetadataJob',
+                kwargs={
+                    'resources': {kind: [str(id) for id in ids]
+                                  for kind, ids in resources.items()},
+                    'metadata': metadata,
+                    'allowNull': allowNull,
+                },
+                title='Set metadata on resources',
+                user=user,
+                type='histomicsui_resource_metadata',
+                public=False,
+                asynchronous=True,
+            )
+            Job().scheduleJob(job)
+            return job
+        # We aren't using model.setMetadata, since it is more restrictive than
+        # we want.
+        metaUpdate = metadataUpdate(metadata, allowNull)
+        return sum(modified for kind in resources for _, modified in bulkUpdate(
+            models[kind], resources[kind], metaUpdate))
 
 
 @access.admin(scope=TokenScope.SETTINGS_READ)
@@ -0,0 +1,145 @@
+"""
+Extend login sessions as they are used.
+
+When the login session expiry setting is set, each authenticated request
+pushes the expiry of its token further into the future.  Rather than saving
+the token during the request, extensions are rate limited per token and
+queued; a background thread writes the queued extensions periodically with a
+single bulk write.
+"""
+
+import datetime
+import threading
+import time
+
+import cachetools
+import pymongo
+from girder import logger
+from girder.models.setting import Setting
+from girder.models.token import Token
+
+from .constants import PluginSettings
+
+
+class SessionExtender:
+    """
+    Coalesce login token expiry extensions and write them in the background.
+    """
+
+    def __init__(self, maxsize=100000, interval=60, flushInterval=5):
+        """
+        :param maxsize: the maximum number of tokens whose last extension time
+            is tracked.  The least recently used tokens are forgotten first.
+        :param interval: the minimum time in seconds between extensions of a
+            single token.
+        :param flushInterval: how often in seconds queued extensions are
+            written to the database.
+        """
+        self.interval = interval
+        self.flushInterval = flushInterval
+        self._lastExtended = cachetools.LRUCache(maxsize=maxsize)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._expiry = None
+        #: The number of token expiry updates written to the database.
+        self.written = 0
+        #: The number of extensions that didn't need their own write.
+        self.coalesced = 0
+
+    def expiryDays(self):
+        """
+        Get the login session expiry from its setting.  The value is cached
+        until the setting is changed.
+
+        :returns: the expiry in days or None if sessions aren't extended.
+        """
+        if self._expiry is None:
+            minutes = Setting().get(PluginSettings.HUI_LOGIN_SESSION_EXPIRY_MINUTES)
+            self._expiry = (float(minutes) / 24 / 60 if minutes else False, )
+        return self._expiry[0] or None
+
+    def settingChanged(self, event=None):
+        """
+        Invalidate the cached expiry when its setting is saved or removed.
+        This is a handler for the ``model.setting.save.after`` and
+        ``model.setting.remove`` events.
+
+        :param event: the event.  If None, the cached expiry is always
+            invalidated.
+        """
+        if (event is None or
+                event.info.get('key') == PluginSettings.HUI_LOGIN_SESSION_EXPIRY_MINUTES):
+            self._expiry = None
+
+    def extend(self, token, now=None):
+        """
+        Queue an extension of a token's expiry if it hasn't been extended
+        recently.
+
+        :param token: the token document.
+        :param now: the current time as a timezone-aware datetime.  None to
+            use the current time.
+        :returns: True if an extension was queued.
+        """
+        days = self.expiryDays()
+        if not days:
+            return False
+        now = datetime.datetime.now(datetime.timezone.utc) if now is None else now
+        with self._lock:
+            last = self._lastExtended.get(token['_id'])
+            if last is not None and (now - last).total_seconds() < self.interval:
+                self.coalesced += 1
+                return False
+            self._lastExtended[token['_id']] = now
+            if token['_id'] in self._pending:
+                self.coalesced += 1
+            self._pending[token['_id']] = now + datetime.timedelta(days=days)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, daemon=True, name='HistomicsUI-sessions')
+                self._thread.start()
+        token['expires'] = now + datetime.timedelta(days=days)
+        return True
+
+    def flush(self):
+        """
+        Write queued extensions to the database.
+
+        :returns: the number of tokens updated.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        Token().collection.bulk_write([
+            pymongo.UpdateOne({'_id': tokenId}, {'$set': {'expires': expires}})
+            for tokenId, expires in pending.items()], ordered=False)
+        with self._lock:
+            self.written += len(pending)
+        logger.debug('Extended %d login session(s)', len(pending))
+        return len(pending)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flushInterval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to extend login sessions')
+
+    def counts(self):
+        """
+        Report how many extensions have been written and coalesced.
+
+        :returns: a dictionary with written, coalesced, and pending counts.
+        """
+        with self._lock:
+            return {
+                'written': self.written,
+                'coalesced': self.coalesced,
+                'pending': len(self._pending),
+            }
+
+
+sessionExtender = SessionExtender()
@@ -0,0 +1,378 @@
+"""
+Virtual folder queries and materialized item orderings.
+
+A virtual folder lists the items that match its ``virtualItemsQuery``.  Parsed
+queries are cached by their text.  When the materialize virtual folders
+setting is enabled, the order of the items of a virtual folder is also kept in
+memory as a sorted array of (sort key, item id) pairs.  An ordering is built
+with one projected query, kept current as items are saved and removed, and
+used to list, count, and find adjacent items without rerunning and sorting the
+folder's query.  Saved items are matched against each ordering's query in
+memory; if a query uses operators that can't be evaluated that way, the
+ordering is marked as stale and rebuilt the next time it is used.  Only sorts
+on keys that have a value of a single type in every item can be materialized.
+Items changed without a save event, such as with bulk updates, and changes
+made by other server processes are seen when an ordering expires.
+"""
+
+import bisect
+import copy
+import datetime
+import functools
+import threading
+
+import cachetools
+from bson import ObjectId, json_util
+from girder.models.item import Item
+from girder.models.setting import Setting
+
+from .constants import PluginSettings
+
+# Sort keys that have a value of the same type in every item, so items can be
+# ordered in memory or found with range queries.
+SORTABLE_KEYS = {'_id', 'name', 'lowerName', 'created', 'updated', 'size'}
+
+_queryCache = cachetools.LRUCache(maxsize=1000)
+_queryLock = threading.Lock()
+
+
+def virtualItemsQuery(folder):
+    """
+    Get the parsed query of a virtual folder.
+
+    :param folder: the virtual folder document.
+    :returns: the query.  This is a copy that can be modified.
+    """
+    text = folder['virtualItemsQuery']
+    with _queryLock:
+        query = _queryCache.get(text)
+    if query is None:
+        query = json_util.loads(text)
+        with _queryLock:
+            _queryCache[text] = query
+    return copy.deepcopy(query)
+
+
+_missing = object()
+
+
+def _fieldValue(doc, key):
+    for part in key.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return _missing
+        doc = doc[part]
+    return doc
+
+
+def _allMatch(results):
+    results = list(results)
+    return False if False in results else (None if None in results else True)
+
+
+def _anyMatch(results):
+    results = list(results)
+    return True if True in results else (None if None in results else False)
+
+
+def _comparable(value):
+    # Queries parsed from JSON have timezone-aware dates; stored dates are UTC
+    if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+        return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _equal(value, operand):
+    if isinstance(value, bool) != isinstance(operand, bool):
+        return False
+    return value == operand
+
+
+def _compare(op, value, operand):
+    operand = _comparable(operand)
+    if op == '$exists':
+        return (value is not _missing) == bool(operand)
+    # A null value matches a missing field
+    value = None if value is _missing else _comparable(value)
+    if op in {'$eq', '$ne'}:
+        return _equal(value, operand) == (op == '$eq')
+    if op in {'$in', '$nin'} and isinstance(operand, list):
+        found = any(_equal(value, _comparable(entry)) for entry in operand)
+        return found == (op == '$in')
+    if op in {'$gt', '$gte', '$lt', '$lte'}:
+        # Mongo only compares values of the same type
+        if value is None or type(value) is not type(operand) and not (
+                isinstance(value, (int, float)) and isinstance(operand, (int, float))):
+            return None
+        return {'$gt': value > operand, '$gte': value >= operand,
+                '$lt': value < operand, '$lte': value <= operand}[op]
+    return None
+
+
+def _fieldMatches(doc, key, condition):
+    value = _fieldValue(doc, key)
+    if isinstance(value, (list, dict)):
+        # Array and subdocument matching isn't evaluated
+        return None
+    if isinstance(condition, dict) and condition and all(
+            op.startswith('$') for op in condition):
+        return _allMatch(_compare(op, value, operand) for op, operand in condition.items())
+    if isinstance(condition, (dict, list)) or not isinstance(
+            condition, (str, int, float, bool, type(None), ObjectId, datetime.datetime)):
+        return None
+    return _compare('$eq', value, condition)
+
+
+def queryMatches(query, doc):
+    """
+    Check if a document matches a query without using the database.  Only
+    simple queries can be evaluated: field equality, the $eq, $ne, $exists,
+    $in, $nin, $gt, $gte, $lt, and $lte operators on scalar values, and $and
+    and $or.
+
+    :param query: a Mongo query.
+    :param doc: the document.
+    :returns: True if the document matches, False if it doesn't, or None if
+        the query can't be evaluated in memory.
+    """
+    try:
+        results = []
+        for key, condition in query.items():
+            if key in {'$and', '$or'} and isinstance(condition, list):
+                children = [queryMatches(child, doc) for child in condition]
+                results.append(_allMatch(children) if key == '$and' else _anyMatch(children))
+            elif key.startswith('$'):
+                results.append(None)
+            else:
+                results.append(_fieldMatches(doc, key, condition))
+        return _allMatch(results)
+    except (AttributeError, TypeError):
+        return None
+
+
+@functools.total_ordering
+class _Descending:
+    """
+    Wrap a value so that it sorts in reverse order.
+    """
+
+    __slots__ = ('value', )
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+class VirtualFolderOrdering:
+    """
+    The items of a virtual folder in sort order.
+    """
+
+    def __init__(self, query, sort):
+        """
+        :param query: the query for the items of the folder.
+        :param sort: a list of (key, direction) tuples.  Every key must be in
+            SORTABLE_KEYS.
+        """
+        self.query = query
+        self.sort = sort
+        self._fields = {key: True for key, _ in sort}
+        self._entries = []
+        self._keys = {}
+        self._lock = threading.Lock()
+        #: True if the ordering may be out of date and should be rebuilt.
+        self.stale = False
+
+    def _entry(self, item):
+        return (tuple(item[key] if direction == 1 else _Descending(item[key])
+                      for key, direction in self.sort), item['_id'])
+
+    def build(self):
+        """
+        Load the ordering from the database.
+
+        :returns: True if the ordering was built, False if some item doesn't
+            have a comparable value for every sort key.
+        """
+        try:
+            entries = sorted(self._entry(item) for item in Item().find(
+                self.query, fields=self._fields))
+        except (KeyError, TypeError):
+            return False
+        with self._lock:
+            self._entries = entries
+            self._keys = {entry[1]: entry for entry in entries}
+            self.stale = False
+        return True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def ids(self, offset=0, limit=0):
+        """
+        List item ids in order.
+
+        :param offset: the position of the first id.
+        :param limit: the maximum number of ids.  0 for all of them.
+        :returns: a list of item ids.
+        """
+        with self._lock:
+            return [entry[1] for entry in self._entries[offset:offset + limit if limit else None]]
+
+    def neighbors(self, itemId, count=1):
+        """
+        Get the items before and after an item, wrapping around at the ends.
+
+        :param itemId: the id of the item.
+        :param count: the maximum number of items in each direction.
+        :returns: a tuple of the position of the item, a list of the ids of
+            the items before it, and a list of the ids of the items after it,
+            both nearest first, or None if the item isn't in the ordering.
+        """
+        with self._lock:
+            entry = self._keys.get(itemId)
+            if entry is None:
+                return None
+            index = bisect.bisect_left(self._entries, entry)
+            total = len(self._entries)
+            offsets = range(1, min(count, total - 1) + 1)
+            return (
+                index,
+                [self._entries[(index - offset) % total][1] for offset in offsets],
+                [self._entries[(index + offset) % total][1] for offset in offsets])
+
+    def _discard(self, itemId):
+        entry = self._keys.pop(itemId, None)
+        if entry is not None:
+            del self._entries[bisect.bisect_left(self._entries, entry)]
+
+    def update(self, item):
+        """
+        Add, move, or remove an item after it has been saved.  The item is
+        matched against the ordering's query in memory.  If that isn't
+        possible, the ordering is marked as stale.
+
+        :param item: the complete item document.
+        """
+        match = queryMatches(self.query, item)
+        if match is False and item['_id'] not in self._keys:
+            return
+        if match is None:
+            self.stale = True
+            return
+        with self._lock:
+            self._discard(item['_id'])
+            if not match:
+                return
+            try:
+                entry = self._entry(item)
+                bisect.insort(self._entries, entry)
+            except (KeyError, TypeError):
+                self.stale = True
+                return
+            self._keys[entry[1]] = entry
+
+    def remove(self, itemId):
+        """
+        Remove an item.
+
+        :param itemId: the id of the item.
+        """
+        with self._lock:
+            self._discard(itemId)
+
+
+class VirtualFolderOrderings:
+    """
+    A cache of materialized virtual folder orderings.
+    """
+
+    def __init__(self, maxsize=100, ttl=600):
+        """
+        :param maxsize: the maximum number of orderings to keep.  Every
+            ordering's query is matched in memory when an item is saved.
+        :param ttl: the number of seconds an ordering is kept.
+        """
+        self._cache = cachetools.TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.RLock()
+        #: The number of orderings that were built.
+        self.builds = 0
+
+    def get(self, folder, sort, imagesOnly=False):
+        """
+        Get the materialized ordering of a virtual folder.
+
+        :param folder: the virtual folder document.
+        :param sort: a list of (key, direction) tuples.  Items are also sorted
+            by id.
+        :param imagesOnly: if True, only include large image items.
+        :returns: a VirtualFolderOrdering or None if the setting is disabled,
+            this isn't a virtual folder, or the sort can't be materialized.
+        """
+        if (not folder.get('isVirtual') or 'virtualItemsQuery' not in folder or
+                not Setting().get(PluginSettings.HUI_MATERIALIZE_VIRTUAL_FOLDERS)):
+            return None
+        sort = [(key, direction) for key, direction in sort]
+        if not all(key in SORTABLE_KEYS for key, _ in sort):
+            return None
+        if not any(key == '_id' for key, _ in sort):
+            sort.append(('_id', 1))
+        cacheKey = (folder['_id'], folder['virtualItemsQuery'], tuple(sort), imagesOnly)
+        with self._lock:
+            ordering = self._cache.get(cacheKey)
+            if ordering is not None and ordering.stale:
+                if not ordering.build():
+                    ordering = None
+                self.builds += 1
+                self._cache[cacheKey] = ordering
+            elif ordering is None and cacheKey not in self._cache:
+                query = virtualItemsQuery(folder)
+                if imagesOnly:
+                    query = {'$and': [query, {'largeImage.fileId': {'$ne': None}}]}
+                ordering = VirtualFolderOrdering(query, sort)
+                if not ordering.build():
+                    ordering = None
+                self.builds += 1
+                # Remember orderings that can't be built so they aren't retried
+                self._cache[cacheKey] = ordering
+        return ordering
+
+    def _orderings(self):
+        with self._lock:
+            return [ordering for ordering in self._cache.values() if ordering is not None]
+
+    def itemSaved(self, event):
+        """
+        Update orderings when an item is saved.  This is a handler for the
+        ``model.item.save.after`` event.
+
+        :param event: the event.
+        """
+        for ordering in self._orderings():
+            ordering.update(event.info)
+
+    def itemRemoved(self, event):
+        """
+        Update orderings when an item is removed.  This is a handler for the
+        ``model.item.remove`` event.
+
+        :param event: the event.
+        """
+        for ordering in self._orderings():
+            ordering.remove(event.info['_id'])
+
+    def clear(self, event=None):
+        """
+        Discard all orderings.
+
+        :param event: the event that triggered this or None.
+        """
+        with self._lock:
+            self._cache.clear()
+
+
+virtualFolderOrderings = VirtualFolderOrderings()
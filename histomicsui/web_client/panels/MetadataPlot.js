@@ -1,4 +1,4 @@
-/* global BUILD_TIMESTAMP */
+/* global PLOTLY_HASH */
 
 import $ from 'jquery';
 import _ from 'underscore';
@@ -710,7 +710,7 @@ var MetadataPlot = Panel.extend({
                 this.plottableDataPromise,
                 !window.Plotly
                     ? $.ajax({ // like $.getScript, but allow caching
-                        url: root + '/plugins/histomicsui/extra/plotly.js' + (BUILD_TIMESTAMP ? '?_=' + BUILD_TIMESTAMP : ''),
+                        url: root + '/plugins/histomicsui/extra/plotly.js?_=' + PLOTLY_HASH,
                         dataType: 'script',
                         cache: true
                     })
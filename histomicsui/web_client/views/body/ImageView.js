@@ -2,7 +2,7 @@
 import _ from 'underscore';
 import $ from 'jquery';
 
-import {restRequest} from '@girder/core/rest';
+import {getApiRoot, restRequest} from '@girder/core/rest';
 import {getCurrentUser} from '@girder/core/auth';
 import {AccessType} from '@girder/core/constants';
 import ItemModel from '@girder/core/models/ItemModel';
@@ -39,6 +39,11 @@ import View from '../View';
 import imageTemplate from '../../templates/body/image.pug';
 import '../../stylesheets/body/image.styl';
 
+// The number of lowest resolution levels of the next image to prefetch
+const PREFETCH_LEVELS = 3;
+// The maximum number of tiles to prefetch
+const PREFETCH_MAX_TILES = 32;
+
 var ImageView = View.extend({
     events: {
         'keydown .h-image-body': '_onKeyDown',
@@ -51,6 +56,7 @@ var ImageView = View.extend({
         this.viewerWidget = null;
         this._mouseClickQueue = [];
         this._openId = null;
+        this._prefetchedTiles = {};
         this._displayedRegion = null;
         this._currentMousePosition = null;
         this._selectElementsByRegionCanceled = false;
@@ -230,6 +236,7 @@ var ImageView = View.extend({
 
             this.viewerWidget.on('g:imageRendered', () => {
                 events.trigger('h:imageOpened', this.model);
+                this._prefetchAdjacentImages();
                 // store a reference to the underlying viewer
                 this.viewer = this.viewerWidget.viewer;
                 this.annotations._viewer = this.viewerWidget;
@@ -342,6 +349,16 @@ var ImageView = View.extend({
         this.model.clear({silent: true});
         delete this.model.parent;
         if (id) {
+            // Gather most of what is needed to show the image in one request
+            this._bootstrap = restRequest({
+                url: `histomicsui/bootstrap/${id}`,
+                error: null
+            }).then((resp) => {
+                if (resp && resp.settings) {
+                    HuiSettings.setSettings(resp.settings);
+                }
+                return resp;
+            }, () => null);
             this.model.set({_id: id}).fetch().then(() => {
                 this._setImageInput();
                 return null;
@@ -353,6 +370,85 @@ var ImageView = View.extend({
             events.trigger('h:imageOpened', null);
         }
     },
+    /**
+     * Get a value from the bootstrap response for the open image.
+     *
+     * @param {string} id The id of the image the value is for.
+     * @param {string} key The key in the bootstrap response.
+     * @returns {Promise} A promise that resolves to the value, or to
+     *      undefined if it isn't available.
+     */
+    _bootstrapValue(id, key) {
+        if (!this._bootstrap) {
+            return $.Deferred().resolve(undefined).promise();
+        }
+        return this._bootstrap.then((resp) => {
+            return resp && resp.item && resp.item._id === id ? resp[key] : undefined;
+        });
+    },
+    /**
+     * When the browser is idle, get the tile metadata of the images adjacent
+     * to the open image and warm the browser cache with the low resolution
+     * tiles of the next image, so paging to it doesn't start cold.
+     */
+    _prefetchAdjacentImages() {
+        const id = this.model.id;
+        const idle = window.requestIdleCallback || ((callback) => window.setTimeout(callback, 1000));
+        idle(() => {
+            if (!id || id !== this._openId) {
+                return;
+            }
+            const data = {prefetch: 1, includeIndex: false};
+            if (router.getQuery('folder')) {
+                data.folderId = router.getQuery('folder');
+            }
+            restRequest({
+                url: `item/${id}/adjacent_images`,
+                data: data,
+                error: null
+            }).done((resp) => {
+                this._prefetchedTiles = {};
+                (resp.previousImages || []).concat(resp.nextImages || []).forEach((entry) => {
+                    if (entry.tiles) {
+                        this._prefetchedTiles[entry.item._id] = entry.tiles;
+                    }
+                });
+                const next = (resp.nextImages || [])[0];
+                if (next && next.tiles && next.item._id !== id && id === this._openId) {
+                    idle(() => this._prefetchTiles(next.item, next.tiles));
+                }
+            });
+        });
+    },
+    /**
+     * Load the lowest resolution tiles of an image so that they are in the
+     * browser cache.  The urls match those used by the image viewer, which
+     * add the item's modification time as a cache buster.
+     *
+     * @param {object} item The image item.
+     * @param {object} tiles The tile metadata of the image.
+     */
+    _prefetchTiles(item, tiles) {
+        const updated = item.updated || item.created;
+        const query = updated ? `?_=${encodeURIComponent(updated.replace(/:/g, '-').replace(/\+/g, '_'))}` : '';
+        let count = 0;
+        for (let z = 0; z < Math.min(tiles.levels, PREFETCH_LEVELS); z += 1) {
+            const scale = Math.pow(2, tiles.levels - 1 - z);
+            const xTiles = Math.ceil(tiles.sizeX / scale / tiles.tileWidth);
+            const yTiles = Math.ceil(tiles.sizeY / scale / tiles.tileHeight);
+            for (let y = 0; y < yTiles; y += 1) {
+                for (let x = 0; x < xTiles; x += 1) {
+                    if (count >= PREFETCH_MAX_TILES) {
+                        return;
+                    }
+                    const img = new Image();
+                    img.crossOrigin = 'use-credentials';
+                    img.src = `${getApiRoot()}/item/${item._id}/tiles/zxy/${z}/${x}/${y}${query}`;
+                    count += 1;
+                }
+            }
+        }
+    },
     /**
      * Set any input image parameters to the currently open image.
      * The jobs endpoints expect file id's rather than item id's,
@@ -376,6 +472,15 @@ var ImageView = View.extend({
 
         // helper functions passed through promises
         var getItemFile = (itemId) => {
+            return this._bootstrapValue(itemId, 'file').then((file) => {
+                if (file) {
+                    return new FileModel(file);
+                }
+                return getItemFirstFile(itemId);
+            });
+        };
+
+        var getItemFirstFile = (itemId) => {
             return restRequest({
                 url: 'item/' + itemId + '/files',
                 data: {
@@ -391,8 +496,10 @@ var ImageView = View.extend({
         };
 
         var getTilesDef = (itemId) => {
-            return restRequest({
-                url: 'item/' + itemId + '/tiles'
+            return this._bootstrapValue(itemId, 'tiles').then((tiles) => {
+                return tiles || this._prefetchedTiles[itemId] || restRequest({
+                    url: 'item/' + itemId + '/tiles'
+                });
             }).then((tiles) => {
                 this.zoomWidget.setMaxMagnification(tiles.magnification || 20, this._increaseZoom2x, this._increaseZoom2xRange);
                 this.zoomWidget.render();
@@ -403,8 +510,13 @@ var ImageView = View.extend({
         };
 
         var getFileModel = (fileId) => {
-            return restRequest({
-                url: 'file/' + fileId
+            return this._bootstrapValue(this.model.id, 'file').then((file) => {
+                if (file && file._id === fileId) {
+                    return file;
+                }
+                return restRequest({
+                    url: 'file/' + fileId
+                });
             }).then((file) => {
                 return new FileModel(file);
             });
@@ -1744,8 +1856,13 @@ var ImageView = View.extend({
             this._folderConfig = {};
             this._hotkeys = {};
         }
-        restRequest({
-            url: `folder/${this.model.get('folderId')}/yaml_config/.histomicsui_config.yaml`
+        this._bootstrapValue(modelId, 'config').then((val) => {
+            if (val !== undefined) {
+                return val;
+            }
+            return restRequest({
+                url: `folder/${this.model.get('folderId')}/yaml_config/.histomicsui_config.yaml`
+            });
         }).done((val) => {
             $('body').attr('view-mode', (val || {}).viewMode || '');
             if (!val || this.model.id !== modelId) {
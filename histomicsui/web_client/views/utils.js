@@ -29,6 +29,18 @@ class HuiSettings {
         return HuiSettings._hui_settings;
     }
 
+    /**
+     * Use settings that were fetched as part of another request if settings
+     * haven't been fetched yet.
+     *
+     * @param {object} settings The public HistomicsUI settings.
+     */
+    static setSettings(settings) {
+        if (!HuiSettings._hui_settings) {
+            HuiSettings._hui_settings = $.Deferred().resolve(settings);
+        }
+    }
+
     static clearSettingsCache() {
         delete HuiSettings._hui_settings;
     }
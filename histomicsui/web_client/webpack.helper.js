@@ -1,3 +1,5 @@
+const crypto = require('crypto');
+const fs = require('fs');
 const path = require('path');
 
 const webpack = require('webpack');
@@ -6,15 +8,18 @@ const CopyWebpackPlugin = require('copy-webpack-plugin');
 const {VueLoaderPlugin} = require('vue-loader');
 
 module.exports = function (config) {
+    // the minified version fails in our test environment because
+    // plotly.min.js uses some modern javascript (plotly.js doesn't)
+    const plotlyPath = require.resolve(process.env.TOX_ENV_NAME ? 'plotly.js/dist/plotly.js' : 'plotly.js/dist/plotly.min.js');
+    // this matches the content hash the server uses for static assets
+    const plotlyHash = crypto.createHash('sha256').update(fs.readFileSync(plotlyPath)).digest('hex').substr(0, 16);
     config.plugins.push(
         new CopyWebpackPlugin([{
             from: path.join(path.resolve(__dirname), 'static'),
             to: config.output.path,
             toType: 'dir'
         }, {
-            // the minified version fails in our test environment because
-            // plotly.min.js uses some modern javascript (plotly.js doesn't)
-            from: require.resolve(process.env.TOX_ENV_NAME ? 'plotly.js/dist/plotly.js' : 'plotly.js/dist/plotly.min.js'),
+            from: plotlyPath,
             to: path.join(config.output.path, 'extra', 'plotly.js'),
             toType: 'file'
         }, {
@@ -24,7 +29,7 @@ module.exports = function (config) {
     );
     config.plugins.push(
         new webpack.DefinePlugin({
-            BUILD_TIMESTAMP: Date.now()
+            PLOTLY_HASH: JSON.stringify(plotlyHash)
         })
     );
     config.module.rules.push({
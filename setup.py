@@ -46,10 +46,14 @@ setup(
         'girder-large-image-annotation>=1.33.5',
         'girder-slicer-cli-web[girder]>=1.4.0',
         'cachetools',
+        'ijson',
+        'numpy',
         'orjson',
     ],
     extras_require={
         'analysis': [],  # kept for backwards compatibility
+        'brotli': ['brotli'],
+        'zstd': ['zstandard'],
     },
     license='Apache Software License 2.0',
     long_description=readme,
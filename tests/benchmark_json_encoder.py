@@ -0,0 +1,104 @@
+"""
+Compare the orjson-based REST response encoder with the previous encoder.
+
+Run this with ``python -m tests.benchmark_json_encoder`` from the repository
+root.  It encodes payloads shaped like an item listing and a large annotation
+with both encoders and reports the best time of several runs.
+"""
+
+import datetime
+import json
+import math
+import random
+import time
+
+import girder.utility
+from bson import ObjectId
+
+from histomicsui import handlers
+
+
+def legacyNan2None(obj):
+    # The conversion used before the orjson encoder; it rebuilds every
+    # container.
+    if isinstance(obj, dict):
+        return {k: legacyNan2None(v) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [legacyNan2None(v) for v in obj]
+    elif isinstance(obj, float) and (
+            math.isnan(obj) or obj == float('inf') or obj == -float('inf')):
+        return None
+    return obj
+
+
+class LegacyEncoder(json.JSONEncoder):
+    default = girder.utility.JsonEncoder.default
+
+    def encode(self, obj, *args, **kwargs):
+        return json.JSONEncoder.encode(self, legacyNan2None(obj), *args, **kwargs)
+
+
+class OrjsonEncoder(json.JSONEncoder):
+    default = girder.utility.JsonEncoder.default
+
+    def encode(self, obj, *args, **kwargs):
+        return handlers.orjsonEncode(self, obj)
+
+
+def itemListing(count=5000):
+    now = datetime.datetime.utcnow()
+    return [{
+        '_id': ObjectId(),
+        'name': 'slide_%05d.svs' % idx,
+        'folderId': ObjectId(),
+        'creatorId': ObjectId(),
+        'created': now,
+        'updated': now,
+        'size': random.randint(1, 10 ** 10),
+        'meta': {
+            'score': random.random() if idx % 10 else float('nan'),
+            'stain': 'HE',
+            'tags': ['a', 'b', 'c'],
+        },
+        'largeImage': {'fileId': ObjectId(), 'sourceName': 'openslide'},
+    } for idx in range(count)]
+
+
+def annotation(count=100000):
+    return {
+        '_id': ObjectId(),
+        'annotation': {
+            'name': 'Nuclei',
+            'elements': [{
+                'id': str(ObjectId()),
+                'type': 'polyline',
+                'closed': True,
+                'points': [[random.random() * 1e5, random.random() * 1e5, 0]
+                           for _ in range(8)],
+                'user': {'score': random.random()},
+            } for _ in range(count)],
+        },
+    }
+
+
+def bench(encoder, payload, repeats=5):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        json.dumps(payload, sort_keys=True, allow_nan=False, cls=encoder).encode('utf8')
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    random.seed(0)
+    for name, payload in (('item listing', itemListing()), ('annotation', annotation())):
+        legacy = bench(LegacyEncoder, payload)
+        current = bench(OrjsonEncoder, payload)
+        print('%-14s legacy %7.3fs  orjson %7.3fs  speedup %5.1fx' % (
+            name, legacy, current, legacy / current))
+
+
+if __name__ == '__main__':
+    main()
@@ -40,10 +40,12 @@ def uploadTestFile(fileName, user, assetstore, folderName='Public', name=None, r
         name=None, reference=reference)
 
 
-def uploadText(text, user, assetstore, folder, name):
+def uploadText(text, user, assetstore, folder, name, reference=None):
+    data = text.encode() if isinstance(text, str) else text
     file = Upload().uploadFromFile(
-        io.BytesIO(text.encode()), len(text), name,
-        parentType='folder', parent=folder, user=user, assetstore=assetstore)
+        io.BytesIO(data), len(data), name,
+        parentType='folder', parent=folder, user=user, assetstore=assetstore,
+        reference=reference)
     return file
 
 
@@ -1,15 +1,35 @@
 """Test annotation file and metadata handlers."""
 
+import datetime
+import gzip
 import json
+import os
 import time
 
+import girder.utility
+import large_image.config
+import numpy
 import pytest
+from bson import ObjectId
+from girder import events
+from girder.models.folder import Folder
 from girder.models.item import Item
+from girder.models.notification import Notification
+from girder.utility import config
+from girder_jobs.constants import JobStatus
+from girder_jobs.models.job import Job
 from girder_large_image_annotation.models.annotation import Annotation
+from girder_large_image_annotation.models.annotationelement import Annotationelement
+
+from histomicsui import handlers, identifiers, ingest
 
 from . import girder_utilities as utilities
 
 
+def recoveredIngestJob(job):
+    Job().updateJob(job, log='Recovered\n')
+
+
 @pytest.mark.plugin('histomicsui')
 class TestHUIHandlers:
     def testAnnotationHandler(self, server, fsAssetstore, admin):
@@ -119,3 +139,464 @@ class TestHUIHandlers:
                 break
             time.sleep(0.1)
         assert Annotation().findOne({'itemId': item['_id']}) is not None
+
+    def testAnnotationHandlerStreamed(self, server, fsAssetstore, admin):
+        histomicsuiConfig = config.getConfig().setdefault('histomicsui', {})
+        histomicsuiConfig.update({'annotation_stream_min_size': 0, 'annotation_batch_size': 1})
+        try:
+            file = utilities.uploadExternalFile('Easy1.png', admin, fsAssetstore)
+            item = Item().load(file['itemId'], user=admin)
+            utilities.uploadTestFile(
+                'sample.anot', admin, fsAssetstore, reference=json.dumps({
+                    'identifier': 'IsAnAnnotationFile',
+                    'userId': str(admin['_id']),
+                    'itemId': str(item['_id']),
+                    'fileId': str(file['_id']),
+                }))
+            starttime = time.time()
+            while time.time() < starttime + 10:
+                annot = Annotation().findOne({'itemId': item['_id']})
+                if annot is not None and annot.get('_elementCount'):
+                    break
+                time.sleep(0.1)
+            assert annot['_elementCount'] == 2
+            annot = Annotation().load(annot['_id'], force=True)
+            assert annot['annotation']['name'] == 'Sample'
+            assert len(annot['annotation']['elements']) == 2
+            # The group set is computed from the streamed elements
+            testDir = os.path.dirname(os.path.realpath(__file__))
+            with open(os.path.join(testDir, 'test_files', 'sample.anot')) as fptr:
+                fixtureGroups = {element.get('group') for element in json.load(fptr)['elements']}
+            assert annot['groups'] == sorted(
+                group for group in fixtureGroups if group is not None) + (
+                [None] if None in fixtureGroups else [])
+        finally:
+            histomicsuiConfig.pop('annotation_stream_min_size', None)
+            histomicsuiConfig.pop('annotation_batch_size', None)
+
+    def testAnnotationHandlerMultiple(self, server, fsAssetstore, admin):
+        file = utilities.uploadExternalFile('Easy1.png', admin, fsAssetstore)
+        item = Item().load(file['itemId'], user=admin)
+        utilities.uploadTestFile(
+            'sample_multiple.anot', admin, fsAssetstore, reference=json.dumps({
+                'identifier': 'IsAnAnnotationFile',
+                'userId': str(admin['_id']),
+                'itemId': str(item['_id']),
+                'fileId': str(file['_id']),
+            }))
+        starttime = time.time()
+        while time.time() < starttime + 10:
+            if Annotation().find({'itemId': item['_id']}).count() == 3:
+                break
+            time.sleep(0.1)
+        annots = list(Annotation().find({'itemId': item['_id']}, sort=[('annotation.name', 1)]))
+        assert [annot['annotation']['name'] for annot in annots] == [
+            'Cluster 1', 'Cluster 2', 'Cluster 3']
+        assert [annot['_elementCount'] for annot in annots] == [1, 2, 2]
+        annot = Annotation().load(annots[1]['_id'], force=True)
+        assert len(annot['annotation']['elements']) == 2
+        assert annot['annotation']['elements'][1]['type'] == 'polyline'
+
+    def testAnnotationHandlerJob(self, server, fsAssetstore, admin):
+        file = utilities.uploadExternalFile('Easy1.png', admin, fsAssetstore)
+        item = Item().load(file['itemId'], user=admin)
+        counts = handlers.EventModelCache.counts()
+        annotFile = utilities.uploadTestFile(
+            'sample.anot', admin, fsAssetstore, reference=json.dumps({
+                'identifier': 'IsAnAnnotationFile',
+                'userId': str(admin['_id']),
+                'itemId': str(item['_id']),
+                'fileId': str(file['_id']),
+            }))
+        starttime = time.time()
+        while time.time() < starttime + 10:
+            job = Job().findOne({
+                'type': 'histomicsui_ingest', 'kwargs.fileId': str(annotFile['_id'])})
+            if job and job['status'] in {JobStatus.SUCCESS, JobStatus.ERROR}:
+                break
+            time.sleep(0.1)
+        assert job['status'] == JobStatus.SUCCESS
+        assert job['userId'] == admin['_id']
+        assert job['progress']['current'] == 2
+        assert Annotation().findOne({'itemId': item['_id']}) is not None
+        # The item and folder are reused when checking access to the files
+        assert handlers.EventModelCache.counts()['hits'] >= counts['hits'] + 2
+
+    def testAnnotationWithLateGirderIdHandler(self, server, fsAssetstore, admin):
+        file = utilities.uploadExternalFile('Easy1.png', admin, fsAssetstore)
+        item = Item().load(file['itemId'], user=admin)
+        utilities.uploadExternalFile(
+            'Easy1.png', admin, fsAssetstore, reference=json.dumps({
+                'identifier': 'ImageRecord1',
+                'uuid': '12347',
+                'userId': str(admin['_id']),
+                'itemId': str(item['_id']),
+                'fileId': str(file['_id']),
+            }))
+        # The reference is past the first 100 elements
+        elements = [{'type': 'point', 'center': [idx, idx, 0]} for idx in range(150)]
+        elements.append({'type': 'image', 'girderId': 'ImageRecord1'})
+        utilities.uploadText(
+            json.dumps({'name': 'Late', 'elements': elements}), admin, fsAssetstore,
+            utilities.namedFolder(admin), 'late.anot', reference=json.dumps({
+                'identifier': 'IsAnAnnotationFile',
+                'uuid': '12347',
+                'userId': str(admin['_id']),
+                'itemId': str(item['_id']),
+                'fileId': str(file['_id']),
+            }))
+        starttime = time.time()
+        while time.time() < starttime + 10:
+            annot = Annotation().findOne({'itemId': item['_id']})
+            if annot is not None:
+                break
+            time.sleep(0.1)
+        annot = Annotation().load(annot['_id'], force=True)
+        imageElement = annot['annotation']['elements'][-1]
+        assert imageElement['type'] == 'image'
+        assert Item().load(imageElement['girderId'], force=True) is not None
+
+    def testMongoIdentifierRegistry(self, server):
+        # Two registries act like two separate Girder processes
+        registry1 = identifiers.MongoIdentifierRegistry()
+        registry2 = identifiers.MongoIdentifierRegistry()
+        info = {'file': {'_id': 'fileid', 'itemId': 'itemid'}}
+        assert registry1.lookup('batch', ['Image1']) is None
+        assert registry1.record('batch', 'Annotation1', info) == []
+        assert registry2.lookup('batch', ['Image1']) == {}
+        assert registry2.defer('batch', ['Image1'], {'kind': 'annotations'}) is True
+        assert registry1.record('batch', 'Image1', info) == [{'kind': 'annotations'}]
+        assert registry2.record('batch', 'Image2', info) == []
+        assert registry2.lookup('batch', ['Image1', 'Image2']) == {
+            'Image1': info, 'Image2': info}
+        assert registry2.defer('batch', ['Image1'], {'kind': 'annotations'}) is False
+
+    def testMetadataTableHandler(self, server, fsAssetstore, admin):
+        folder = utilities.namedFolder(admin)
+        item1 = Item().createItem('slide1.svs', admin, folder)
+        item2 = Item().createItem('slide2.svs', admin, folder)
+        subfolder = Folder().createFolder(folder, 'batch', creator=admin)
+        item3 = Item().createItem('slide3.svs', admin, subfolder)
+        table = '\n'.join([
+            'name,stain,score,note',
+            'slide1.svs,HE,3,',
+            '"slide2.svs",IHC,2.5,"has, comma"',
+            'missing.svs,HE,1,',
+        ]) + '\n'
+        tableFile = utilities.uploadText(
+            table, admin, fsAssetstore, folder, 'clinical.csv', reference=json.dumps({
+                'identifier': 'ClinicalItemMetadataTable',
+                'userId': str(admin['_id']),
+            }))
+        ndjson = '\n'.join([
+            json.dumps({'path': 'batch/slide3.svs', 'stain': 'HE', 'extra': {'a': 1}}),
+            json.dumps({'_id': str(item1['_id']), 'reviewed': True}),
+        ])
+        utilities.uploadText(
+            ndjson, admin, fsAssetstore, folder, 'more.ndjson', reference=json.dumps({
+                'identifier': 'MoreItemMetadataTable',
+                'userId': str(admin['_id']),
+            }))
+        starttime = time.time()
+        while time.time() < starttime + 10:
+            jobs = list(Job().find({
+                'type': 'histomicsui_ingest', 'kwargs.kind': 'metadata_table'}))
+            if len(jobs) == 2 and all(
+                    job['status'] in {JobStatus.SUCCESS, JobStatus.ERROR} for job in jobs):
+                break
+            time.sleep(0.1)
+        assert all(job['status'] == JobStatus.SUCCESS for job in jobs)
+        job = [job for job in jobs if job['kwargs']['fileId'] == str(tableFile['_id'])][0]
+        assert 'missing.svs' in ''.join(Job().load(job['_id'], force=True)['log'])
+        item1 = Item().load(item1['_id'], force=True)
+        assert item1['meta'] == {'stain': 'HE', 'score': 3, 'reviewed': True}
+        item2 = Item().load(item2['_id'], force=True)
+        assert item2['meta'] == {'stain': 'IHC', 'score': 2.5, 'note': 'has, comma'}
+        item3 = Item().load(item3['_id'], force=True)
+        assert item3['meta'] == {'stain': 'HE', 'extra': {'a': 1}}
+
+    def testMetadataTableNumericNames(self, server, fsAssetstore, admin):
+        folder = utilities.namedFolder(admin)
+        item1 = Item().createItem('12345', admin, folder)
+        item2 = Item().createItem('67890', admin, folder)
+        utilities.uploadText(
+            'name,score\n12345,3\n,4\n', admin, fsAssetstore, folder, 'scores.csv',
+            reference=json.dumps({
+                'identifier': 'ScoresItemMetadataTable',
+                'userId': str(admin['_id']),
+            }))
+        utilities.uploadText(
+            '\n'.join([
+                json.dumps({'name': 67890, 'stain': 'HE'}),
+                json.dumps({'stain': 'IHC'}),
+                'not json',
+            ]), admin, fsAssetstore, folder, 'stains.ndjson', reference=json.dumps({
+                'identifier': 'StainsItemMetadataTable',
+                'userId': str(admin['_id']),
+            }))
+        starttime = time.time()
+        while time.time() < starttime + 10:
+            jobs = list(Job().find({
+                'type': 'histomicsui_ingest', 'kwargs.kind': 'metadata_table'}))
+            if len(jobs) == 2 and all(
+                    job['status'] in {JobStatus.SUCCESS, JobStatus.ERROR} for job in jobs):
+                break
+            time.sleep(0.1)
+        # Bad rows are reported rather than failing the job
+        assert all(job['status'] == JobStatus.SUCCESS for job in jobs)
+        logs = ''.join(''.join(Job().load(job['_id'], force=True)['log']) for job in jobs)
+        assert 'row 3 (no name value)' in logs
+        assert 'row 2 (does not specify an item)' in logs
+        assert 'row 3 (not valid JSON)' in logs
+        assert Item().load(item1['_id'], force=True)['meta'] == {'score': 3}
+        assert Item().load(item2['_id'], force=True)['meta'] == {'stain': 'HE'}
+
+    def testAnnotationHandlerColumnar(self, server, fsAssetstore, admin, tmp_path):
+        file = utilities.uploadExternalFile('Easy1.png', admin, fsAssetstore)
+        item = Item().load(file['itemId'], user=admin)
+        path = str(tmp_path / 'nuclei.npz')
+        numpy.savez_compressed(
+            path,
+            name=numpy.array('Nuclei'),
+            point_center=numpy.array([[10, 20], [30, 40], [50, 60]]),
+            point_label=numpy.array(['a', '', 'b']),
+            polyline_coords=numpy.array([[0, 0], [10, 0], [10, 10], [20, 20], [30, 20]]),
+            polyline_offsets=numpy.array([0, 3, 5]),
+            polyline_closed=numpy.array([True, False]),
+            polyline_lineColor=numpy.array(['#ff0000', '']))
+        annotFile = utilities.uploadFile(path, admin, fsAssetstore, reference=json.dumps({
+            'identifier': 'IsAnAnnotationFile',
+            'userId': str(admin['_id']),
+            'itemId': str(item['_id']),
+            'fileId': str(file['_id']),
+        }))
+        starttime = time.time()
+        while time.time() < starttime + 10:
+            job = Job().findOne({
+                'type': 'histomicsui_ingest', 'kwargs.fileId': str(annotFile['_id'])})
+            if job and job['status'] in {JobStatus.SUCCESS, JobStatus.ERROR}:
+                break
+            time.sleep(0.1)
+        assert job['status'] == JobStatus.SUCCESS
+        annot = Annotation().load(
+            Annotation().findOne({'itemId': item['_id']})['_id'], user=admin)
+        assert annot['annotation']['name'] == 'Nuclei'
+        elements = annot['annotation']['elements']
+        assert len(elements) == 5
+        points = [element for element in elements if element['type'] == 'point']
+        assert points[0]['center'] == [10, 20, 0]
+        assert points[0]['label'] == {'value': 'a'}
+        assert 'label' not in points[1]
+        lines = [element for element in elements if element['type'] == 'polyline']
+        assert lines[0]['points'] == [[0, 0, 0], [10, 0, 0], [10, 10, 0]]
+        assert lines[0]['closed'] is True
+        assert lines[0]['lineColor'] == '#ff0000'
+        assert lines[1]['closed'] is False
+
+    def testAnnotationHandlerCompressed(self, server, fsAssetstore, admin):
+        file = utilities.uploadExternalFile('Easy1.png', admin, fsAssetstore)
+        item = Item().load(file['itemId'], user=admin)
+        with open(os.path.join(
+                os.path.dirname(__file__), 'test_files', 'sample.anot'), 'rb') as fptr:
+            data = gzip.compress(fptr.read())
+        annotFile = utilities.uploadText(
+            data, admin, fsAssetstore, utilities.namedFolder(admin), 'sample.anot.gz',
+            reference=json.dumps({
+                'identifier': 'IsAnAnnotationFile',
+                'userId': str(admin['_id']),
+                'itemId': str(item['_id']),
+                'fileId': str(file['_id']),
+            }))
+        starttime = time.time()
+        while time.time() < starttime + 10:
+            job = Job().findOne({
+                'type': 'histomicsui_ingest', 'kwargs.fileId': str(annotFile['_id'])})
+            if job and job['status'] in {JobStatus.SUCCESS, JobStatus.ERROR}:
+                break
+            time.sleep(0.1)
+        assert job['status'] == JobStatus.SUCCESS
+        annot = Annotation().load(
+            Annotation().findOne({'itemId': item['_id']})['_id'], force=True)
+        assert annot['annotation']['name'] == 'Sample'
+        assert len(annot['annotation']['elements']) == 2
+
+    def testAnnotationHandlerCompressionLimit(self, server, fsAssetstore, admin):
+        file = utilities.uploadExternalFile('Easy1.png', admin, fsAssetstore)
+        item = Item().load(file['itemId'], user=admin)
+        data = gzip.compress(b'[' + b' ' * 10 ** 7 + b']')
+        large_image.config.setConfig('max_annotation_input_file_length', 100000)
+        try:
+            annotFile = utilities.uploadText(
+                data, admin, fsAssetstore, utilities.namedFolder(admin), 'bomb.anot.gz',
+                reference=json.dumps({
+                    'identifier': 'IsAnAnnotationFile',
+                    'userId': str(admin['_id']),
+                    'itemId': str(item['_id']),
+                    'fileId': str(file['_id']),
+                }))
+            starttime = time.time()
+            while time.time() < starttime + 10:
+                job = Job().findOne({
+                    'type': 'histomicsui_ingest', 'kwargs.fileId': str(annotFile['_id'])})
+                if job and job['status'] in {JobStatus.SUCCESS, JobStatus.ERROR}:
+                    break
+                time.sleep(0.1)
+        finally:
+            large_image.config.setConfig('max_annotation_input_file_length', 1024 ** 3)
+        assert job['status'] == JobStatus.ERROR
+        assert 'Decompressed file is larger' in ''.join(Job().load(job['_id'], force=True)['log'])
+        assert Annotation().findOne({'itemId': item['_id']}) is None
+
+    def testAnnotationHandlerDuplicate(self, server, fsAssetstore, admin):
+        file = utilities.uploadExternalFile('Easy1.png', admin, fsAssetstore)
+        item = Item().load(file['itemId'], user=admin)
+        reference = json.dumps({
+            'identifier': 'IsAnAnnotationFile',
+            'userId': str(admin['_id']),
+            'itemId': str(item['_id']),
+            'fileId': str(file['_id']),
+        })
+
+        def uploadAndWait():
+            annotFile = utilities.uploadTestFile(
+                'sample.anot', admin, fsAssetstore, reference=reference)
+            starttime = time.time()
+            while time.time() < starttime + 10:
+                job = Job().findOne({
+                    'type': 'histomicsui_ingest', 'kwargs.fileId': str(annotFile['_id'])})
+                if job and job['status'] in {JobStatus.SUCCESS, JobStatus.ERROR}:
+                    break
+                time.sleep(0.1)
+            assert job['status'] == JobStatus.SUCCESS
+            return list(Annotation().find({'itemId': item['_id'], '_active': {'$ne': False}}))
+
+        first = uploadAndWait()
+        assert len(first) == 1
+        # An identical file is skipped
+        assert [annot['_id'] for annot in uploadAndWait()] == [first[0]['_id']]
+        histomicsuiConfig = config.getConfig().setdefault('histomicsui', {})
+        histomicsuiConfig['annotation_duplicates'] = 'replace'
+        try:
+            replaced = uploadAndWait()
+        finally:
+            histomicsuiConfig.pop('annotation_duplicates', None)
+        # Annotations are replaced in place, keeping their ids
+        assert len(replaced) == 1
+        assert replaced[0]['_id'] == first[0]['_id']
+        assert replaced[0]['_version'] > first[0]['_version']
+        assert replaced[0]['_elementCount'] == first[0]['_elementCount']
+        assert Annotationelement().collection.count_documents(
+            {'annotationId': first[0]['_id']}) == first[0]['_elementCount']
+
+    def testJsonEncoder(self, server):
+        doc = {
+            '_id': ObjectId('5f0000000000000000000000'),
+            'created': datetime.datetime(2024, 1, 2, 3, 4, 5),
+            'values': [1.5, float('nan'), float('inf'), -float('inf')],
+            'nested': {'tags': {'a'}, 'value': float('nan')},
+            'count': 3,
+        }
+        result = json.loads(json.dumps(doc, sort_keys=True, allow_nan=False,
+                                       cls=girder.utility.JsonEncoder))
+        assert result == {
+            '_id': '5f0000000000000000000000',
+            'created': '2024-01-02T03:04:05+00:00',
+            'values': [1.5, None, None, None],
+            'nested': {'tags': ['a'], 'value': None},
+            'count': 3,
+        }
+        # Values orjson can't encode use the standard library encoder
+        doc['count'] = 2 ** 70
+        result = json.loads(json.dumps(doc, sort_keys=True, allow_nan=False,
+                                       cls=girder.utility.JsonEncoder))
+        assert result['count'] == 2 ** 70
+        assert result['values'] == [1.5, None, None, None]
+        # Indented output is unchanged
+        result = json.dumps({'b': float('nan'), 'a': 1}, indent=4, sort_keys=True,
+                            allow_nan=False, cls=girder.utility.JsonEncoder)
+        assert result == '{\n    "a": 1,\n    "b": null\n}'
+
+    def testBulkCreateAnnotations(self, server, admin, monkeypatch):
+        item = Item().createItem('bulk', admin, utilities.namedFolder(admin))
+
+        def annotations():
+            return [{'name': 'a%d' % idx, 'elements': [
+                {'type': 'point', 'center': [idx, idx, 0]}]} for idx in range(3)]
+
+        def preventA1(event):
+            if event.info['annotation']['name'] == 'a1':
+                event.preventDefault()
+
+        with events.bound('model.annotation.save', 'test', preventA1):
+            created = ingest.bulkCreateAnnotations(item, admin, annotations(), batchSize=1)
+        assert [doc['annotation']['name'] for doc in created] == ['a0', 'a2']
+        assert Annotation().collection.count_documents({'itemId': item['_id']}) == 2
+        assert Notification().collection.count_documents({
+            'type': 'large_image_annotation.create', 'data.itemId': item['_id']}) == 2
+        # If storing the annotation documents fails, their elements are removed
+        elementCount = Annotationelement().collection.count_documents({})
+
+        def failInsert(*args, **kwargs):
+            msg = 'insert failed'
+            raise ValueError(msg)
+
+        monkeypatch.setattr(Annotation().collection, 'insert_many', failInsert)
+        with pytest.raises(ValueError):
+            ingest.bulkCreateAnnotations(item, admin, annotations())
+        assert Annotationelement().collection.count_documents({}) == elementCount
+        assert Annotation().collection.count_documents({'itemId': item['_id']}) == 2
+
+    def testRecoverIngestJobs(self, server, admin):
+        jobs = []
+        for status in (JobStatus.QUEUED, JobStatus.RUNNING):
+            job = Job().createLocalJob(
+                module='tests.test_handlers', function='recoveredIngestJob', kwargs={},
+                title='Ingest', user=admin, type='histomicsui_ingest', asynchronous=True)
+            job = Job().updateJob(job, status=JobStatus.QUEUED)
+            if status == JobStatus.RUNNING:
+                job = Job().updateJob(job, status=JobStatus.RUNNING)
+            jobs.append(job)
+        ingest.recoverIngestJobs()
+        starttime = time.time()
+        while time.time() < starttime + 10:
+            queued = Job().load(jobs[0]['_id'], force=True)
+            if queued['status'] in {JobStatus.SUCCESS, JobStatus.ERROR}:
+                break
+            time.sleep(0.1)
+        # Jobs that hadn't started are run; ones that were running have failed
+        assert queued['status'] == JobStatus.SUCCESS
+        assert 'Recovered\n' in queued['log']
+        running = Job().load(jobs[1]['_id'], force=True)
+        assert running['status'] == JobStatus.ERROR
+        assert 'server restart' in ''.join(running['log'])
+
+    def testRecoverIngestJobsOtherProcess(self, server, admin):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        owner = {'host': 'other-host', 'pid': 1, 'boot': 'other-boot'}
+        jobs = {}
+        for key, status, heartbeat in (
+                ('running', JobStatus.RUNNING, now),
+                ('queued', JobStatus.QUEUED, now),
+                ('stale', JobStatus.RUNNING, now - datetime.timedelta(hours=1))):
+            job = Job().createLocalJob(
+                module='tests.test_handlers', function='recoveredIngestJob', kwargs={},
+                title='Ingest', user=admin, type='histomicsui_ingest', asynchronous=True)
+            job = Job().updateJob(job, status=JobStatus.QUEUED)
+            if status == JobStatus.RUNNING:
+                job = Job().updateJob(job, status=JobStatus.RUNNING)
+            jobs[key] = Job().updateJob(job, otherFields={
+                'ingestOwner': owner, 'ingestHeartbeat': heartbeat})
+        ingest.recoverIngestJobs()
+        time.sleep(0.5)
+        # Jobs held by a live process are left alone
+        running = Job().load(jobs['running']['_id'], force=True)
+        assert running['status'] == JobStatus.RUNNING
+        assert running['ingestOwner'] == owner
+        queued = Job().load(jobs['queued']['_id'], force=True)
+        assert queued['status'] == JobStatus.QUEUED
+        assert queued['ingestOwner'] == owner
+        assert 'Recovered\n' not in queued['log']
+        # A job whose owner stopped updating its heartbeat has failed
+        stale = Job().load(jobs['stale']['_id'], force=True)
+        assert stale['status'] == JobStatus.ERROR
+        assert 'server restart' in ''.join(stale['log'])
@@ -1,18 +1,32 @@
 """Test histomicsui endpoints"""
 
+import base64
+import datetime
+import gzip
 import json
 
+import pymongo.collection
+import pymongo.errors
 import pytest
+from bson import json_util
+from girder.constants import AccessType
 from girder.exceptions import ValidationException
 from girder.models.collection import Collection
 from girder.models.folder import Folder
 from girder.models.group import Group
 from girder.models.item import Item
 from girder.models.setting import Setting
+from girder.models.token import Token
 from girder.models.user import User
 from girder.utility import config
+from girder_jobs.constants import JobStatus
+from girder_jobs.models.job import Job
+from girder_large_image_annotation.models.annotation import Annotation
 
+import histomicsui
+from histomicsui import assets, folder_config, sessions
 from histomicsui.constants import PluginSettings
+from histomicsui.rest import query_guard, system
 
 from . import girder_utilities as utilities
 
@@ -106,6 +120,85 @@ class TestHUIResourceAndItem:
         assert utilities.respStatus(resp) == 400
         assert 'Resource not found' in resp.json['message']
 
+    def testResourceItemsFlat(self, server, admin, user):
+        self.makeResources(admin)
+        # Items of all folders are listed in a single order
+        resp = server.request(
+            path='/resource/%s/items' % self.collection['_id'], user=admin,
+            params={'type': 'collection', 'flat': True, 'sort': 'name', 'sortdir': -1})
+        assert utilities.respStatus(resp) == 200
+        assert [item['name'] for item in resp.json] == [
+            'item C3', 'item C2', 'item C1', 'item B2', 'item B1', 'item A1']
+        # Page with cursors
+        names = []
+        params = {'type': 'collection', 'flat': True, 'limit': 4, 'sort': 'name'}
+        while True:
+            resp = server.request(
+                path='/resource/%s/items' % self.collection['_id'], user=admin, params=params)
+            assert utilities.respStatus(resp) == 200
+            names.extend(item['name'] for item in resp.json)
+            if 'Girder-Next-Cursor' not in resp.headers:
+                break
+            params['cursor'] = resp.headers['Girder-Next-Cursor']
+        assert names == [
+            'item A1', 'item B1', 'item B2', 'item C1', 'item C2', 'item C3']
+        # Folders the user can't read are skipped
+        resp = server.request(
+            path='/resource/%s/items' % admin['_id'], user=user,
+            params={'type': 'user', 'flat': True, 'sort': 'name'})
+        assert utilities.respStatus(resp) == 200
+        assert [item['name'] for item in resp.json] == [
+            'item D1', 'item D2', 'item Public 1']
+        # A cursor must match the sort
+        resp = server.request(
+            path='/resource/%s/items' % self.collection['_id'], user=admin,
+            params={'type': 'collection', 'cursor': params['cursor'], 'sort': 'created'})
+        assert utilities.respStatus(resp) == 400
+        assert 'Invalid cursor' in resp.json['message']
+        # Cursor values can't be query operators
+        for value in ({'$ne': None}, ['item'], 5):
+            cursor = base64.urlsafe_b64encode(json_util.dumps(
+                [['name', 1, value], ['_id', 1, self.colItemA1['_id']]]).encode()).decode()
+            resp = server.request(
+                path='/resource/%s/items' % self.collection['_id'], user=admin,
+                params={'type': 'collection', 'cursor': cursor, 'sort': 'name'})
+            assert utilities.respStatus(resp) == 400
+
+    def testChildMetadata(self, server, admin, user):
+        self.makeResources(admin)
+        Folder().setMetadata(self.colFolderC, {'stain': 'HE'})
+        Item().setMetadata(self.colItemC1, {'score': float('nan')})
+        Item().setMetadata(self.colItemB1, {'score': 2})
+        Item().setMetadata(self.itemPriv1, {'private': True})
+        resp = server.request(
+            path='/histomicsui/child_metadata/%s' % self.collection['_id'],
+            user=admin, params={'type': 'collection'})
+        assert utilities.respStatus(resp) == 200
+        assert resp.json == {
+            str(self.colFolderC['_id']): {'stain': 'HE'},
+            str(self.colItemC1['_id']): {'score': None},
+            str(self.colItemB1['_id']): {'score': 2},
+        }
+        resp = server.request(
+            path='/histomicsui/child_metadata/%s' % self.colFolderA['_id'],
+            user=admin, params={'type': 'folder', 'format': 'ndjson'}, isJson=False)
+        assert utilities.respStatus(resp) == 200
+        assert resp.headers['Content-Type'] == 'application/x-ndjson'
+        lines = [json.loads(line) for line in utilities.getBody(resp).splitlines()]
+        assert sorted(lines, key=lambda line: line['type']) == [{
+            'id': str(self.colFolderC['_id']), 'type': 'folder',
+            'parentId': str(self.colFolderA['_id']), 'meta': {'stain': 'HE'},
+        }, {
+            'id': str(self.colItemC1['_id']), 'type': 'item',
+            'parentId': str(self.colFolderC['_id']), 'meta': {'score': None},
+        }]
+        # Folders the user can't read are skipped
+        resp = server.request(
+            path='/histomicsui/child_metadata/%s' % admin['_id'],
+            user=user, params={'type': 'user'})
+        assert utilities.respStatus(resp) == 200
+        assert resp.json == {}
+
     def testItemQuery(self, server, admin, user):
         self.makeResources(admin)
         itemMeta = [
@@ -146,6 +239,87 @@ class TestHUIResourceAndItem:
         items = resp.json
         assert len(items) == 1
 
+    def testItemQueryPushdown(self, server, admin, user, monkeypatch):
+        self.makeResources(admin)
+        for folder in (self.publicFolder, self.privateFolder, self.folderD):
+            for idx in range(3):
+                item = Item().createItem('meta item %d' % idx, admin, folder)
+                Item().setMetadata(item, {'index': idx})
+        params = {'query': json.dumps({'meta.index': {'$gte': 1}}), 'sort': 'name'}
+        resp = server.request(path='/item/query', user=user, params=params)
+        assert utilities.respStatus(resp) == 200
+        pushdown = sorted((item['folderId'], item['name']) for item in resp.json)
+        assert len(pushdown) == 4
+        assert str(self.privateFolder['_id']) not in {folderId for folderId, _ in pushdown}
+        # Users that can read too many folders get the same results without
+        # the pushdown
+        monkeypatch.setattr(system, 'MAX_PUSHDOWN_FOLDERS', 1)
+        assert system.readableFolderIds(user) is None
+        resp = server.request(path='/item/query', user=user, params=params)
+        assert utilities.respStatus(resp) == 200
+        assert sorted((item['folderId'], item['name']) for item in resp.json) == pushdown
+
+    def testQueryGuardrails(self, server, admin, user, monkeypatch):
+        self.makeResources(admin)
+        for idx in range(3):
+            item = Item().createItem('meta item %d' % idx, admin, self.publicFolder)
+            Item().setMetadata(item, {'key1': 'value1'})
+        params = {'query': json.dumps({'meta.key1': 'value1'}), 'limit': 0}
+        resp = server.request(path='/item/query', user=admin, params=params)
+        assert utilities.respStatus(resp) == 200
+        assert len(resp.json) == 3
+        # A limit of 0 is capped at the maximum and the client is told
+        assert resp.headers['Girder-Limit-Capped'] == '10000'
+        resp = server.request(path='/item/query', user=admin, params=dict(params, limit=3))
+        assert 'Girder-Limit-Capped' not in resp.headers
+        curConfig = config.getConfig()['histomicsui']
+        monkeypatch.setitem(curConfig, 'query_max_limit', 2)
+        resp = server.request(path='/item/query', user=admin, params=params)
+        assert utilities.respStatus(resp) == 200
+        assert len(resp.json) == 2
+        assert resp.headers['Girder-Limit-Capped'] == '2'
+        # Collection scans are rejected for non-admin users
+        monkeypatch.setitem(curConfig, 'query_explain_min_documents', 1)
+        monkeypatch.setattr(system, 'MAX_PUSHDOWN_FOLDERS', 0)
+        resp = server.request(path='/item/query', user=user, params=params)
+        assert utilities.respStatus(resp) == 400
+        assert 'scan every item' in resp.json['message']
+        resp = server.request(path='/item/query', user=admin, params=params)
+        assert utilities.respStatus(resp) == 200
+        resp = server.request(path='/item/query', user=user, params={
+            'query': json.dumps({'name': 'meta item 1'})})
+        assert utilities.respStatus(resp) == 200
+        assert len(resp.json) == 1
+        assert query_guard.queryShape({
+            'meta.key1': {'$in': ['a', 'b']}, '$or': [{'name': 'x'}, {'name': 'y'}],
+        }) == {'meta.key1': {'$in': ['?']}, '$or': [{'name': '?'}]}
+
+    def testQueryCountTimeout(self, server, admin, monkeypatch):
+        self.makeResources(admin)
+        for idx in range(3):
+            item = Item().createItem('meta item %d' % idx, admin, self.publicFolder)
+            Item().setMetadata(item, {'key1': 'value1'})
+        params = {'query': json.dumps({'meta.key1': 'value1'})}
+        resp = server.request(path='/item/query', user=admin, params=params)
+        assert utilities.respStatus(resp) == 200
+        assert resp.headers['Girder-Total-Count'] == '3'
+        counts = []
+
+        def slowCount(self, filter, **kwargs):
+            counts.append(kwargs)
+            msg = 'operation exceeded time limit'
+            raise pymongo.errors.ExecutionTimeout(msg)
+
+        monkeypatch.setattr(pymongo.collection.Collection, 'count_documents', slowCount)
+        monkeypatch.setitem(config.getConfig()['histomicsui'], 'query_max_time_ms', 500)
+        # The count is limited to the query time and omitted if it takes too
+        # long
+        resp = server.request(path='/item/query', user=admin, params=params)
+        assert utilities.respStatus(resp) == 200
+        assert len(resp.json) == 3
+        assert 'Girder-Total-Count' not in resp.headers
+        assert counts == [{'maxTimeMS': 500}]
+
     def testFolderQuery(self, server, admin, user):
         self.makeResources(admin)
         resp = server.request(
@@ -218,6 +392,55 @@ class TestHUIResourceAndItem:
         assert meta['keyb']['keyc'] is None
         assert meta['keyb']['keyd'] == 'valued'
 
+    def testResourceMetadataBulk(self, server, admin, user, monkeypatch):
+        self.makeResources(admin)
+        monkeypatch.setattr(system, 'METADATA_CHUNK_SIZE', 1)
+        items = [str(self.colItemB1['_id']), str(self.colItemB2['_id'])]
+        # Without write access, nothing is changed
+        resp = server.request(
+            method='PUT', path='/resource/metadata', user=user, params={
+                'resources': json.dumps({'item': items + [str(self.colItemA1['_id'])]}),
+                'metadata': json.dumps({'keya': 'valuea'})})
+        assert utilities.respStatus(resp) == 403
+        assert 'keya' not in Item().load(self.colItemB1['_id'], force=True).get('meta', {})
+        # Access to items comes from their folders
+        Folder().setUserAccess(self.colFolderB, user, AccessType.WRITE, save=True)
+        resp = server.request(
+            method='PUT', path='/resource/metadata', user=user, params={
+                'resources': json.dumps({'item': items}),
+                'metadata': json.dumps({'keya': 'valuea'})})
+        assert utilities.respStatus(resp) == 200
+        assert resp.json == 2
+        assert Item().load(self.colItemB2['_id'], force=True)['meta']['keya'] == 'valuea'
+        resp = server.request(
+            method='PUT', path='/resource/metadata', user=user, params={
+                'resources': json.dumps({'folder': [str(self.colFolderA['_id'])]}),
+                'metadata': json.dumps({'keya': 'valuea'})})
+        assert utilities.respStatus(resp) == 403
+        resp = server.request(
+            method='PUT', path='/resource/metadata', user=admin, params={
+                'resources': json.dumps({'item': [str(self.colFolderA['_id'])]}),
+                'metadata': json.dumps({'keya': 'valuea'})})
+        assert utilities.respStatus(resp) == 400
+        # Large sets can be changed in a job
+        monkeypatch.setattr(Job, 'scheduleJob', lambda self, job: job)
+        resp = server.request(
+            method='PUT', path='/resource/metadata', user=user, params={
+                'resources': json.dumps({'item': items}),
+                'metadata': json.dumps({'keya': None, 'keyb': 'valueb'}),
+                'asynchronous': True})
+        assert utilities.respStatus(resp) == 200
+        assert resp.json['type'] == 'histomicsui_resource_metadata'
+        assert 'keya' in Item().load(self.colItemB1['_id'], force=True)['meta']
+        system.setResourceMetadataJob(Job().load(resp.json['_id'], force=True))
+        job = Job().load(resp.json['_id'], force=True)
+        assert job['status'] == JobStatus.SUCCESS
+        assert job['progress']['current'] == job['progress']['total'] == 2
+        for itemId in items:
+            meta = Item().load(itemId, force=True)['meta']
+            assert 'keya' not in meta
+            assert meta['keyb'] == 'valueb'
+
 
 @pytest.mark.plugin('histomicsui')
 class TestHUIEndpoints:
@@ -256,6 +479,22 @@ class TestHUIEndpoints:
             settings = resp.json
             assert json.loads(settings[key]) == value
 
+    def testHUISettingsETag(self, server):
+        resp = server.request(path='/histomicsui/settings')
+        assert utilities.respStatus(resp) == 200
+        etag = resp.headers['ETag']
+        resp = server.request(
+            path='/histomicsui/settings', isJson=False,
+            additionalHeaders=[('If-None-Match', etag)])
+        assert utilities.respStatus(resp) == 304
+        # Changing a setting invalidates the cached settings
+        Setting().set(PluginSettings.HUI_BRAND_NAME, 'Tagged')
+        resp = server.request(
+            path='/histomicsui/settings', additionalHeaders=[('If-None-Match', etag)])
+        assert utilities.respStatus(resp) == 200
+        assert resp.json[PluginSettings.HUI_BRAND_NAME] == 'Tagged'
+        assert resp.headers['ETag'] != etag
+
     def testGeneralSettings(self, server, admin, user):
         self.makeResources(admin)
         settings = [{
@@ -334,6 +573,143 @@ class TestHUIEndpoints:
         body = utilities.getBody(resp)
         assert '<title>Alternate</title>' in body
 
+    def testWebrootCache(self, server, tmp_path, monkeypatch):
+        (tmp_path / 'a.css').write_text('body {}')
+        (tmp_path / 'b.js').write_text('var b;')
+        monkeypatch.setattr(assets, '_manifest', assets.AssetManifest(str(tmp_path)))
+
+        class Root:
+            vars = {'plugins': []}
+            renders = 0
+
+            def _renderHTML(self):
+                self.renders += 1
+                return ('<link rel="stylesheet" href="/static/built/a.css">'
+                        '<script src="/static/built/b.js"></script>%d' % self.renders)
+
+        root = Root()
+        histomicsui.betterInvalidateJSandCSSCaches(root)
+        body = root._renderHTML()
+        cssHash = assets.assetHash(str(tmp_path / 'a.css'))
+        jsHash = assets.assetHash(str(tmp_path / 'b.js'))
+        assert '<link rel="stylesheet" href="/static/built/a.css?_=%s">' % cssHash in body
+        assert '<script src="/static/built/b.js?_=%s">' % jsHash in body
+        assert (tmp_path / assets.MANIFEST_NAME).exists()
+        assert root._renderHTML() == body
+        assert root.renders == 1
+        Setting().set(PluginSettings.HUI_BRAND_NAME, 'Cached')
+        body = root._renderHTML()
+        assert root.renders == 2
+        # The built assets are checked again after the check interval
+        (tmp_path / 'b.js').write_text('var b = 1;')
+        root._renderHTML()
+        assert root.renders == 2
+        root._htmlCache['checked'] -= histomicsui.WEBROOT_BUILD_CHECK_INTERVAL
+        body = root._renderHTML()
+        assert root.renders == 3
+        assert '<link rel="stylesheet" href="/static/built/a.css?_=%s">' % cssHash in body
+        assert jsHash not in body
+
+    def testAssetPrecompression(self, server, tmp_path):
+        (tmp_path / 'plugins' / 'histomicsui').mkdir(parents=True)
+        (tmp_path / 'girder_lib.min.js').write_text('var a = 1;\n' * 1000)
+        (tmp_path / 'plugins' / 'histomicsui' / 'plugin.min.js').write_text('var b;')
+        (tmp_path / 'plugins' / 'histomicsui' / 'favicon.png').write_bytes(b'png')
+        manifest = assets.AssetManifest(str(tmp_path))
+        for relpath in assets.webrootAssets(['histomicsui']):
+            manifest.hash(relpath)
+        assert set(manifest.entries) == {
+            'girder_lib.min.js', 'plugins/histomicsui/plugin.min.js',
+            'plugins/histomicsui/favicon.png'}
+        written = manifest.precompress()
+        assert written == (4 if assets.brotli else 2)
+        assert gzip.decompress((tmp_path / 'girder_lib.min.js.gz').read_bytes()) == (
+            tmp_path / 'girder_lib.min.js').read_bytes()
+        assert not (tmp_path / 'plugins' / 'histomicsui' / 'favicon.png.gz').exists()
+        assert manifest.precompress() == 0
+        # A saved manifest is reused
+        assert assets.AssetManifest(str(tmp_path)).current('girder_lib.min.js') == \
+            manifest.current('girder_lib.min.js')
+
+    def testBootstrap(self, server, fsAssetstore, admin):
+        file = utilities.uploadExternalFile('Easy1.png', admin, fsAssetstore)
+        item = Item().load(file['itemId'], force=True)
+        Annotation().createAnnotation(item, admin, {'name': 'sample', 'elements': []})
+        path = '/histomicsui/bootstrap/%s' % item['_id']
+        resp = server.request(path=path, user=admin)
+        assert utilities.respStatus(resp) == 200
+        assert resp.json['item']['_id'] == str(item['_id'])
+        assert resp.json['file']['_id'] == str(file['_id'])
+        assert resp.json['settings'][PluginSettings.HUI_BRAND_NAME] == 'HistomicsUI'
+        assert resp.json['privateFolder']['name'] == 'Private'
+        assert resp.json['groups'] == []
+        assert [a['annotation']['name'] for a in resp.json['annotations']] == ['sample']
+        assert {'config', 'tiles', 'adjacentImages'} <= set(resp.json)
+        etag = resp.headers['ETag']
+        resp = server.request(
+            path=path, user=admin, isJson=False, additionalHeaders=[('If-None-Match', etag)])
+        assert utilities.respStatus(resp) == 304
+        # Anything the response depends on changes the ETag
+        Annotation().createAnnotation(item, admin, {'name': 'another', 'elements': []})
+        resp = server.request(
+            path=path, user=admin, additionalHeaders=[('If-None-Match', etag)])
+        assert utilities.respStatus(resp) == 200
+        assert len(resp.json['annotations']) == 2
+        assert resp.headers['ETag'] != etag
+        # Changing the sort order of adjacent images changes the ETag
+        etag = resp.headers['ETag']
+        folder = Folder().load(item['folderId'], force=True)
+        utilities.uploadText(
+            'itemList:\n  defaultSort:\n    - type: record\n      value: updated\n'
+            '      dir: up\n', admin, fsAssetstore, folder, '.large_image_config.yaml')
+        resp = server.request(
+            path=path, user=admin, isJson=False, additionalHeaders=[('If-None-Match', etag)])
+        assert utilities.respStatus(resp) == 200
+        assert resp.headers['ETag'] != etag
+        # As does renaming another item in the folder
+        other = Item().createItem('other', admin, folder)
+        resp = server.request(path=path, user=admin, isJson=False)
+        etag = resp.headers['ETag']
+        other['name'] = 'renamed'
+        Item().save(other)
+        resp = server.request(
+            path=path, user=admin, isJson=False, additionalHeaders=[('If-None-Match', etag)])
+        assert utilities.respStatus(resp) == 200
+        assert resp.headers['ETag'] != etag
+
+    def testFolderConfig(self, server, fsAssetstore, admin):
+        folder = utilities.namedFolder(admin, 'Private')
+        child = Folder().createFolder(folder, 'child', creator=admin)
+        file = utilities.uploadText(
+            'viewMode: test\n', admin, fsAssetstore, folder, '.histomicsui_config.yaml')
+        params = {'folderIds': json.dumps([str(child['_id']), str(folder['_id'])])}
+        resp = server.request(path='/histomicsui/folder_config', user=admin, params=params)
+        assert utilities.respStatus(resp) == 200
+        assert resp.json[str(child['_id'])]['.histomicsui_config.yaml'] == {'viewMode': 'test'}
+        assert resp.json[str(folder['_id'])]['.large_image_config.yaml'] is None
+        hits = folder_config.folderConfigCache.hits
+        resp = server.request(path='/histomicsui/folder_config', user=admin, params=params)
+        assert utilities.respStatus(resp) == 200
+        assert folder_config.folderConfigCache.hits == hits + 4
+        # Replacing a config file in an ancestor discards cached configs
+        Item().remove(Item().load(file['itemId'], force=True))
+        utilities.uploadText(
+            'viewMode: other\n', admin, fsAssetstore, folder, '.histomicsui_config.yaml')
+        resp = server.request(path='/histomicsui/folder_config', user=admin, params=params)
+        assert resp.json[str(child['_id'])]['.histomicsui_config.yaml'] == {'viewMode': 'other'}
+        # Renaming a config file discards cached configs
+        configItem = Item().findOne({'folderId': folder['_id'], 'name': '.histomicsui_config.yaml'})
+        configItem['name'] = 'renamed.yaml'
+        Item().save(configItem)
+        resp = server.request(path='/histomicsui/folder_config', user=admin, params=params)
+        assert resp.json[str(child['_id'])]['.histomicsui_config.yaml'] is None
+        resp = server.request(path='/histomicsui/folder_config', user=None, params=params)
+        assert utilities.respStatus(resp) == 200
+        assert resp.json == {}
+        resp = server.request(path='/histomicsui/folder_config', user=admin, params=dict(
+            params, names=json.dumps(['config.yaml'])))
+        assert utilities.respStatus(resp) == 400
+
     def testRestrictDownloads(self, server, fsAssetstore, admin, user):
         self.makeResources(admin)
         file = utilities.uploadExternalFile('Easy1.png', admin, fsAssetstore)
@@ -432,3 +808,35 @@ class TestHUIEndpoints:
             method='PUT', user=user,
             path='/histomicsui/quarantine/%s' % str(items[0]['_id']))
         assert utilities.respStatus(resp) == 200
+
+    def testLoginSessionExtension(self, server, admin):
+        extender = sessions.SessionExtender(interval=60, flushInterval=3600)
+        token = Token().createToken(admin, days=1)
+        assert extender.extend(token) is False
+        Setting().set(PluginSettings.HUI_LOGIN_SESSION_EXPIRY_MINUTES, 120)
+        # The cached setting is only refreshed when the setting changes; this
+        # extender isn't bound to the setting event
+        assert extender.expiryDays() is None
+        extender._expiry = None
+        assert extender.expiryDays() == pytest.approx(120 / 24 / 60)
+        assert sessions.sessionExtender.expiryDays() == pytest.approx(120 / 24 / 60)
+        Setting().set(PluginSettings.HUI_LOGIN_SESSION_EXPIRY_MINUTES, 60)
+        assert sessions.sessionExtender.expiryDays() == pytest.approx(60 / 24 / 60)
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        assert extender.extend(token, now) is True
+        assert extender.extend(token, now + datetime.timedelta(seconds=30)) is False
+        assert extender.counts() == {'written': 0, 'coalesced': 1, 'pending': 1}
+        assert extender.flush() == 1
+        assert extender.counts() == {'written': 1, 'coalesced': 1, 'pending': 0}
+        expires = Token().load(token['_id'], force=True, objectId=False)['expires']
+        assert abs((expires.replace(tzinfo=datetime.timezone.utc) - now).total_seconds() -
+                   3600) < 1
+        assert extender.extend(token, now + datetime.timedelta(seconds=90)) is True
+        Setting().set(PluginSettings.HUI_LOGIN_SESSION_EXPIRY_MINUTES, None)
+        assert sessions.sessionExtender.expiryDays() is None
+        # Removing the setting also invalidates the cached value
+        Setting().set(PluginSettings.HUI_LOGIN_SESSION_EXPIRY_MINUTES, 60)
+        assert sessions.sessionExtender.expiryDays() == pytest.approx(60 / 24 / 60)
+        Setting().unset(PluginSettings.HUI_LOGIN_SESSION_EXPIRY_MINUTES)
+        assert sessions.sessionExtender.expiryDays() is None
@@ -1,6 +1,11 @@
 import pytest
+from bson import json_util
 from girder.models.folder import Folder
 from girder.models.item import Item
+from girder.models.setting import Setting
+
+from histomicsui import virtual_folders
+from histomicsui.constants import PluginSettings
 
 from . import girder_utilities as utilities
 
@@ -100,3 +105,106 @@ class TestImageBrowseEndpoints:
             path='/item/%s/adjacent_images' % str(self.items[-1]['_id']), user=admin)
         assert utilities.respStatus(resp) == 200
         assert resp.json['next']['_id'] == str(self.items[0]['_id'])
+
+    def testGetAdjacentImagesIndex(self, server, admin):
+        self.makeResources(admin)
+        resp = server.request(
+            path='/item/%s/adjacent_images' % str(self.items[3]['_id']), user=admin)
+        assert utilities.respStatus(resp) == 200
+        assert resp.json['previous']['_id'] == str(self.items[2]['_id'])
+        assert resp.json['index'] == 3
+        assert resp.json['count'] == 10
+
+        resp = server.request(
+            path='/item/%s/adjacent_images' % str(self.items[3]['_id']), user=admin,
+            params={'includeIndex': False})
+        assert utilities.respStatus(resp) == 200
+        assert resp.json['next']['_id'] == str(self.items[4]['_id'])
+        assert 'index' not in resp.json
+
+    def testGetAdjacentImagesSameName(self, server, admin):
+        self.makeResources(admin)
+        # Images with the same name are ordered by id
+        for item in self.items[4:7]:
+            item['name'] = 'item_same'
+            Item().save(item)
+        seen = [self.items[0]['_id']]
+        for _ in range(len(self.items) - 1):
+            resp = server.request(path='/item/%s/next_image' % str(seen[-1]), user=admin)
+            assert utilities.respStatus(resp) == 200
+            seen.append(resp.json['_id'])
+        assert len(set(map(str, seen))) == len(self.items)
+        resp = server.request(path='/item/%s/next_image' % str(seen[-1]), user=admin)
+        assert resp.json['_id'] == str(seen[0])
+        for idx in range(len(seen) - 1, 0, -1):
+            resp = server.request(path='/item/%s/previous_image' % str(seen[idx]), user=admin)
+            assert resp.json['_id'] == str(seen[idx - 1])
+
+    def testGetAdjacentImagesPrefetch(self, server, admin):
+        self.makeResources(admin)
+        resp = server.request(
+            path='/item/%s/adjacent_images' % str(self.items[8]['_id']), user=admin,
+            params={'prefetch': 3})
+        assert utilities.respStatus(resp) == 200
+        assert resp.json['next']['_id'] == str(self.items[9]['_id'])
+        assert [entry['item']['_id'] for entry in resp.json['nextImages']] == [
+            str(self.items[idx]['_id']) for idx in (9, 0, 1)]
+        assert [entry['item']['_id'] for entry in resp.json['previousImages']] == [
+            str(self.items[idx]['_id']) for idx in (7, 6, 5)]
+        # These items aren't real images, so they have no tile metadata
+        assert all('tiles' in entry and entry['tiles'] is None
+                   for entry in resp.json['nextImages'])
+
+        resp = server.request(
+            path='/item/%s/adjacent_images' % str(self.items[8]['_id']), user=admin)
+        assert 'nextImages' not in resp.json
+
+    def testGetAdjacentImagesMaterializedVirtualFolder(self, server, admin):
+        self.makeResources(admin)
+        Setting().set(PluginSettings.HUI_MATERIALIZE_VIRTUAL_FOLDERS, True)
+        virtualFolder = Folder().createFolder(self.folder, 'virtual', creator=admin)
+        virtualFolder['isVirtual'] = True
+        virtualFolder['virtualItemsQuery'] = json_util.dumps({'folderId': self.folder['_id']})
+        virtualFolder = Folder().save(virtualFolder)
+        path = '/item/%s/adjacent_images' % str(self.items[9]['_id'])
+        params = {'folderId': str(virtualFolder['_id'])}
+        builds = virtual_folders.virtualFolderOrderings.builds
+        resp = server.request(path=path, user=admin, params=params)
+        assert utilities.respStatus(resp) == 200
+        assert resp.json['next']['_id'] == str(self.items[0]['_id'])
+        assert resp.json['index'] == 9
+        assert resp.json['count'] == 10
+        assert virtual_folders.virtualFolderOrderings.builds == builds + 1
+
+        # The ordering is updated as items are saved and removed
+        extra = Item().createItem('item_99', creator=admin, folder=self.folder)
+        extra['largeImage'] = {'fileId': 'deadbeef'}
+        extra = Item().save(extra)
+        resp = server.request(path=path, user=admin, params=params)
+        assert resp.json['next']['_id'] == str(extra['_id'])
+        assert resp.json['count'] == 11
+        Item().remove(self.items[0])
+        resp = server.request(path=path, user=admin, params=params)
+        assert resp.json['previous']['_id'] == str(self.items[8]['_id'])
+        assert resp.json['count'] == 10
+        assert virtual_folders.virtualFolderOrderings.builds == builds + 1
+
+        items = list(Folder().childItems(virtualFolder, includeVirtual=True, offset=1, limit=2))
+        assert [item['_id'] for item in items] == [self.items[2]['_id'], self.items[3]['_id']]
+
+        # Queries that can't be matched in memory are rebuilt when next used
+        virtualFolder['virtualItemsQuery'] = json_util.dumps({
+            'folderId': self.folder['_id'], 'name': {'$regex': '^item_'}})
+        virtualFolder = Folder().save(virtualFolder)
+        resp = server.request(path=path, user=admin, params=params)
+        assert resp.json['count'] == 10
+        assert virtual_folders.virtualFolderOrderings.builds == builds + 2
+        # Items that can't match aren't checked against the database
+        Item().createItem('other', creator=admin, folder=Folder().createFolder(
+            self.folder, 'other', creator=admin))
+        assert virtual_folders.virtualFolderOrderings.builds == builds + 2
+        extra['name'] = 'item_98'
+        Item().save(extra)
+        resp = server.request(path=path, user=admin, params=params)
+        assert resp.json['count'] == 10
+        assert virtual_folders.virtualFolderOrderings.builds == builds + 3